@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+import argparse
+import sys
+
+from casperfpga import CasperFpga, CasperLogHandlers
+from casperfpga.benchmarks import BenchmarkReport, BENCHMARKS, \
+    STANDIN_KINDS, run_matrix, run_standin_matrix
+
+parser = argparse.ArgumentParser(
+    description='Benchmark casperfpga against boards or local stand-ins, '
+                'and optionally compare the results with a baseline.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--standin', dest='standin', type=str, action='store', default=None,
+    choices=STANDIN_KINDS,
+    help='benchmark local stand-in boards of this kind')
+parser.add_argument(
+    '--hosts', dest='hosts', type=str, action='store', default='',
+    help='comma-separated boards to benchmark')
+parser.add_argument(
+    '--fpg', dest='fpg', type=str, action='store', default=None,
+    help='the fpg running on the boards, programmed in the programming '
+         'benchmark if --program is given')
+parser.add_argument(
+    '--program', dest='program', action='store_true', default=False,
+    help='include the programming benchmark on real boards')
+parser.add_argument(
+    '--count', dest='count', type=int, action='store', default=4,
+    help='how many stand-in boards')
+parser.add_argument(
+    '--latency', dest='latency', type=float, action='store', default=0.0,
+    help='seconds added to every stand-in request or packet')
+parser.add_argument(
+    '--register', dest='register', type=str, action='store',
+    default='sys_scratchpad', help='the register for latency tests')
+parser.add_argument(
+    '--bram', dest='bram', type=str, action='store', default=None,
+    help='the memory device for throughput tests')
+parser.add_argument(
+    '--snapshot', dest='snapshot', type=str, action='store', default=None,
+    help='the snapshot for capture and decode tests')
+parser.add_argument(
+    '--no-writes', dest='writes', action='store_false', default=True,
+    help='do not run the write benchmarks')
+parser.add_argument(
+    '--quick', dest='quick', action='store_true', default=False,
+    help='fewer repeats, for a smoke test')
+parser.add_argument(
+    '--only', dest='only', type=str, action='store', default='',
+    help='comma-separated benchmarks to run, from: %s' % ', '.join(
+        BENCHMARKS))
+parser.add_argument(
+    '--output', dest='output', type=str, action='store', default=None,
+    help='write the results to this JSON file')
+parser.add_argument(
+    '--baseline', dest='baseline', type=str, action='store', default=None,
+    help='compare the results with this JSON file, exit 1 on regression')
+parser.add_argument(
+    '--tolerance', dest='tolerance', type=float, action='store',
+    default=0.1, help='fractional change allowed before a regression')
+parser.add_argument(
+    '--fast-path', dest='fast_path', action='store_true', default=False,
+    help='skip per-packet debug logging in the transports')
+parser.add_argument('--loglevel', dest='log_level', action='store', default='',
+                    help='log level to use, default None, '
+                         'options INFO, DEBUG, ERROR')
+args = parser.parse_args()
+
+if args.log_level != '':
+    import logging
+    log_level = args.log_level.strip()
+    try:
+        logging.basicConfig(level=eval('logging.%s' % log_level))
+    except AttributeError:
+        raise RuntimeError('No such log level: %s' % log_level)
+
+CasperLogHandlers.set_fast_path(args.fast_path)
+
+benchmarks = BENCHMARKS
+if args.only != '':
+    benchmarks = [name.strip() for name in args.only.split(',')]
+
+if args.standin is not None:
+    report = run_standin_matrix(args.standin, args.count, args.latency,
+                                benchmarks=benchmarks, quick=args.quick)
+elif args.hosts != '':
+    fpgas = []
+    for host in args.hosts.split(','):
+        fpga = CasperFpga(host.strip())
+        fpga.get_system_information(args.fpg)
+        fpgas.append(fpga)
+    report = run_matrix(fpgas, benchmarks=benchmarks, quick=args.quick,
+                        register=args.register, device=args.bram,
+                        snapshot=args.snapshot,
+                        fpg=args.fpg if args.program else None,
+                        writes=args.writes)
+else:
+    raise RuntimeError('Give either --standin or --hosts')
+
+print(report.format())
+if args.output is not None:
+    report.save(args.output)
+    print('Results written to %s' % args.output)
+
+if args.baseline is not None:
+    regressions = report.compare(BenchmarkReport.load(args.baseline),
+                                 args.tolerance)
+    if len(regressions) > 0:
+        print('\nRegressions against %s:' % args.baseline)
+        for name, metric, base, value, change in regressions:
+            print('\t%s %s: %.6g -> %.6g, %.1f%% worse' % (
+                name, metric, base, value, change * 100))
+        sys.exit(1)
+    print('\nNo regressions against %s' % args.baseline)
+
+# end
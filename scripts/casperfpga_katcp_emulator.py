@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+from casperfpga.katcp_emulator import KatcpFpgaServer
+
+parser = argparse.ArgumentParser(
+    description='Emulate a katcp (tcpborphserver) FPGA host on this machine.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--fpg', dest='fpg', type=str, action='store', default=None,
+    help='the fpg the FPGA starts out programmed with')
+parser.add_argument(
+    '--host', dest='host', type=str, action='store', default='127.0.0.1',
+    help='the address on which to listen')
+parser.add_argument(
+    '--port', dest='port', type=int, action='store', default=7147,
+    help='the port on which to listen')
+parser.add_argument(
+    '--latency', dest='latency', type=float, action='store', default=0.0,
+    help='seconds every request takes')
+parser.add_argument(
+    '--jitter', dest='jitter', type=float, action='store', default=0.0,
+    help='up to this many seconds more per request')
+parser.add_argument(
+    '--max-concurrent', dest='max_concurrent', type=int, action='store',
+    default=1, help='the most requests served at once, 0 for no limit')
+parser.add_argument('--loglevel', dest='log_level', action='store', default='',
+                    help='log level to use, default None, '
+                         'options INFO, DEBUG, ERROR')
+args = parser.parse_args()
+
+if args.log_level != '':
+    import logging
+    log_level = args.log_level.strip()
+    try:
+        logging.basicConfig(level=eval('logging.%s' % log_level))
+    except AttributeError:
+        raise RuntimeError('No such log level: %s' % log_level)
+
+server = KatcpFpgaServer(
+    host=args.host, port=args.port, fpg=args.fpg, latency=args.latency,
+    jitter=args.jitter, max_concurrent=args.max_concurrent or None)
+server.start()
+print('Emulating a katcp FPGA host on %s:%i' % server.bind_address)
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    pass
+server.stop()
+server.join()
+
+# end
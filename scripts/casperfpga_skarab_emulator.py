@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+from casperfpga import skarab_definitions as sd
+from casperfpga.skarab_emulator import SkarabEmulator, SkarabEmulatorServer, \
+    loopback_hosts
+
+parser = argparse.ArgumentParser(
+    description='Emulate one or more SKARABs on this machine.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--fpg', dest='fpg', type=str, action='store', default=None,
+    help='the fpg the boards run, they run the golden image if not given')
+parser.add_argument(
+    '--hosts', dest='hosts', type=str, action='store', default='',
+    help='comma-separated addresses on which to emulate boards')
+parser.add_argument(
+    '--count', dest='count', type=int, action='store', default=1,
+    help='emulate this many boards on consecutive loopback addresses, '
+         'if --hosts is not given')
+parser.add_argument(
+    '--first-host', dest='first_host', type=str, action='store',
+    default='127.0.1.1', help='the first loopback address to use')
+parser.add_argument(
+    '--port', dest='port', type=int, action='store',
+    default=sd.ETHERNET_CONTROL_PORT_ADDRESS,
+    help='the control port, 0 to use a free port per board')
+parser.add_argument(
+    '--delay', dest='delay', type=float, action='store', default=0.0,
+    help='delay every response by this many seconds')
+parser.add_argument(
+    '--jitter', dest='jitter', type=float, action='store', default=0.0,
+    help='delay responses by up to this many seconds more')
+parser.add_argument(
+    '--drop', dest='drop', type=float, action='store', default=0.0,
+    help='the chance of losing each request and response')
+parser.add_argument(
+    '--reorder', dest='reorder', type=float, action='store', default=0.0,
+    help='the chance of a response being overtaken by later ones')
+parser.add_argument(
+    '--boot-time', dest='boot_time', type=float, action='store', default=0.0,
+    help='seconds the boards are silent after a reboot')
+parser.add_argument('--loglevel', dest='log_level', action='store', default='',
+                    help='log level to use, default None, '
+                         'options INFO, DEBUG, ERROR')
+args = parser.parse_args()
+
+if args.log_level != '':
+    import logging
+    log_level = args.log_level.strip()
+    try:
+        logging.basicConfig(level=eval('logging.%s' % log_level))
+    except AttributeError:
+        raise RuntimeError('No such log level: %s' % log_level)
+
+if args.hosts != '':
+    hosts = [host.strip() for host in args.hosts.split(',')]
+else:
+    hosts = loopback_hosts(args.count, args.first_host)
+
+server = SkarabEmulatorServer()
+for host in hosts:
+    emulator = server.add(SkarabEmulator(
+        host=host, port=args.port, fpg=args.fpg, delay=args.delay,
+        jitter=args.jitter, drop=args.drop, reorder=args.reorder,
+        boot_time=args.boot_time))
+    print('Emulating a SKARAB on %s:%i' % (emulator.host, emulator.port))
+
+server.start()
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    pass
+server.stop()
+
+# end
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+import argparse
+import time
+
+from casperfpga.tapcp_emulator import TapcpServer, FLASH_SECTOR_ERASE_TIME, \
+    FLASH_PAGE_PROGRAM_TIME
+
+parser = argparse.ArgumentParser(
+    description='Emulate one or more TAPCP (SNAP) boards on this machine.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    '--fpg', dest='fpg', type=str, action='store', default=None,
+    help='the fpg the boards start out running')
+parser.add_argument(
+    '--golden-fpg', dest='golden_fpg', type=str, action='store',
+    default=None, help='the fpg of the golden image')
+parser.add_argument(
+    '--hosts', dest='hosts', type=str, action='store', default='127.0.0.1',
+    help='comma-separated addresses on which to emulate boards')
+parser.add_argument(
+    '--port', dest='port', type=int, action='store', default=69,
+    help='the TFTP port, 0 to use a free port per board')
+parser.add_argument(
+    '--no-options', dest='negotiate', action='store_false', default=True,
+    help='ignore TFTP blksize and windowsize options')
+parser.add_argument(
+    '--delay', dest='delay', type=float, action='store', default=0.0,
+    help='delay every packet by this many seconds')
+parser.add_argument(
+    '--loss', dest='loss', type=float, action='store', default=0.0,
+    help='the chance of losing each packet')
+parser.add_argument(
+    '--erase-time', dest='erase_time', type=float, action='store',
+    default=FLASH_SECTOR_ERASE_TIME,
+    help='seconds to erase a flash sector')
+parser.add_argument(
+    '--page-program-time', dest='page_program_time', type=float,
+    action='store', default=FLASH_PAGE_PROGRAM_TIME,
+    help='seconds to program a flash page')
+parser.add_argument('--loglevel', dest='log_level', action='store', default='',
+                    help='log level to use, default None, '
+                         'options INFO, DEBUG, ERROR')
+args = parser.parse_args()
+
+if args.log_level != '':
+    import logging
+    log_level = args.log_level.strip()
+    try:
+        logging.basicConfig(level=eval('logging.%s' % log_level))
+    except AttributeError:
+        raise RuntimeError('No such log level: %s' % log_level)
+
+servers = []
+for host in args.hosts.split(','):
+    server = TapcpServer(
+        host=host.strip(), port=args.port, fpg=args.fpg,
+        golden_fpg=args.golden_fpg, negotiate=args.negotiate,
+        delay=args.delay, loss=args.loss, flash_erase_time=args.erase_time,
+        flash_page_program_time=args.page_program_time)
+    servers.append(server.start())
+    print('Emulating a TAPCP board on %s:%i' % (server.host, server.port))
+
+try:
+    while True:
+        time.sleep(1)
+except KeyboardInterrupt:
+    pass
+for server in servers:
+    server.stop()
+
+# end
@@ -135,7 +135,7 @@ if args.spead:
             raise RuntimeError(
                 'Gbe packet not correct length - should be {}. is {}'.format(
                     expected_packet_length, len(pkt[data_key])))
-        gbe_data.append(pkt[data_key])
+        gbe_data.append([int(word) for word in pkt[data_key]])
     spead_processor.process_data(gbe_data)
     spead_data = []
     for ctr, spead_pkt in enumerate(spead_processor.packets):
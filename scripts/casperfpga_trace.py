@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import argparse
+
+from casperfpga import CasperFpga
+from casperfpga import tracing
+
+parser = argparse.ArgumentParser(
+    description='Analyse a casperfpga trace file: time per call site, '
+                'redundant reads and adjacent accesses that could be '
+                'coalesced. Optionally simulate or replay it.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument(
+    dest='trace', type=str, action='store',
+    help='the trace file, written by a tracing.TraceRecorder')
+parser.add_argument(
+    '--layer', dest='layer', type=str, action='store', default='casperfpga',
+    choices=sorted(tracing.LAYER_NAMES.values()),
+    help='analyse CasperFpga reads and writes, or transport requests')
+parser.add_argument(
+    '--top', dest='top', type=int, action='store', default=10,
+    help='how many entries to show in each table')
+parser.add_argument(
+    '--max-gap', dest='max_gap', type=int, action='store', default=0,
+    help='accesses this many bytes apart still count as adjacent')
+parser.add_argument(
+    '--latency', dest='latency', type=float, action='store', default=None,
+    help='simulate the trace on a link with this many seconds per request')
+parser.add_argument(
+    '--bandwidth', dest='bandwidth', type=float, action='store', default=0,
+    help='the simulated link speed, bytes per second, 0 for unlimited')
+parser.add_argument(
+    '--replay', dest='replay', type=str, action='store', default=None,
+    help='replay the reads in the trace on this board')
+parser.add_argument(
+    '--fpg', dest='fpg', type=str, action='store', default=None,
+    help='the fpg running on the replay board')
+parser.add_argument(
+    '--coalesce', dest='coalesce', action='store_true', default=False,
+    help='replay runs of adjacent reads as one read_many')
+parser.add_argument('--loglevel', dest='log_level', action='store', default='',
+                    help='log level to use, default None, '
+                         'options INFO, DEBUG, ERROR')
+args = parser.parse_args()
+
+if args.log_level != '':
+    import logging
+    log_level = args.log_level.strip()
+    try:
+        logging.basicConfig(level=eval('logging.%s' % log_level))
+    except AttributeError:
+        raise RuntimeError('No such log level: %s' % log_level)
+
+layer = [key for key, value in tracing.LAYER_NAMES.items()
+         if value == args.layer][0]
+events = tracing.read_trace(args.trace)
+print(tracing.format_analysis(
+    tracing.analyse_trace(events, layer, args.max_gap), args.top))
+
+if args.latency is not None:
+    simulated = tracing.simulate_trace(events, args.latency, args.bandwidth,
+                                       layer, args.max_gap)
+    print('\nSimulated at %.3f ms per request:' % (args.latency * 1000))
+    for name in ('recorded', 'no_redundant', 'coalesced'):
+        print('  %-14s %7i requests %10.3f ms' % (
+            name, simulated[name]['requests'],
+            simulated[name]['time'] * 1000))
+
+if args.replay is not None:
+    fpga = CasperFpga(args.replay)
+    fpga.get_system_information(args.fpg)
+    hosts = set(event.host for event in events)
+    result = tracing.replay_trace(
+        events, fpga, host=hosts.pop() if len(hosts) == 1 else None,
+        coalesce=args.coalesce, max_gap=args.max_gap)
+    print('\nReplayed on %s:' % args.replay)
+    for name in ('recorded', 'replayed'):
+        print('  %-14s %7i requests %10.3f ms' % (
+            name, result[name]['requests'], result[name]['time'] * 1000))
+
+# end
@@ -47,14 +47,16 @@ setuptools.setup(
     long_description_content_type='text/markdown',
     # Specify version in-line here
     install_requires=[
+        'futures',
         'katcp==0.6.2',
         'numpy==1.16',
         'odict',
         'setuptools',
         'tornado==4.3',
     ],
-    packages=['casperfpga'],
-    package_dir={'casperfpga': 'src'},
+    packages=['casperfpga', 'casperfpga.benchmarks'],
+    package_dir={'casperfpga': 'src',
+                 'casperfpga.benchmarks': 'src/benchmarks'},
     scripts=glob.glob('scripts/*'),
     setup_requires=['katversion'],
     use_katversion=True,
@@ -2,6 +2,11 @@ import logging
 import termcolors
 import datetime
 import os
+import collections
+import copy
+import threading
+import time
+import Queue
 
 LOGGER = logging.getLogger(__name__)
 
@@ -88,7 +93,7 @@ def getNewLogger(*args, **kwargs):
     file_handler = logging.FileHandler(filename)
     formatted_datetime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-4]
     formatted_string = '%(name)s - ' + formatted_datetime + ' - %(levelname)s ' \
-                        '| %(filename)s:%(lineno)d - %(msg)s'
+                        '| %(filename)s:%(lineno)d - %(message)s'
     file_handler.setFormatter(logging.Formatter(formatted_string))
     logger.addHandler(file_handler)
     logger.setLevel(log_level)
@@ -97,15 +102,163 @@ def getNewLogger(*args, **kwargs):
 
 # endregion
 
+# region -- Hot-path logging --
+
+# When True, transports skip their per-packet debug logging altogether,
+# without even asking their loggers whether DEBUG is enabled
+FAST_PATH = False
+
+
+def set_fast_path(enabled=True):
+    """
+    Strip the per-packet debug logging from the transport hot paths.
+
+    :param enabled: True to skip per-packet logging, False to log per
+        packet again whenever a logger is at DEBUG
+    """
+    global FAST_PATH
+    FAST_PATH = enabled
+
+
+def debug_enabled(logger):
+    """
+    Should a hot path log at DEBUG? Transports ask once per request and
+    keep the answer, rather than building messages that are thrown away.
+
+    :param logger: the logger the debug messages would go to
+    :return: True/False
+    """
+    return (not FAST_PATH) and logger.isEnabledFor(logging.DEBUG)
+
+# endregion
+
 
 # region -- CasperConsoleHandler --
 
+class _ConsoleListener(object):
+    """
+    A daemon thread printing the records queued by CasperConsoleHandlers,
+    so that a thread that logs never waits for the console. It also prints
+    the repeats a handler held back once their rate-limit window ends.
+    """
+    def __init__(self, max_queued=10000):
+        """
+        :param max_queued: records waiting beyond this are dropped
+        """
+        self.queue = Queue.Queue(max_queued)
+        self._thread = None
+        self._lock = threading.Lock()
+        # handlers holding back repeats
+        self._watched = set()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='CasperConsoleListener')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def enqueue(self, handler, record):
+        """
+        Queue a record to be written by a handler, without blocking.
+
+        :return: False if the queue is full and the record was dropped
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
+        try:
+            self.queue.put_nowait((handler, record))
+        except Queue.Full:
+            return False
+        return True
+
+    def watch(self, handler):
+        """
+        Report the repeats a handler is holding back when their rate-limit
+        window ends, even if the message is not logged again.
+
+        :param handler: the CasperConsoleHandler, with its lock held
+        """
+        with self._lock:
+            if handler in self._watched:
+                return
+            self._watched.add(handler)
+        # wake the thread so that it works out when to report them
+        self.enqueue(None, None)
+
+    def _report_held_back(self):
+        """
+        Have the watched handlers print the repeats held back in windows
+        that have ended.
+
+        :return: seconds until the next window ends, or None
+        """
+        now = time.time()
+        next_due = None
+        with self._lock:
+            handlers = list(self._watched)
+        for handler in handlers:
+            handler.acquire()
+            try:
+                due = handler.report_held_back(now)
+                if due is None:
+                    with self._lock:
+                        self._watched.discard(handler)
+                elif next_due is None or due < next_due:
+                    next_due = due
+            finally:
+                handler.release()
+        if next_due is None:
+            return None
+        return max(next_due - now, 0.01)
+
+    def _run(self):
+        while True:
+            try:
+                handler, record = self.queue.get(
+                    timeout=self._report_held_back())
+            except Queue.Empty:
+                continue
+            try:
+                if handler is not None:
+                    handler.write_record(record)
+            except Exception:
+                handler.handleError(record)
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout=5.0):
+        """
+        Wait until every queued record has been written.
+
+        :param timeout: give up after this many seconds
+        """
+        deadline = time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+_CONSOLE_LISTENER = _ConsoleListener()
+
+
 class CasperConsoleHandler(logging.Handler):
     """
     Stream Log Handler for casperfpga records 
 
     * Trying a custom logger before incorporating into corr2
     * This inherits from the logging.Handler - Stream or File
+    * Records are printed by a background thread, so emitting never
+      blocks on the console. If that thread falls too far behind, records
+      are dropped from the console (but kept in the history) and counted
+      in dropped.
+    * A message repeated within rate_limit seconds is printed once. The
+      repeats held back are reported, with their number, when the window
+      ends or the message is next printed, whichever comes first.
     """
 
     def __init__(self, name, *args, **kwargs):
@@ -117,19 +270,26 @@ class CasperConsoleHandler(logging.Handler):
         :param name: Name of the StreamHandler
         :type name: str
         :param max_len: How many log records to store in the FIFO
+        :param rate_limit: Seconds before a repeated message is printed
+            again, 0 to print every message
+        :param blocking: Print on the logging thread instead of queueing
         """
+        max_len = kwargs.pop('max_len', 1000)
+        self.rate_limit = kwargs.pop('rate_limit', 1.0)
+        self.blocking = kwargs.pop('blocking', False)
         # logging.Handler.__init__(self)
         super(CasperConsoleHandler, self).__init__(*args, **kwargs)
 
         # This always needs to be present
         self.name = name
 
-        try:
-            self._max_len = kwargs['max_len']
-        except KeyError:
-            self._max_len = 1000
-
-        self._records = []
+        self._max_len = max_len
+        self._records = collections.deque(maxlen=max_len)
+        # (logger name, level, message) ->
+        #     [time last printed, repeats held back, last record held back]
+        self._recent = {}
+        self.dropped = 0
+        self.suppressed = 0
 
     def emit(self, record):
         """
@@ -138,13 +298,79 @@ class CasperConsoleHandler(logging.Handler):
         :param record: Log record as a string
         :return: True/False = Success/Fail
         """
-        if len(self._records) >= self._max_len:
-            self._records.pop(0)
-
+        # the arguments may change before the record is printed, so format
+        # the message now, on a copy other handlers won't see
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        # key on the formatted message, so that messages made from the same
+        # template with different arguments are not taken for repeats
+        key = (record.name, record.levelno, record.msg)
         self._records.append(record)
+        if self.rate_limit > 0 and not self._rate_check(key, record):
+            return
+        if self.blocking:
+            self.write_record(record)
+        elif not _CONSOLE_LISTENER.enqueue(self, record):
+            self.dropped += 1
+
+    def _rate_check(self, key, record):
+        """
+        Should this record be printed, or is it a repeat of one printed
+        less than rate_limit seconds ago?
+        """
+        entry = self._recent.get(key)
+        if entry is not None and record.created - entry[0] < self.rate_limit:
+            entry[1] += 1
+            entry[2] = record
+            self.suppressed += 1
+            _CONSOLE_LISTENER.watch(self)
+            return False
+        if entry is not None and entry[1] > 0:
+            record.msg = '%s (repeated %i times)' % (record.msg, entry[1])
+        if entry is None and len(self._recent) >= self._max_len:
+            # forget the messages that are no longer being held back
+            self._recent = dict(
+                (old_key, old_entry) for old_key, old_entry
+                in self._recent.items()
+                if (record.created - old_entry[0] < self.rate_limit) or
+                (old_entry[1] > 0))
+        self._recent[key] = [record.created, 0, None]
+        return True
+
+    def report_held_back(self, now):
+        """
+        Print the last of the repeats held back in each rate-limit window
+        that has ended, with their number. Call with the handler's lock
+        held.
+
+        :param now: the time.time() to check the windows against
+        :return: when the next window with repeats held back ends, or None
+        """
+        next_due = None
+        for key, entry in self._recent.items():
+            if entry[1] == 0:
+                continue
+            due = entry[0] + self.rate_limit
+            if due > now:
+                if next_due is None or due < next_due:
+                    next_due = due
+                continue
+            record = entry[2]
+            record.msg = '%s (repeated %i times)' % (record.msg, entry[1])
+            # repeats straight after this are held back again
+            self._recent[key] = [now, 0, None]
+            self.write_record(record)
+        return next_due
+
+    def write_record(self, record):
+        """
+        Print a record to the console, coloured by level.
 
+        :param record: Log record, of type logging.LogRecord
+        """
         if record.exc_info:
-            print termcolors.colorize('%s: %s Exception: ' % (record.name, record.msg), record.exc_info[0:-1],
+            print termcolors.colorize('%s: %s Exception: ' % (record.name, record.getMessage()), record.exc_info[0:-1],
                                       fg='red')
         else:
             console_text = self.format(record)
@@ -157,16 +383,24 @@ class CasperConsoleHandler(logging.Handler):
             elif record.levelno >= logging.ERROR:
                 print termcolors.colorize(console_text, fg='red')
             else:
-                print '%s: %s' % (record.name, record.msg)
+                print '%s: %s' % (record.name, record.getMessage())
+
+    def flush(self):
+        """
+        Wait for the queued records to be printed.
+        """
+        _CONSOLE_LISTENER.flush()
 
     def format(self, record):
         """
         :param record: Log record as a string, of type logging.LogRecord
         :return: Formatted record
         """
-        formatted_datetime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-4]
+        formatted_datetime = datetime.datetime.fromtimestamp(
+            record.created).strftime('%Y-%m-%d %H:%M:%S.%f')[:-4]
         formatted_string = '{} {} {} {}:{} - {}'.format(formatted_datetime, record.levelname, record.name,
-                                                        record.filename, str(record.lineno), record.msg)
+                                                        record.filename, str(record.lineno),
+                                                        record.getMessage())
         
         return formatted_string
 
@@ -174,7 +408,7 @@ class CasperConsoleHandler(logging.Handler):
         """
         Clear the list of stored log messages
         """
-        self._records = []
+        self._records.clear()
 
     def set_max_len(self, max_len):
         """
@@ -182,6 +416,7 @@ class CasperConsoleHandler(logging.Handler):
         :param max_len:
         """
         self._max_len = max_len
+        self._records = collections.deque(self._records, maxlen=max_len)
 
     def get_log_strings(self, num_to_print=1):
         """
@@ -192,9 +427,9 @@ class CasperConsoleHandler(logging.Handler):
         for ctr, record in enumerate(self._records):
             if ctr == num_to_print:
                 if record.exc_info:
-                    log_list.append('%s: %s Exception: ' % (record.name, record.msg))
+                    log_list.append('%s: %s Exception: ' % (record.name, record.getMessage()))
                 else:
-                    log_list.append('%s: %s' % (record.name, record.msg))
+                    log_list.append('%s: %s' % (record.name, record.getMessage()))
             pass
         return log_list
 
@@ -208,17 +443,17 @@ class CasperConsoleHandler(logging.Handler):
             if ctr == num_to_print:
                 break
             if record.exc_info:
-                print termcolors.colorize('%s: %s Exception: ' % (record.name, record.msg), record.exc_info[0:-1],
+                print termcolors.colorize('%s: %s Exception: ' % (record.name, record.getMessage()), record.exc_info[0:-1],
                                           fg='red')
             else:
                 if record.levelno < logging.WARNING:
-                    print termcolors.colorize('%s: %s' % (record.name, record.msg), fg='green')
+                    print termcolors.colorize('%s: %s' % (record.name, record.getMessage()), fg='green')
                 elif (record.levelno >= logging.WARNING) and (record.levelno < logging.ERROR):
-                    print termcolors.colorize('%s: %s' % (record.name, record.msg), fg='yellow')
+                    print termcolors.colorize('%s: %s' % (record.name, record.getMessage()), fg='yellow')
                 elif record.levelno >= logging.ERROR:
-                    print termcolors.colorize('%s: %s' % (record.name, record.msg), fg='red')
+                    print termcolors.colorize('%s: %s' % (record.name, record.getMessage()), fg='red')
                 else:
-                    print '%s: %s' % (record.name, record.msg)
+                    print '%s: %s' % (record.name, record.getMessage())
 
 # endregion
 
@@ -6,8 +6,9 @@ control and monitor fpga-based casper designs.
 from bitfield import Bitfield, Field
 from katadc import KatAdc
 from casperfpga import CasperFpga
+from fleet import FpgaFleet
 from transport_katcp import KatcpTransport
-from transport_tapcp import TapcpTransport
+from transport_tapcp import TapcpTransport, tapcp_program_many
 from transport_skarab import SkarabTransport
 from transport_itpm import ItpmTransport
 from memory import Memory
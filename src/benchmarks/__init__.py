@@ -0,0 +1,14 @@
+"""
+Benchmarks for the casperfpga hot paths: register latency, bulk
+throughput, snapshot decoding, fleet sweeps, design loading and
+programming. They run against real boards or local stand-ins, and report
+percentile latencies as JSON for comparison against a stored baseline.
+"""
+
+from results import BenchmarkReport, summarise
+from standins import StandIns, make_test_fpg, STANDIN_KINDS
+from suite import BENCHMARKS, run_matrix, run_standin_matrix, \
+    bench_register_latency, bench_bulk_throughput, bench_snapshot, \
+    bench_fleet_sweep, bench_design_load, bench_programming
+
+# end
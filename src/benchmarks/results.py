@@ -0,0 +1,153 @@
+"""
+Benchmark results: latency percentiles, JSON reports and comparison
+against a stored baseline.
+"""
+
+import json
+import time
+import socket
+import platform
+
+import numpy as np
+
+# metrics where a bigger number is better, all others are times
+HIGHER_IS_BETTER = ('mb_per_s', 'per_s')
+
+# the metrics compared against a baseline
+COMPARED_METRICS = ('p50', 'p90', 'p99', 'mb_per_s', 'per_s')
+
+
+def summarise(samples):
+    """
+    Summarise a list of times.
+
+    :param samples: times, in seconds
+    :return: a dict of count, mean, min, max and the 50th, 90th and 99th
+        percentiles, in seconds
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    if len(samples) == 0:
+        return {'count': 0}
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+    return {'count': len(samples), 'mean': float(samples.mean()),
+            'min': float(samples.min()), 'max': float(samples.max()),
+            'p50': float(p50), 'p90': float(p90), 'p99': float(p99)}
+
+
+class BenchmarkReport(object):
+    """
+    The results of one benchmark run.
+
+    Each result has a name of the form benchmark/case, e.g.
+    bulk_read/65536, and holds its parameters and its metrics.
+    """
+    def __init__(self, target='', meta=None):
+        """
+
+        :param target: what was benchmarked, e.g. the stand-in or hosts
+        :param meta: a dict of extra information to store with the results
+        """
+        self.meta = {
+            'target': target,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'machine': socket.gethostname(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+        }
+        try:
+            from .. import __version__
+            self.meta['casperfpga'] = __version__
+        except ImportError:
+            pass
+        self.meta.update(meta or {})
+        self.results = {}
+
+    def add(self, name, samples=None, params=None, **metrics):
+        """
+        Add a result.
+
+        :param name: the result name, benchmark/case
+        :param samples: times, in seconds, summarised into percentiles
+        :param params: a dict of the parameters of the case
+        :param metrics: other metrics, e.g. mb_per_s
+        :return: the result dict
+        """
+        result = {'params': params or {}}
+        if samples is not None:
+            result.update(summarise(samples))
+        result.update(metrics)
+        self.results[name] = result
+        return result
+
+    def to_dict(self):
+        return {'meta': self.meta, 'results': self.results}
+
+    def save(self, filename):
+        """
+        Write the report to a JSON file.
+        """
+        with open(filename, 'w') as fptr:
+            json.dump(self.to_dict(), fptr, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a report from a JSON file.
+        """
+        with open(filename, 'r') as fptr:
+            data = json.load(fptr)
+        report = cls()
+        report.meta = data.get('meta', {})
+        report.results = data.get('results', {})
+        return report
+
+    def compare(self, baseline, tolerance=0.1):
+        """
+        Compare these results with a baseline.
+
+        :param baseline: a BenchmarkReport
+        :param tolerance: the fractional change allowed before a metric
+            counts as a regression
+        :return: a list of (name, metric, baseline value, value, change)
+            for each regressed metric, change being the fractional change
+            in the bad direction
+        """
+        regressions = []
+        for name in sorted(self.results.keys()):
+            if name not in baseline.results:
+                continue
+            current = self.results[name]
+            base = baseline.results[name]
+            for metric in COMPARED_METRICS:
+                if (metric not in current) or (metric not in base) or \
+                        (base[metric] <= 0):
+                    continue
+                change = (current[metric] - base[metric]) / base[metric]
+                if metric in HIGHER_IS_BETTER:
+                    change = -change
+                if change > tolerance:
+                    regressions.append((name, metric, base[metric],
+                                        current[metric], change))
+        return regressions
+
+    def format(self):
+        """
+        A table of the results, for printing.
+        """
+        lines = ['%-32s %10s %10s %10s %12s' % (
+            'benchmark', 'p50 ms', 'p90 ms', 'p99 ms', 'rate')]
+        for name in sorted(self.results.keys()):
+            result = self.results[name]
+            times = ['%10.3f' % (result[metric] * 1000.0)
+                     if metric in result else '%10s' % '-'
+                     for metric in ('p50', 'p90', 'p99')]
+            if 'mb_per_s' in result:
+                rate = '%8.2f MB/s' % result['mb_per_s']
+            elif 'per_s' in result:
+                rate = '%10.1f/s' % result['per_s']
+            else:
+                rate = ''
+            lines.append('%-32s %s %12s' % (name, ' '.join(times), rate))
+        return '\n'.join(lines)
+
+# end
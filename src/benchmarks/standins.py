@@ -0,0 +1,173 @@
+"""
+Local stand-ins for boards, and synthetic designs to load onto them, so
+the benchmarks can run without hardware.
+"""
+
+import logging
+
+from ..casperfpga import CasperFpga
+from ..transport_dummy import DummyTransport
+from ..transport_katcp import KatcpTransport
+from ..transport_skarab import SkarabTransport
+from ..transport_tapcp import TapcpTransport
+
+LOGGER = logging.getLogger(__name__)
+
+STANDIN_KINDS = ('dummy', 'katcp', 'skarab', 'tapcp')
+
+# names of the devices in a synthetic design
+BENCH_REGISTER = 'bench_reg%i'
+BENCH_SNAPSHOT = 'bench_snap'
+BENCH_BRAM = 'bench_bram'
+
+SYS_REGISTERS = [('sys_board_id', 0x0), ('sys_rev', 0x4),
+                 ('sys_rev_rcs', 0xc), ('sys_scratchpad', 0x10),
+                 ('sys_clkcounter', 0x14)]
+
+
+def _sw_reg_meta(name, io_dir):
+    return ['?meta\t%s\txps:sw_reg\t%s' % (name, line) for line in (
+        'io_dir\t%s' % io_dir, 'names\treg', 'bitwidths\t32',
+        'arith_types\t0', 'bin_pts\t0')]
+
+
+def _bram_meta(name, num_bytes):
+    return ['?meta\t%s\txps:bram\t%s' % (name, line) for line in (
+        'addr_width\t%i' % ((num_bytes // 4).bit_length() - 1),
+        'data_width\t32')]
+
+
+def make_test_fpg(filename, num_registers=16, snapshot_nsamples=13,
+                  bram_bytes=0x40000, clk_rate=200):
+    """
+    Write a synthetic fpg file: the system registers, num_registers
+    software registers, a 32-bit snapshot and a BRAM. The bitstream is a
+    small block of zeros.
+
+    :param filename: the file to write
+    :param num_registers: how many bench_regN registers
+    :param snapshot_nsamples: log2 of the snapshot length, in words
+    :param bram_bytes: the size of bench_bram, a power of two
+    :param clk_rate: the design clock, MHz
+    :return: filename
+    """
+    registers = []
+    meta = ['?meta\t77777\tsystem\tsystem\tbenchmark',
+            '?meta\tXSG_core_config\txps:xsg\tclk_rate\t%i' % clk_rate]
+    for name, address in SYS_REGISTERS:
+        registers.append((name, address, 4))
+    address = 0x1000
+    for ctr in range(num_registers):
+        name = BENCH_REGISTER % ctr
+        registers.append((name, address, 4))
+        meta.extend(_sw_reg_meta(name, 'From\\_Processor'))
+        address += 4
+    for suffix, io_dir in (('_ctrl', 'From\\_Processor'),
+                           ('_status', 'To\\_Processor')):
+        registers.append((BENCH_SNAPSHOT + suffix, address, 4))
+        meta.extend(_sw_reg_meta(BENCH_SNAPSHOT + suffix, io_dir))
+        address += 4
+    snap_bytes = (2 ** snapshot_nsamples) * 4
+    address = (address + snap_bytes - 1) // snap_bytes * snap_bytes
+    registers.append((BENCH_SNAPSHOT + '_bram', address, snap_bytes))
+    meta.extend('?meta\t%s\tcasper:snapshot\t%s' % (BENCH_SNAPSHOT, line)
+                for line in ('data_width\t32',
+                             'nsamples\t%i' % snapshot_nsamples,
+                             'offset\toff', 'value\toff', 'circap\toff'))
+    meta.extend(_bram_meta(BENCH_SNAPSHOT + '_bram', snap_bytes))
+    address += snap_bytes
+    address = (address + bram_bytes - 1) // bram_bytes * bram_bytes
+    registers.append((BENCH_BRAM, address, bram_bytes))
+    meta.extend(_bram_meta(BENCH_BRAM, bram_bytes))
+    lines = ['#!/bin/kcpfpg', '?uploadbin']
+    lines.extend('?register\t%s\t0x%x\t0x%x' % register
+                 for register in registers)
+    lines.extend(meta)
+    lines.append('?quit')
+    with open(filename, 'wb') as fptr:
+        fptr.write('\n'.join(lines) + '\n')
+        fptr.write('\x00' * 1024)
+    return filename
+
+
+class StandIns(object):
+    """
+    A set of local stand-in boards all running the same design, and a
+    CasperFpga talking to each.
+    """
+    def __init__(self, kind, fpg, count=1, latency=0.0, **kwargs):
+        """
+
+        :param kind: dummy, katcp, skarab or tapcp
+        :param fpg: the design the boards run
+        :param count: how many boards
+        :param latency: seconds added to every request or packet
+        :param kwargs: passed on to the stand-in servers
+        """
+        if kind not in STANDIN_KINDS:
+            raise ValueError('Unknown stand-in %s, expected one of %s' % (
+                kind, ', '.join(STANDIN_KINDS)))
+        self.kind = kind
+        self.fpg = fpg
+        self.servers = []
+        self.fpgas = []
+        try:
+            for ctr in range(count):
+                self.fpgas.append(self._start_one(ctr, latency, kwargs))
+            for fpga in self.fpgas:
+                fpga.get_system_information(fpg)
+        except Exception:
+            self.stop()
+            raise
+
+    def _start_one(self, ctr, latency, kwargs):
+        if self.kind == 'dummy':
+            return CasperFpga('dummy%i' % ctr, bitstream=self.fpg,
+                              transport=DummyTransport, latency=latency,
+                              **kwargs)
+        if self.kind == 'katcp':
+            from ..katcp_emulator import KatcpFpgaServer
+            server = KatcpFpgaServer(port=0, fpg=self.fpg, latency=latency,
+                                     **kwargs)
+            server.start()
+            self.servers.append(server)
+            return CasperFpga(server.bind_address[0],
+                              port=server.bind_address[1],
+                              transport=KatcpTransport)
+        if self.kind == 'skarab':
+            from ..skarab_emulator import SkarabEmulator, \
+                SkarabEmulatorServer
+            emulator = SkarabEmulator(port=0, fpg=self.fpg, delay=latency,
+                                      **kwargs)
+            self.servers.append(SkarabEmulatorServer([emulator]).start())
+            return CasperFpga(emulator.host,
+                              skarab_control_port=emulator.port,
+                              transport=SkarabTransport)
+        from ..tapcp_emulator import TapcpServer
+        server = TapcpServer(port=0, fpg=self.fpg, delay=latency, **kwargs)
+        self.servers.append(server.start())
+        return CasperFpga(server.host, tftp_port=server.port,
+                          transport=TapcpTransport)
+
+    def stop(self):
+        """
+        Disconnect from and stop all the stand-ins.
+        """
+        for fpga in self.fpgas:
+            if isinstance(fpga.transport, KatcpTransport):
+                fpga.transport.stop()
+                fpga.transport.join(timeout=1)
+        for server in self.servers:
+            server.stop()
+            if hasattr(server, 'join'):
+                server.join(timeout=1)
+        self.servers = []
+        self.fpgas = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+# end
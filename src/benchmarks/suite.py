@@ -0,0 +1,255 @@
+"""
+The standard benchmark matrix.
+
+Each bench_ function runs one benchmark and adds its results to a
+BenchmarkReport. run_matrix runs the lot against a set of boards, and
+run_standin_matrix runs it against local stand-ins.
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+
+from ..casperfpga import CasperFpga
+from ..transport_dummy import DummyTransport
+from ..fleet import FpgaFleet
+from ..utils import parse_fpg
+from results import BenchmarkReport
+from standins import StandIns, make_test_fpg, BENCH_REGISTER, \
+    BENCH_SNAPSHOT, BENCH_BRAM
+
+LOGGER = logging.getLogger(__name__)
+
+BENCHMARKS = ('register_latency', 'bulk_throughput', 'snapshot',
+              'fleet_sweep', 'design_load', 'programming')
+
+# register counts for the design load benchmark
+DESIGN_SIZES = (10, 100, 1000, 5000)
+
+
+def _time_calls(func, repeats):
+    """
+    Call func repeats times.
+
+    :return: a list of the time each call took, in seconds
+    """
+    samples = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return samples
+
+
+def _powers_of_two(start, stop):
+    values = []
+    value = start
+    while value <= stop:
+        values.append(value)
+        value *= 2
+    return values
+
+
+def bench_register_latency(report, fpga, register='sys_scratchpad',
+                           repeats=500, writes=True):
+    """
+    Single-register read and write latency.
+    """
+    params = {'register': register}
+    samples = _time_calls(lambda: fpga.read_uint(register), repeats)
+    report.add('register_latency/read', samples, params,
+               per_s=repeats / sum(samples))
+    if writes:
+        data = '\x00\x00\x00\x00'
+        samples = _time_calls(lambda: fpga.blindwrite(register, data),
+                              repeats)
+        report.add('register_latency/blindwrite', samples, params,
+                   per_s=repeats / sum(samples))
+
+
+def bench_bulk_throughput(report, fpga, device, sizes=None, repeats=10,
+                          writes=True):
+    """
+    Read and write throughput against transfer size, from one word up to
+    the whole device.
+    """
+    if sizes is None:
+        sizes = _powers_of_two(
+            4, fpga.memory_devices[device].length_bytes)
+    for size in sizes:
+        params = {'device': device, 'bytes': size}
+        samples = _time_calls(lambda: fpga.read(device, size), repeats)
+        report.add('bulk_read/%i' % size, samples, params,
+                   mb_per_s=size * repeats / sum(samples) / 1e6)
+        if writes:
+            data = '\x5a' * size
+            samples = _time_calls(lambda: fpga.blindwrite(device, data),
+                                  repeats)
+            report.add('bulk_write/%i' % size, samples, params,
+                       mb_per_s=size * repeats / sum(samples) / 1e6)
+
+
+def bench_snapshot(report, fpga, snapshot, repeats=10):
+    """
+    Snapshot capture rate, and the rate at which captures are decoded.
+    """
+    snap = fpga.snapshots[snapshot]
+    params = {'snapshot': snapshot, 'bytes': snap.length_bytes}
+    samples = _time_calls(snap.read, repeats)
+    report.add('snapshot/read', samples, params,
+               per_s=repeats / sum(samples))
+    rawdata = snap.read_raw()[0]['data']
+    samples = _time_calls(lambda: snap._process_data(rawdata), repeats)
+    report.add('snapshot/decode', samples, params,
+               per_s=repeats / sum(samples),
+               mb_per_s=snap.length_bytes * repeats / sum(samples) / 1e6)
+
+
+def bench_fleet_sweep(report, fpgas, registers, counts=None, repeats=10):
+    """
+    Time to read the same registers from every board, against the number
+    of boards.
+    """
+    if counts is None:
+        counts = _powers_of_two(1, len(fpgas))
+        if counts[-1] != len(fpgas):
+            counts.append(len(fpgas))
+    for count in counts:
+        fleet = FpgaFleet(fpgas[0:count])
+        samples = _time_calls(lambda: fleet.read_registers(registers),
+                              repeats)
+        report.add('fleet_sweep/%i' % count, samples,
+                   {'boards': count, 'registers': len(registers)},
+                   per_s=repeats / sum(samples))
+
+
+def bench_design_load(report, sizes=DESIGN_SIZES, repeats=3):
+    """
+    Time to parse an fpg, and to build a CasperFpga's devices from it,
+    against the number of registers in the design.
+    """
+    workdir = tempfile.mkdtemp(prefix='casperfpga_bench_')
+    try:
+        for size in sizes:
+            fpg = make_test_fpg(os.path.join(workdir, 'design%i.fpg' % size),
+                                num_registers=size)
+            params = {'registers': size}
+            samples = _time_calls(lambda: parse_fpg(fpg), repeats)
+            report.add('design_load/parse/%i' % size, samples, params)
+            fpga = CasperFpga('bench_dummy', transport=DummyTransport)
+            samples = _time_calls(
+                lambda: fpga.get_system_information(fpg), repeats)
+            report.add('design_load/system_info/%i' % size, samples,
+                       params)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_programming(report, fpga, fpg, repeats=1):
+    """
+    Time to program a board with an fpg.
+    """
+    samples = _time_calls(lambda: fpga.upload_to_ram_and_program(fpg),
+                          repeats)
+    report.add('programming/%s' % type(fpga.transport).__name__, samples,
+               {'fpg': os.path.basename(fpg)})
+
+
+def run_matrix(fpgas, report=None, benchmarks=BENCHMARKS, quick=False,
+               register='sys_scratchpad', device=None, snapshot=None,
+               fleet_registers=None, fpg=None, writes=True):
+    """
+    Run the benchmark matrix against a set of boards. Single-board
+    benchmarks use the first board.
+
+    :param fpgas: a list of CasperFpga objects, with their system
+        information already loaded
+    :param report: the BenchmarkReport to add to, a new one if None
+    :param benchmarks: the names of the benchmarks to run
+    :param quick: fewer repeats, for a smoke test
+    :param register: the register for the latency benchmark
+    :param device: the memory device for the throughput benchmark,
+        skipped if None
+    :param snapshot: the snapshot for the snapshot benchmark, skipped if
+        None
+    :param fleet_registers: the registers read in the fleet sweep,
+        defaults to [register]
+    :param fpg: the design to program in the programming benchmark,
+        skipped if None
+    :param writes: run the write benchmarks too
+    :return: the BenchmarkReport
+    """
+    if report is None:
+        report = BenchmarkReport(', '.join(fpga.host for fpga in fpgas))
+    scale = 10 if quick else 1
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark %s' % name)
+        LOGGER.info('Running benchmark %s' % name)
+        if name == 'register_latency':
+            bench_register_latency(report, fpgas[0], register,
+                                   repeats=500 // scale, writes=writes)
+        elif name == 'bulk_throughput':
+            if device is None:
+                LOGGER.info('No device given, skipping %s' % name)
+                continue
+            bench_bulk_throughput(report, fpgas[0], device,
+                                  repeats=max(2, 10 // scale), writes=writes)
+        elif name == 'snapshot':
+            if snapshot is None:
+                LOGGER.info('No snapshot given, skipping %s' % name)
+                continue
+            bench_snapshot(report, fpgas[0], snapshot,
+                           repeats=max(2, 10 // scale))
+        elif name == 'fleet_sweep':
+            bench_fleet_sweep(report, fpgas, fleet_registers or [register],
+                              repeats=max(2, 20 // scale))
+        elif name == 'design_load':
+            bench_design_load(report, DESIGN_SIZES[0:2] if quick
+                              else DESIGN_SIZES,
+                              repeats=1 if quick else 3)
+        elif name == 'programming':
+            if fpg is None:
+                LOGGER.info('No fpg given, skipping %s' % name)
+                continue
+            bench_programming(report, fpgas[0], fpg)
+    return report
+
+
+def run_standin_matrix(kind='dummy', count=4, latency=0.0, report=None,
+                       benchmarks=BENCHMARKS, quick=False, **kwargs):
+    """
+    Run the benchmark matrix against local stand-in boards running a
+    synthetic design.
+
+    :param kind: dummy, katcp, skarab or tapcp
+    :param count: how many boards, for the fleet sweep
+    :param latency: seconds added to every request or packet
+    :param report: the BenchmarkReport to add to, a new one if None
+    :param benchmarks: the names of the benchmarks to run
+    :param quick: fewer repeats, for a smoke test
+    :param kwargs: passed on to the stand-ins
+    :return: the BenchmarkReport
+    """
+    if report is None:
+        report = BenchmarkReport('%s stand-in' % kind,
+                                 meta={'boards': count, 'latency': latency})
+    workdir = tempfile.mkdtemp(prefix='casperfpga_bench_')
+    try:
+        fpg = make_test_fpg(os.path.join(workdir, 'bench.fpg'),
+                            num_registers=64)
+        with StandIns(kind, fpg, count, latency, **kwargs) as standins:
+            # SKARAB uploads go through progska, which only talks to the
+            # standard control port, so the emulator cannot be programmed
+            run_matrix(standins.fpgas, report, benchmarks, quick,
+                       device=BENCH_BRAM, snapshot=BENCH_SNAPSHOT,
+                       fleet_registers=[BENCH_REGISTER % ctr
+                                        for ctr in range(16)],
+                       fpg=None if kind == 'skarab' else fpg)
+    finally:
+        shutil.rmtree(workdir)
+    return report
+
+# end
@@ -1,6 +1,7 @@
 from wishbonedevice import WishBoneDevice
 import numpy as np
 import struct,math
+import time
 import logging
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
@@ -29,6 +30,10 @@ class Bitsnap(object):
         while bs.status()['DONE']==False:
             pass
         bs.read(nsample=512)
+
+        or, to let the block do the polling and decoding:
+        data=bs.acquire(n_triggers=16,nsample=512,dtype=np.int16)
+        power=bs.acquire(n_triggers=1000,dtype=np.int16,reduce='power')
     """
 
     ctrl = None
@@ -38,6 +43,11 @@ class Bitsnap(object):
     bitwidth = None
     adrwidth = None
 
+    # seconds between status polls while waiting for a capture, doubling
+    # from POLL_MIN up to POLL_MAX
+    POLL_MIN = 0.0005
+    POLL_MAX = 0.05
+
     def __init__(self, interface, block_name, bitwidth=64, adrwidth=10, ignore_trig=False, ignore_we=True, **kwargs):
         if bitwidth not in [8,16,32,64,128]:
             raise ValueError('Invalid parameter bitwidth.')
@@ -74,14 +84,20 @@ class Bitsnap(object):
         self.ctrl._write(cmd|0x1)
         self.ctrl._write(cmd)
 
-    def read(self, nsample=None, nskip=0):
+    def read(self, nsample=None, nskip=0, dtype=None):
         """ Read samples and return raw data
 
             nsample number of samples to read
             nskip   read skips the first nskip samples
+            dtype   numpy type of a sample. If given, the samples are
+                    decoded from the big-endian bus data into a numpy
+                    array instead of being returned as a raw string. If
+                    the type is narrower than bitwidth each sample becomes
+                    a row of bitwidth/itemsize values.
 
             E.g.
             mybs.read(nsample=512,nskip=128)
+            mybs.read(nsample=512,dtype=np.int16)
         """
 
         if isinstance(nsample,int):
@@ -91,7 +107,151 @@ class Bitsnap(object):
         length = nsample * self.bitwidth/8
         skipaddr = nskip * self.bitwidth/8
 
-        return self.bram._read(addr=skipaddr,size=length)
+        if dtype is None:
+            return self.bram._read(addr=skipaddr,size=length)
+        raw = self.bram.itf.read(self.bram.name, length, offset=skipaddr)
+        return self._decode(raw, nsample, dtype)
+
+    def _sample_shape(self, nsample, dtype):
+        dtype = np.dtype(dtype)
+        sample_bytes = self.bitwidth/8
+        if sample_bytes % dtype.itemsize != 0:
+            raise ValueError('A %d-bit sample cannot be split into %s '
+                             'values.' % (self.bitwidth, dtype))
+        per_sample = sample_bytes / dtype.itemsize
+        if per_sample == 1:
+            return (nsample,)
+        return (nsample, per_sample)
+
+    def _decode(self, raw, nsample, dtype, out=None):
+        shape = self._sample_shape(nsample, dtype)
+        data = np.frombuffer(raw, dtype=np.dtype(dtype).newbyteorder('>'))
+        data = data.reshape(shape)
+        if out is None:
+            return data.astype(dtype)
+        out[...] = data
+        return out
+
+    def _wait_done(self, timeout):
+        start_time = time.time()
+        poll_time = self.POLL_MIN
+        while True:
+            s = self.status()
+            if s['DONE']:
+                return s
+            elapsed = time.time() - start_time
+            if (timeout >= 0) and (elapsed > timeout):
+                raise RuntimeError('Bitsnap %s did not finish capturing '
+                                   'within %.2f seconds.' % (self.bram.name,
+                                                             timeout))
+            # back off between polls, so a slow capture doesn't keep the
+            # transport busy, but never sleep past the timeout
+            if timeout >= 0:
+                time.sleep(max(0, min(poll_time, timeout - elapsed)))
+            else:
+                time.sleep(poll_time)
+            poll_time = min(poll_time * 2, self.POLL_MAX)
+
+    def acquire(self, n_triggers=1, nsample=None, dtype=None, nskip=0,
+                reduce=None, bins=None, timeout=1.0):
+        """ Trigger, wait for and read the block n_triggers times
+
+            n_triggers  number of captures to take
+            nsample     number of samples to read from each capture
+            dtype       numpy type of a sample, see read(). Defaults to an
+                        unsigned integer as wide as bitwidth.
+            nskip       skip the first nskip samples of each capture
+            reduce      None to return every capture, or reduce the
+                        captures on the fly so memory use stays constant:
+                        'mean'      mean of each sample over the captures
+                        'power'     mean of the squared magnitude of each
+                                    sample over the captures
+                        'histogram' histogram of all the sample values
+            bins        bin edges (or a number of bins, over the range of
+                        dtype) for reduce='histogram'. Integer types of up
+                        to 16 bits default to one bin per value.
+            timeout     seconds to wait for each capture, negative waits
+                        forever
+
+            acquire() returns a (n_triggers, nsample) array when reduce is
+            None, a (nsample,) float array for 'mean' and 'power', and a
+            (counts, bin_edges) tuple for 'histogram'. When dtype is
+            narrower than a sample, each sample holds per_sample =
+            bitwidth/8/dtype.itemsize values and those shapes become
+            (n_triggers, nsample, per_sample) and (nsample, per_sample).
+
+            E.g.
+            avg=mybs.acquire(n_triggers=100,nsample=512,dtype=np.int16,
+                             reduce='mean')
+        """
+
+        if reduce not in [None, 'mean', 'power', 'histogram']:
+            raise ValueError('Invalid parameter reduce.')
+        if n_triggers < 1:
+            raise ValueError('Invalid parameter n_triggers.')
+        if not isinstance(nsample,int):
+            nsample = (1<<self.adrwidth) - nskip
+        if dtype is None:
+            if self.bitwidth > 64:
+                raise ValueError('A dtype is needed for %d-bit '
+                                 'samples.' % self.bitwidth)
+            dtype = np.dtype('u%d' % (self.bitwidth/8))
+        dtype = np.dtype(dtype)
+        shape = self._sample_shape(nsample, dtype)
+        length = nsample * self.bitwidth/8
+        skipaddr = nskip * self.bitwidth/8
+
+        if reduce is None:
+            result = np.empty((n_triggers,) + shape, dtype=dtype)
+        elif reduce == 'histogram':
+            if bins is None:
+                if dtype.kind not in 'iu' or dtype.itemsize > 2:
+                    raise ValueError('Please give bins for a histogram of '
+                                     '%s samples.' % dtype)
+                info = np.iinfo(dtype)
+                bins = np.arange(info.min, info.max + 2) - 0.5
+            elif isinstance(bins, int):
+                if dtype.kind not in 'iu':
+                    raise ValueError('Please give bin edges for a '
+                                     'histogram of %s samples.' % dtype)
+                info = np.iinfo(dtype)
+                bins = np.linspace(info.min, info.max + 1, bins + 1)
+            bins = np.asarray(bins)
+            result = np.zeros(len(bins) - 1, dtype=np.int64)
+        elif (reduce == 'mean') and (dtype.kind == 'c'):
+            result = np.zeros(shape, dtype=np.complex128)
+        else:
+            result = np.zeros(shape, dtype=np.float64)
+        buf = np.empty(shape, dtype=dtype)
+
+        # the control register is left at cmd after a trigger, so only the
+        # rising edge needs to be written for every capture after the first
+        cmd = (self.ignore_we << 2) + (self.ignore_trig << 1) + 0
+        self.ctrl._write(cmd)
+        for n in range(n_triggers):
+            self.ctrl._write(cmd|0x1)
+            self.ctrl._write(cmd)
+            self._wait_done(timeout)
+            raw = self.bram.itf.read(self.bram.name, length, offset=skipaddr)
+            if reduce is None:
+                self._decode(raw, nsample, dtype, out=result[n])
+                continue
+            self._decode(raw, nsample, dtype, out=buf)
+            if reduce == 'mean':
+                result += buf
+            elif reduce == 'power':
+                if dtype.kind == 'c':
+                    result += np.abs(buf) ** 2
+                else:
+                    result += buf.astype(np.float64) ** 2
+            else:
+                result += np.histogram(buf, bins=bins)[0]
+
+        if reduce in ['mean', 'power']:
+            result /= n_triggers
+        elif reduce == 'histogram':
+            return result, bins
+        return result
 
     def status(self):
         """ Status of the bitsnap module
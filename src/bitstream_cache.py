@@ -0,0 +1,205 @@
+"""
+A content-addressed, on-disk cache of the .bin files programmed onto
+SKARABs, so that the same .fpg is not read, decompressed and written out
+again every time it is programmed.
+
+Entries are keyed on a hash of the source image and the processor that
+made them, and the least recently used are evicted once the cache grows
+beyond its size limit. The cache lives in ~/.casperfpga/bin_cache by
+default. Set the CASPERFPGA_BIN_CACHE environment variable to use a
+different directory, or to an empty string to switch the cache off.
+"""
+
+import os
+import logging
+import hashlib
+import tempfile
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.casperfpga',
+                                 'bin_cache')
+
+# evict least recently used entries beyond this many bytes
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# bump this when the processors change what they produce, so that older
+# entries are no longer used
+FORMAT_VERSION = 1
+
+# how much of the source image to hash at a time
+_HASH_CHUNK = 1024 * 1024
+
+
+class BitstreamCache(object):
+    """
+    Processed bitstreams on disk, keyed on the content of their source
+    image and the processor used.
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        """
+
+        :param directory: where to keep the .bin files, defaults to the
+            CASPERFPGA_BIN_CACHE environment variable or DEFAULT_CACHE_DIR.
+            An empty string disables the cache.
+        :param max_bytes: the size the cache is trimmed to when an entry
+            is added
+        """
+        if directory is None:
+            directory = os.environ.get('CASPERFPGA_BIN_CACHE',
+                                       DEFAULT_CACHE_DIR)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # (path, size, mtime) -> digest, so a file is hashed once per process
+        self._digests = {}
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def digest(self, image_file):
+        """
+        Get the SHA-256 of a file's contents.
+
+        :param image_file: the file to hash
+        :return: the hex digest
+        """
+        stat = os.stat(image_file)
+        memo_key = (os.path.realpath(image_file), stat.st_size,
+                    stat.st_mtime)
+        with self._lock:
+            digest = self._digests.get(memo_key)
+        if digest is not None:
+            return digest
+        sha = hashlib.sha256()
+        with open(image_file, 'rb') as fptr:
+            while True:
+                chunk = fptr.read(_HASH_CHUNK)
+                if not chunk:
+                    break
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._digests[memo_key] = digest
+        return digest
+
+    def entry_name(self, image_file, processor):
+        """
+        The cache file for an image processed by a processor.
+
+        :param image_file: the source .fpg, .bit, .hex or .bin
+        :param processor: the skarab_fileops.ImageProcessor class
+        """
+        return os.path.join(self.directory, '%s.%s.v%i.bin' % (
+            self.digest(image_file), processor.__name__.lower(),
+            FORMAT_VERSION))
+
+    def get_bin(self, image_file, processor):
+        """
+        Get the processed .bin of an image, making and caching it if need
+        be. The file must not be modified or removed by the caller.
+
+        :param image_file: the source .fpg, .bit, .hex or .bin
+        :param processor: the skarab_fileops.ImageProcessor class to use
+        :return: the name of the .bin file in the cache
+        """
+        if not self.enabled:
+            raise RuntimeError('The bitstream cache is disabled')
+        bin_name = self.entry_name(image_file, processor)
+        try:
+            # mark it recently used
+            os.utime(bin_name, None)
+            LOGGER.debug('Using cached bitstream %s for %s' % (
+                bin_name, image_file))
+            return bin_name
+        except OSError:
+            pass
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # made by another process in the meantime?
+                if not os.path.isdir(self.directory):
+                    raise
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix='.bin')
+        os.close(fd)
+        try:
+            processor(image_file, tmpname).make_bin_file()
+            os.rename(tmpname, bin_name)
+        except Exception:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        LOGGER.debug('Cached bitstream %s for %s' % (bin_name, image_file))
+        self.evict(keep=bin_name)
+        return bin_name
+
+    def entries(self):
+        """
+        Get the cached .bin files, least recently used first.
+
+        :return: a list of (name, size in bytes, time last used)
+        """
+        if not self.enabled or not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.bin') or filename.startswith('.'):
+                continue
+            filename = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((filename, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache is no
+        larger than max_bytes.
+
+        :param keep: an entry never to remove, e.g. one just added
+        """
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        for filename, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if filename == keep:
+                continue
+            try:
+                os.remove(filename)
+                total -= size
+                LOGGER.debug('Evicted cached bitstream %s' % filename)
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Remove every cached .bin file.
+        """
+        for filename, _, _ in self.entries():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+_bitstream_cache = None
+_bitstream_cache_lock = threading.Lock()
+
+
+def get_bitstream_cache():
+    """
+    Get the process-wide BitstreamCache, creating it on first use.
+    """
+    global _bitstream_cache
+    with _bitstream_cache_lock:
+        if _bitstream_cache is None:
+            _bitstream_cache = BitstreamCache()
+        return _bitstream_cache
+
+# end
@@ -15,6 +15,7 @@ import qdr
 import hmc
 import katadc
 import skarabadc
+import tracing
 
 from attribute_container import AttributeContainer
 from utils import parse_fpg, get_hostname, get_kwarg, get_git_info_from_fpg
@@ -22,6 +23,8 @@ from transport_katcp import KatcpTransport
 from transport_tapcp import TapcpTransport
 from transport_skarab import SkarabTransport
 from transport_dummy import DummyTransport
+from transport_cache import get_transport_cache
+from transport_detect import detect_transport
 
 from CasperLogHandlers import configure_console_logging, configure_file_logging
 from CasperLogHandlers import getLogger
@@ -68,6 +71,15 @@ CASPER_OTHER_DEVICES = {
     'xps:xsg':                      'xps',
 }
 
+# transports that choose_transport can detect, by class name, for the
+# on-disk transport cache
+KNOWN_TRANSPORTS = {
+    'SkarabTransport':  SkarabTransport,
+    'KatcpTransport':   KatcpTransport,
+    'TapcpTransport':   TapcpTransport,
+}
+
+
 class UnknownTransportError(Exception):
     pass
 
@@ -110,6 +122,9 @@ class CasperFpga(object):
         # some transports, e.g. Skarab, need to know their parent
         kwargs['parent_fpga'] = self
 
+        # callables passed a TraceEvent for every read and write
+        self.trace_hooks = []
+
         # Setup logger to be propagated through transports
         # either set log level manually or default to error
         try:
@@ -122,8 +137,7 @@ class CasperFpga(object):
         if transport:
             self.transport = transport(**kwargs)
         else:
-            transport_class = self.choose_transport(self.host)
-            self.transport = transport_class(**kwargs)
+            self.transport = self._create_transport(**kwargs)
 
         # this is just for code introspection
         self.devices = None
@@ -152,27 +166,58 @@ class CasperFpga(object):
         except:
             pass
 
-        
-    def choose_transport(self, host_ip):
-        """
-        Test whether a given host is a katcp client or a skarab
+
+    def _create_transport(self, **kwargs):
+        """
+        Create the transport for this host. A transport type found in the
+        on-disk transport cache is tried first, without probing the host. If
+        that fails the cache entry is dropped and the host is probed.
+
+        :param kwargs: passed on to the transport. transport_cache=False
+            skips the cache.
+        """
+        use_cache = get_kwarg('transport_cache', kwargs, True)
+        if use_cache and not self.host.startswith('CasperDummy'):
+            cache = get_transport_cache()
+            transport_class = KNOWN_TRANSPORTS.get(cache.get(self.host))
+            if transport_class is not None:
+                self.logger.debug('%s is a cached %s' % (
+                    self.host, transport_class.__name__))
+                transport = None
+                try:
+                    transport = transport_class(**kwargs)
+                    if transport.is_connected():
+                        return transport
+                except Exception as exc:
+                    self.logger.debug('%s: cached %s failed: %s' % (
+                        self.host, transport_class.__name__, exc))
+                if transport is not None:
+                    try:
+                        transport.disconnect()
+                    except Exception:
+                        pass
+                self.logger.info('%s: cached transport type is stale, '
+                                 'probing the host' % self.host)
+                cache.invalidate(self.host)
+        transport_class = self.choose_transport(self.host,
+                                                use_cache=use_cache)
+        return transport_class(**kwargs)
+
+    def choose_transport(self, host_ip, use_cache=True):
+        """
+        Test whether a given host is a SKARAB, katcp or TAPCP board. The
+        probes for all three are raced against each other, see
+        transport_detect.
 
         :param host_ip:
+        :param use_cache: store the result in the on-disk transport cache
         """
         self.logger.debug('Trying to figure out what kind of device %s is' % host_ip)
         if host_ip.startswith('CasperDummy'):
             return DummyTransport
         try:
-            if SkarabTransport.test_host_type(host_ip):
-                self.logger.debug('%s seems to be a SKARAB' % host_ip)
-                return SkarabTransport
-            elif KatcpTransport.test_host_type(host_ip):
-                self.logger.debug('%s seems to be ROACH' % host_ip)
-                return KatcpTransport
-            elif TapcpTransport.test_host_type(host_ip):
-                self.logger.debug('%s seems to be a TapcpTransport' % host_ip)
-                return TapcpTransport
-            else:
+            transport_class = detect_transport(host_ip, use_cache=use_cache)
+            if transport_class is None:
                 errmsg = 'Possible that host does not follow one of the \
                             defined casperfpga transport protocols'
                 raise UnknownTransportError(errmsg)
@@ -181,6 +226,9 @@ class CasperFpga(object):
                                'the OS?' % host_ip)
         except Exception as e:
             raise RuntimeError('Could not connect to host %s: %s' % (host_ip, e.message))
+        self.logger.debug('%s seems to be a %s' % (host_ip,
+                                                   transport_class.__name__))
+        return transport_class
 
     def connect(self, timeout=None):
         """
@@ -196,6 +244,23 @@ class CasperFpga(object):
         """
         return self.transport.disconnect()
 
+    def stats(self, reset=False):
+        """
+        Get the request, packet and latency counters of this board's
+        transport.
+
+        :param reset: clear the counters after reading them
+        :return: a dictionary of counters, see TransportStats.to_dict
+        """
+        return self.transport.stats(reset)
+
+    def reset_stats(self):
+        """
+        Clear the request, packet and latency counters of this board's
+        transport.
+        """
+        self.transport.reset_stats()
+
     # def pdebug(self, message, *args, **kwargs):
     #     if self.isEnabledFor(PDEBUG):
     #         self.log(PDEBUG, message, *args, **kwargs)
@@ -225,6 +290,31 @@ class CasperFpga(object):
         self.logger.info(infomsg)
         return True
 
+    def add_trace_hook(self, hook, transport=True):
+        """
+        Call hook with a tracing.TraceEvent for every read and write made
+        through this CasperFpga.
+
+        :param hook: a callable taking a TraceEvent, e.g. a
+            tracing.TraceRecorder
+        :param transport: also pass the hook the requests the transport
+            sends
+        """
+        self.trace_hooks.append(hook)
+        if transport:
+            self.transport.trace_hooks.append(hook)
+
+    def remove_trace_hook(self, hook):
+        """
+        Stop calling a trace hook.
+
+        :param hook: a hook added with add_trace_hook
+        """
+        if hook in self.trace_hooks:
+            self.trace_hooks.remove(hook)
+        if hook in self.transport.trace_hooks:
+            self.transport.trace_hooks.remove(hook)
+
     def read(self, device_name, size, offset=0, **kwargs):
         """
         Read size-bytes of binary data with carriage-return escape-sequenced.
@@ -234,6 +324,16 @@ class CasperFpga(object):
         :param offset: start at this offset, offset in bytes
         :param kwargs:
         """
+        if self.trace_hooks:
+            address = tracing.device_address(self.memory_devices,
+                                             device_name, offset)
+            return tracing.traced_call(
+                self.trace_hooks, tracing.LAYER_FPGA, 'read', self.host,
+                device_name, address, size, None,
+                self._read, device_name, size, offset, **kwargs)
+        return self._read(device_name, size, offset, **kwargs)
+
+    def _read(self, device_name, size, offset=0, **kwargs):
         data = self.transport.read(device_name, size, offset, **kwargs)
         if self.is_little_endian:
             assert ((len(data) % 4) == 0), \
@@ -245,7 +345,70 @@ class CasperFpga(object):
             return data_byte_swapped
         return data
 
+    def read_many(self, reads):
+        """
+        Read from several memory devices in one go, letting the transport
+        batch or coalesce the reads where it can.
+
+        :param reads: a list of (device_name, size, offset) tuples, offsets
+            in bytes
+        :return: a list of binary data strings, one per read
+        """
+        if self.trace_hooks:
+            return self._traced_read_many(reads)
+        return self._read_many(reads)
+
+    def _traced_read_many(self, reads):
+        """
+        read_many, passing the trace hooks an event for each read. The
+        time taken is shared equally between them.
+        """
+        site = tracing.call_site()
+        start = time.time()
+        try:
+            data = self._read_many(reads)
+        except Exception:
+            data = [None] * len(reads)
+            raise
+        finally:
+            duration = (time.time() - start) / max(len(reads), 1)
+            for (device_name, size, offset), item in zip(reads, data):
+                address = tracing.device_address(self.memory_devices,
+                                                 device_name, offset)
+                tracing.emit(self.trace_hooks, tracing.TraceEvent(
+                    tracing.LAYER_FPGA, 'read_many', self.host, device_name,
+                    address, size, start, duration, item is not None,
+                    tracing.crc(item), site))
+        return data
+
+    def _read_many(self, reads):
+        data = self.transport.read_many(reads)
+        if self.is_little_endian:
+            for ctr, item in enumerate(data):
+                assert ((len(item) % 4) == 0), \
+                    "Can only read multiples of 4 bytes because CasperFpga is doing an endianness flip"
+                data[ctr] = ''.join(item[i:i+4][::-1]
+                                    for i in range(0, len(item), 4))
+        return data
+
     def blindwrite(self, device_name, data, offset=0, **kwargs):
+        """
+        Unchecked data write.
+
+        :param device_name: the memory device to which to write
+        :param data: the byte string to write
+        :param offset: the offset, in bytes, at which to write
+        """
+        if self.trace_hooks:
+            address = tracing.device_address(self.memory_devices,
+                                             device_name, offset)
+            return tracing.traced_call(
+                self.trace_hooks, tracing.LAYER_FPGA, 'blindwrite',
+                self.host, device_name, address, len(data), data,
+                self._blindwrite, device_name, data, offset, **kwargs)
+        return self._blindwrite(device_name, data, offset, **kwargs)
+
+    def _blindwrite(self, device_name, data, offset=0, **kwargs):
         if self.is_little_endian:
             assert ((len(data) % 4) == 0), \
                 "Can only write multiples of 4 bytes because CasperFpga is doing an endianness flip"
@@ -397,10 +560,20 @@ class CasperFpga(object):
 
     def dram_bulkread(self, device, size, offset):
         """
+        Read from a DRAM memory device with the transport's bulk read.
 
-        :return:
+        :param device: the name of the DRAM memory device
+        :param size: amount of data to read, in bytes
+        :param offset: offset at which to read, in bytes
+        :return: binary data string
         """
-        raise NotImplementedError
+        try:
+            bulkread = self.transport.bulkread
+        except AttributeError:
+            raise NotImplementedError('%s: %s does not support bulk '
+                                      'reads' % (self.host,
+                                                 type(self.transport).__name__))
+        return bulkread(device, size, offset)
 
     def read_dram(self, size, offset=0):
         """
@@ -430,8 +603,8 @@ class CasperFpga(object):
             # local_reads = min(read_chunk_size, size - n_reads,
             #                   dram_indirect_page_size -
             #                   (offset % dram_indirect_page_size))
-            local_reads = min(size - n_reads, dram_indirect_page_size -
-                              (offset % dram_indirect_page_size))
+            local_reads = min(size - n_reads,
+                              dram_indirect_page_size - local_offset)
             if last_dram_page != dram_page:
                 self.write_int('dram_controller', dram_page)
                 last_dram_page = dram_page
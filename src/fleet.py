@@ -0,0 +1,140 @@
+"""
+Operate on a whole set of CasperFpga boards at once.
+"""
+
+import logging
+
+import numpy as np
+
+import utils
+from transport_stats import TransportStats
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FpgaFleet(object):
+    """
+    A fleet of CasperFpga objects that are monitored and controlled together.
+    """
+    def __init__(self, fpgas, timeout=5.0):
+        """
+
+        :param fpgas: a list of CasperFpga objects
+        :param timeout: how long a board may take to answer a sweep, in
+            seconds
+        """
+        self.fpgas = list(fpgas)
+        self.timeout = timeout
+
+    @classmethod
+    def from_hosts(cls, host_list, timeout=5.0, **kwargs):
+        """
+        Make a fleet by creating a CasperFpga for each host.
+
+        :param host_list: a list of hostnames
+        :param timeout: the sweep timeout for the new fleet, in seconds
+        :param kwargs: passed on to threaded_create_fpgas_from_hosts
+        """
+        return cls(utils.threaded_create_fpgas_from_hosts(host_list,
+                                                          **kwargs),
+                   timeout=timeout)
+
+    @property
+    def hosts(self):
+        return [fpga.host for fpga in self.fpgas]
+
+    def __len__(self):
+        return len(self.fpgas)
+
+    def __iter__(self):
+        return iter(self.fpgas)
+
+    def __getitem__(self, item):
+        return self.fpgas[item]
+
+    @staticmethod
+    def _sweep_registers(fpga, names):
+        """
+        Read all the named 32-bit registers on one board with a single
+        read_many call, so the transport can coalesce the reads.
+
+        :return: a list with the raw data for each name, None for names
+            this board does not have
+        """
+        present = [name for name in names if name in fpga.memory_devices]
+        data = dict(zip(present, fpga.read_many(
+            [(name, 4, 0) for name in present])))
+        return [data.get(name) for name in names]
+
+    def read_registers(self, names, dtype=np.uint32, timeout=None):
+        """
+        Read the same 32-bit registers from every board in the fleet, in one
+        concurrent sweep with a single batched read per board.
+
+        :param names: a list of register names
+        :param dtype: the numpy type to give the register values
+        :param timeout: how long a board may take, defaults to the fleet
+            timeout
+        :return: a tuple of (data, failed) arrays, both of shape
+            (n_boards, n_registers), in fleet and name order. failed is
+            True where a board did not answer or does not have the register,
+            and the matching entries in data are zero.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        wire_type = np.dtype(dtype).newbyteorder('>')
+        if wire_type.itemsize != 4:
+            raise ValueError('Registers are 32 bits wide, cannot read them '
+                             'as %s.' % np.dtype(dtype))
+        names = list(names)
+        num_regs = len(names)
+        raw_data = bytearray(len(self.fpgas) * num_regs * 4)
+        failed = np.ones((len(self.fpgas), num_regs), dtype=bool)
+        rows = {}
+        for ctr, fpga in enumerate(self.fpgas):
+            rows.setdefault(fpga.host, []).append(ctr)
+        for host, result in utils.iter_fpga_operation(
+                self.fpgas, timeout,
+                (self._sweep_registers, (names,), {}), num_retries=1):
+            for col, raw in enumerate(result):
+                if raw is None:
+                    continue
+                for row in rows[host]:
+                    pos = ((row * num_regs) + col) * 4
+                    raw_data[pos:pos + 4] = raw
+                    failed[row, col] = False
+        data = np.frombuffer(bytes(raw_data), dtype=wire_type)
+        data = data.reshape(failed.shape).astype(dtype)
+        return data, failed
+
+    def stats(self, reset=False):
+        """
+        Get the transport counters of every board, and their sum.
+
+        :param reset: clear the counters after reading them
+        :return: a dictionary with the summed counters under 'total' and
+            each board's under 'hosts', keyed on hostname
+        """
+        metrics = [fpga.transport.metrics for fpga in self.fpgas]
+        stats = {'total': TransportStats.merged(metrics).to_dict(),
+                 'hosts': dict((fpga.host, fpga.transport.stats(reset))
+                               for fpga in self.fpgas)}
+        return stats
+
+    def run(self, target_function, timeout=None):
+        """
+        Run a CasperFpga method, or a function taking a CasperFpga as its
+        first argument, on every board. See utils.threaded_fpga_function.
+
+        :return: a dictionary of results, keyed on hostname
+        """
+        if timeout is None:
+            timeout = self.timeout
+        target_function = utils._check_target_func(target_function)
+        if isinstance(target_function[0], basestring):
+            return utils.threaded_fpga_function(self.fpgas, timeout,
+                                                target_function)
+        return utils.threaded_fpga_operation(self.fpgas, timeout,
+                                             target_function)
+
+# end
@@ -1,5 +1,6 @@
 import logging
 import time
+import numpy as np
 
 from network import IpAddress, Mac
 from gbe import Gbe
@@ -284,8 +285,7 @@ class FortyGbe(Gbe):
         elif (group_size==0):
             mask = "255.255.255.255"
         else:
-            import numpy
-            if ((numpy.log2(group_size+1)%1)!=0):
+            if ((np.log2(group_size+1)%1)!=0):
                 raise RuntimeError("You tried to subscribe to {}+{}. Must subscribe to a binary multiple of addresses.".format(ip_str,group_size))
             if ((group_size+1)>256):
                 raise RuntimeError("You tried to subscribe to {}+{}. Can't subscribe to more than 256 addresses.".format(ip_str,group_size))
@@ -429,41 +429,81 @@ class FortyGbe(Gbe):
 
     @staticmethod
     def convert_128_to_64(w128):
-        return [(w128 >> (64-(ctr*64))) & (2 ** 64 - 1) for ctr in range(2)]
+        """
+        Split 128-bit words into two 64-bit lanes, most significant first.
+
+        :param w128: a single 128-bit integer, a sequence of them, or an
+            (N, 2) uint64 lane array as returned by
+            Memory._process_data_array
+        :return: a two-item list for a single integer, otherwise an (N, 2)
+            uint64 array
+        """
+        if isinstance(w128, (int, long)):
+            return [(w128 >> (64-(ctr*64))) & (2 ** 64 - 1)
+                    for ctr in range(2)]
+        if isinstance(w128, np.ndarray) and (w128.ndim == 2):
+            return w128.astype(np.uint64)
+        w128 = np.array(w128, dtype=object)
+        lanes = np.empty((len(w128), 2), dtype=np.uint64)
+        lanes[:, 0] = (w128 >> 64).astype(np.uint64)
+        lanes[:, 1] = (w128 & (2 ** 64 - 1)).astype(np.uint64)
+        return lanes
 
     @staticmethod
     def process_snap_data(d):
-        # convert the 256-bit data to 64-bit data
-        d64 = {k: [] for k in d.keys()}
-        d64['data'] = []
-        for ctr in range(len(d['data_msw'])):
-            d64['data'].extend(FortyGbe.convert_128_to_64(d['data_msw'][ctr]))
-            d64['data'].extend(FortyGbe.convert_128_to_64(d['data_lsw'][ctr]))
-            for k in d.keys():
-                if k == 'eof':
-                    d64[k].extend([0] * 3)
-                    d64[k].append(d[k][ctr])
-                elif ((k!='data_msw') and (k!='data_lsw') and (k!='data')):
-                    for ctr4 in range(4):
-                        d64[k].append(d[k][ctr])
+        """
+        Convert the 256-bit snapshot data to 64-bit words. Each 256-bit
+        sample becomes four 64-bit words, the eof flag is placed on the last
+        of the four and all other keys are repeated four times.
+
+        :param d: dictionary of snapshot data, with the 256-bit data split
+            into data_msw and data_lsw
+        :return: dictionary of equal-length arrays, with the 64-bit words
+            in 'data'
+        """
+        msw = FortyGbe.convert_128_to_64(d['data_msw'])
+        lsw = FortyGbe.convert_128_to_64(d['data_lsw'])
+        nsamples = len(msw)
+        d64 = {'data': np.hstack((msw, lsw)).reshape(-1)}
+        for k in d.keys():
+            if k in ['data_msw', 'data_lsw', 'data']:
+                continue
+            values = np.asarray(d[k])
+            if k == 'eof':
+                eof = np.zeros((nsamples, 4), dtype=values.dtype)
+                eof[:, 3] = values
+                d64[k] = eof.reshape(-1)
+            else:
+                d64[k] = np.repeat(values, 4)
         return d64
 
+    def _read_snaps(self, direction):
+        """
+        Read the raw snapshots for one direction and unpack their fields
+        into arrays.
+
+        :param direction: 'tx' or 'rx'
+        """
+        d = {}
+        for ctr, snap in enumerate(self.snaps[direction]):
+            if ctr == 0:
+                rawdata, _ = snap.read_raw()
+            else:
+                rawdata, _ = snap.read_raw(arm=False)
+            d.update(snap._process_data_array(rawdata['data']))
+        return d
+
     def read_txsnap(self):
         """
         Read the TX snapshot embedded in this GbE yellow block
         """
-        d = self.snaps['tx'][0].read()['data']
-        for snap in self.snaps['tx'][1:]:
-            d.update(snap.read(arm=False)['data'])
-        return FortyGbe.process_snap_data(d)
+        return FortyGbe.process_snap_data(self._read_snaps('tx'))
 
     def read_rxsnap(self):
         """
         Read the RX snapshot embedded in this GbE yellow block
         """
-        d = self.snaps['rx'][0].read()['data']
-        for snap in self.snaps['rx'][1:]:
-            d.update(snap.read(arm=False)['data'])
+        d = self._read_snaps('rx')
         for key in ['eof_in', 'valid_in', 'ip_in', ]:
             if key in d:
                 d[key.replace('_in', '')] = d[key]
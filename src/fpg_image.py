@@ -0,0 +1,167 @@
+"""
+Read .fpg files without loading them into memory: the file is mapped,
+the end of the header is found once, and the (possibly gzipped) program
+bitstream is read a chunk at a time.
+"""
+
+import os
+import mmap
+import zlib
+import hashlib
+
+# the header ends with this line, the bitstream follows it
+QUIT_LINE = '?quit'
+
+GZIP_MAGIC = '\x1f\x8b\x08'
+
+# the default size of the chunks a bitstream is read in
+CHUNK_SIZE = 1024 * 1024
+
+
+def _rechunk(pieces, chunk_size):
+    """
+    Regroup strings into chunk_size pieces, the last possibly shorter.
+    """
+    buffered = []
+    buffered_size = 0
+    for piece in pieces:
+        buffered.append(piece)
+        buffered_size += len(piece)
+        if buffered_size < chunk_size:
+            continue
+        data = ''.join(buffered)
+        pos = 0
+        while len(data) - pos >= chunk_size:
+            yield data[pos:pos + chunk_size]
+            pos += chunk_size
+        buffered = [data[pos:]]
+        buffered_size = len(buffered[0])
+    if buffered_size > 0:
+        yield ''.join(buffered)
+
+
+class FpgImage(object):
+    """
+    A memory-mapped .fpg file: the header and the program bitstream.
+
+    Use it as a context manager, or close() it when done.
+    """
+    def __init__(self, filename):
+        """
+
+        :param filename: the .fpg file
+        """
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        try:
+            self.size = os.fstat(self._file.fileno()).st_size
+            if self.size == 0:
+                raise IOError('{} is not a valid fpg file!'.format(filename))
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        quit_offset = self._map.find('\n' + QUIT_LINE + '\n')
+        if quit_offset != -1:
+            quit_offset += 1
+        else:
+            quit_offset = self._map.find(QUIT_LINE)
+        if quit_offset == -1:
+            self.close()
+            raise IOError('{} is not a valid fpg file!'.format(filename))
+        # where the ?quit line starts, and where the bitstream starts
+        self.quit_offset = quit_offset
+        self.bitstream_offset = quit_offset + len(QUIT_LINE) + 1
+        self.compressed = self._map[
+            self.bitstream_offset:self.bitstream_offset + len(GZIP_MAGIC)] \
+            == GZIP_MAGIC
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def header(self):
+        """
+        The header, up to and including the ?quit line.
+        """
+        return self._map[:self.bitstream_offset]
+
+    def header_lines(self):
+        """
+        The lines of the header before the ?quit line.
+        """
+        return self._map[:self.quit_offset].split('\n')
+
+    def iter_raw(self, chunk_size=CHUNK_SIZE, start=0):
+        """
+        Iterate over the file as it is on disk.
+
+        :param chunk_size: the size of each chunk, the last may be shorter
+        :param start: the offset at which to start
+        """
+        for pos in xrange(start, self.size, chunk_size):
+            yield self._map[pos:pos + chunk_size]
+
+    def _iter_decompressed(self, chunk_size):
+        """
+        Iterate over the gunzipped bitstream, never holding more than a
+        chunk of input and a chunk of output. Anything after the end of
+        the gzip stream is ignored, as zlib.decompress does.
+        """
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        raw = self.iter_raw(chunk_size, self.bitstream_offset)
+        data = ''
+        while True:
+            if not data:
+                data = next(raw, '')
+                if not data:
+                    break
+            out = decompressor.decompress(data, chunk_size)
+            data = decompressor.unconsumed_tail
+            if out:
+                yield out
+            if decompressor.unused_data:
+                break
+        out = decompressor.flush()
+        if out:
+            yield out
+
+    def iter_bitstream(self, chunk_size=CHUNK_SIZE):
+        """
+        Iterate over the program bitstream, gunzipped if it is compressed.
+
+        :param chunk_size: the size of each chunk, the last may be shorter
+        """
+        if not self.compressed:
+            return self.iter_raw(chunk_size, self.bitstream_offset)
+        return _rechunk(self._iter_decompressed(chunk_size), chunk_size)
+
+    def bitstream(self):
+        """
+        The whole program bitstream, gunzipped if it is compressed.
+        """
+        return ''.join(self.iter_bitstream())
+
+    def file_hash(self, name='md5'):
+        """
+        Hash the whole file.
+
+        :param name: the hashlib algorithm
+        :return: the hex digest
+        """
+        checksum = hashlib.new(name)
+        for chunk in self.iter_raw():
+            checksum.update(chunk)
+        return checksum.hexdigest()
+
+# end
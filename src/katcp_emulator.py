@@ -0,0 +1,373 @@
+"""
+A stand-in for tcpborphserver, for exercising KatcpTransport without a
+ROACH.
+
+KatcpFpgaServer is a katcp DeviceServer that serves the requests
+KatcpTransport makes - ?read, ?write, ?bulkread, ?wordread, ?listdev,
+?meta, ?fpgastatus, ?progremote, ?progdev and ?watchdog - on top of an
+FpgaSimulator memory map loaded from an fpg file.
+
+Every request can be given a latency, and the number of requests served at
+once can be limited, as tcpborphserver serves one at a time.
+"""
+
+import os
+import gzip
+import random
+import socket
+import logging
+import tempfile
+import threading
+
+import katcp
+from katcp.kattypes import concurrent_reply
+import tornado.gen
+import tornado.locks
+
+from transport_dummy import FpgaSimulator
+
+LOGGER = logging.getLogger(__name__)
+
+# the most data in one #bulkread inform, bytes
+BULKREAD_INFORM_SIZE = 4096
+
+
+def read_fpg_meta(filename):
+    """
+    Get the ?meta lines from an fpg file's header, as katcp arguments.
+
+    :param filename: the fpg file
+    :return: a list of argument lists
+    """
+    parser = katcp.MessageParser()
+    metalist = []
+    with open(filename, 'rb') as fptr:
+        for line in fptr:
+            line = line.rstrip('\n')
+            if line == '?quit':
+                break
+            if line.startswith('?meta'):
+                # older mlib_devel used spaces rather than tabs
+                line = line.replace('\t', ' ')
+                metalist.append(parser.parse(line).arguments)
+    return metalist
+
+
+class KatcpFpgaServer(katcp.DeviceServer):
+    """
+    A katcp server answering like tcpborphserver does for a programmed
+    FPGA.
+    """
+    VERSION_INFO = ('casperfpga-katcp-emulator', 0, 1)
+    BUILD_INFO = ('casperfpga-katcp-emulator', 0, 1, '')
+
+    def __init__(self, host='127.0.0.1', port=7147, fpg=None, latency=0.0,
+                 jitter=0.0, max_concurrent=1):
+        """
+
+        :param host: the address on which to listen
+        :param port: the port on which to listen, 0 for any free port
+        :param fpg: the fpg the FPGA starts out programmed with, None to
+            start unprogrammed
+        :param latency: seconds every request takes
+        :param jitter: up to this many seconds more, at random
+        :param max_concurrent: the most requests served at once, None for
+            no limit
+        """
+        super(KatcpFpgaServer, self).__init__(host, port)
+        self.set_concurrency_options(thread_safe=False, handler_thread=False)
+        self.latency = latency
+        self.jitter = jitter
+        self.max_concurrent = max_concurrent
+        self.simulator = FpgaSimulator()
+        self.metalist = []
+        self.stats = {'requests': 0, 'bytes_read': 0, 'bytes_written': 0}
+        self._slots = None
+        if fpg is not None:
+            self._program(fpg)
+
+    def setup_sensors(self):
+        pass
+
+    # region --- helpers ---
+
+    def _program(self, filename):
+        """
+        Program the simulated FPGA with an fpg file.
+        """
+        self.simulator.load(filename)
+        self.metalist = read_fpg_meta(filename)
+
+    def _deprogram(self):
+        self.simulator.clear()
+        self.metalist = []
+
+    @tornado.gen.coroutine
+    def _serve(self, func):
+        """
+        Run func as a request would be served: waiting for a free slot,
+        then taking latency seconds.
+
+        :return: func's result
+        """
+        self.stats['requests'] += 1
+        if (self.max_concurrent is not None) and (self._slots is None):
+            # made here, on the server's ioloop
+            self._slots = tornado.locks.Semaphore(self.max_concurrent)
+        if self._slots is not None:
+            yield self._slots.acquire()
+        try:
+            delay = self.latency
+            if self.jitter:
+                delay += random.uniform(0, self.jitter)
+            if delay > 0:
+                yield tornado.gen.sleep(delay)
+            result = func()
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+        raise tornado.gen.Return(result)
+
+    def _fpga_ready(self):
+        self.mass_inform(katcp.Message.inform('fpga', 'ready'))
+
+    def _receive_fpg(self, listener, timeout):
+        """
+        Receive an fpg sent to a ?progremote port and program it.
+        """
+        fd, filename = tempfile.mkstemp(suffix='.fpg')
+        try:
+            conn, _ = listener.accept()
+            conn.settimeout(timeout)
+            with os.fdopen(fd, 'wb') as fptr:
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        break
+                    fptr.write(data)
+            conn.close()
+            with open(filename, 'rb') as fptr:
+                compressed = fptr.read(2) == '\x1f\x8b'
+            if compressed:
+                with gzip.open(filename, 'rb') as fptr:
+                    data = fptr.read()
+                with open(filename, 'wb') as fptr:
+                    fptr.write(data)
+            self._program(filename)
+            self.ioloop.add_callback(self._fpga_ready)
+        except (socket.error, IOError, RuntimeError) as exc:
+            LOGGER.error('%s: progremote failed: %s' % (self.bind_address,
+                                                        exc))
+            self.ioloop.add_callback(
+                self.mass_inform, katcp.Message.inform('fpga', 'down'))
+        finally:
+            listener.close()
+            os.remove(filename)
+
+    # endregion
+
+    # region --- requests ---
+
+    @concurrent_reply
+    @tornado.gen.coroutine
+    def request_read(self, req, msg):
+        """
+        Read bytes from a memory device.
+
+        ?read name offset size
+        !read ok data
+        """
+        name, offset, size = msg.arguments[0], int(msg.arguments[1]), \
+            int(msg.arguments[2])
+        try:
+            data = yield self._serve(
+                lambda: self.simulator.read(name, size, offset))
+        except RuntimeError as exc:
+            raise tornado.gen.Return(req.make_reply('fail', str(exc)))
+        self.stats['bytes_read'] += size
+        raise tornado.gen.Return(req.make_reply('ok', data))
+
+    @concurrent_reply
+    @tornado.gen.coroutine
+    def request_write(self, req, msg):
+        """
+        Write bytes to a memory device.
+
+        ?write name offset data
+        !write ok
+        """
+        name, offset, data = msg.arguments[0], int(msg.arguments[1]), \
+            msg.arguments[2]
+        try:
+            yield self._serve(
+                lambda: self.simulator.write(name, data, offset))
+        except RuntimeError as exc:
+            raise tornado.gen.Return(req.make_reply('fail', str(exc)))
+        self.stats['bytes_written'] += len(data)
+        raise tornado.gen.Return(req.make_reply('ok'))
+
+    @concurrent_reply
+    @tornado.gen.coroutine
+    def request_bulkread(self, req, msg):
+        """
+        Read bytes from a memory device, returned in informs.
+
+        ?bulkread name offset size
+        #bulkread data
+        !bulkread ok
+        """
+        name, offset, size = msg.arguments[0], int(msg.arguments[1]), \
+            int(msg.arguments[2])
+        try:
+            data = yield self._serve(
+                lambda: self.simulator.read(name, size, offset))
+        except RuntimeError as exc:
+            raise tornado.gen.Return(req.make_reply('fail', str(exc)))
+        for pos in range(0, len(data), BULKREAD_INFORM_SIZE):
+            req.inform(data[pos:pos + BULKREAD_INFORM_SIZE])
+        self.stats['bytes_read'] += size
+        raise tornado.gen.Return(req.make_reply('ok'))
+
+    @concurrent_reply
+    @tornado.gen.coroutine
+    def request_wordread(self, req, msg):
+        """
+        Read 32-bit words from a memory device, starting at a bit offset.
+
+        ?wordread name word_offset[:bit_offset] [count]
+        !wordread ok 0xvalue...
+        """
+        name = msg.arguments[0]
+        location = msg.arguments[1].split(':')
+        word_offset = int(location[0], 0)
+        bit_offset = int(location[1], 0) if len(location) > 1 else 0
+        count = int(msg.arguments[2]) if len(msg.arguments) > 2 else 1
+
+        def wordread():
+            data = self.simulator.read(name, count * 4, word_offset * 4)
+            # the bits shifted in from the word after, if there is one
+            following = '\x00' * 4
+            if bit_offset:
+                try:
+                    following = self.simulator.read(
+                        name, 4, (word_offset + count) * 4)
+                except RuntimeError:
+                    pass
+            value = int((str(data) + str(following)).encode('hex'), 16)
+            value >>= 32 - bit_offset
+            return [(value >> (32 * (count - 1 - ctr))) & 0xffffffff
+                    for ctr in range(count)]
+        try:
+            words = yield self._serve(wordread)
+        except (RuntimeError, ValueError) as exc:
+            raise tornado.gen.Return(req.make_reply('fail', str(exc)))
+        raise tornado.gen.Return(req.make_reply(
+            'ok', *['0x%x' % word for word in words]))
+
+    @concurrent_reply
+    @tornado.gen.coroutine
+    def request_listdev(self, req, msg):
+        """
+        List the memory devices.
+
+        ?listdev [size|detail]
+        #listdev name [bytes:0|0xaddress:0xbytes]
+        !listdev ok
+        """
+        detail = msg.arguments[0] if msg.arguments else ''
+        memorymap = yield self._serve(lambda: dict(self.simulator.memorymap))
+        for name in sorted(memorymap.keys()):
+            info = memorymap[name]
+            if detail == 'size':
+                req.inform(name, '%i:0' % info['bytes'])
+            elif detail == 'detail':
+                req.inform(name, '0x%08x:0x%x' % (info['address'],
+                                                  info['bytes']))
+            else:
+                req.inform(name)
+        raise tornado.gen.Return(req.make_reply('ok'))
+
+    @concurrent_reply
+    @tornado.gen.coroutine
+    def request_meta(self, req, msg):
+        """
+        List the design's meta information.
+
+        ?meta [name]
+        #meta name tag param value...
+        !meta ok
+        """
+        device = msg.arguments[0] if msg.arguments else None
+        metalist = yield self._serve(lambda: list(self.metalist))
+        for meta in metalist:
+            if (device is None) or (meta[0] == device):
+                req.inform(*meta)
+        raise tornado.gen.Return(req.make_reply('ok'))
+
+    @concurrent_reply
+    @tornado.gen.coroutine
+    def request_fpgastatus(self, req, msg):
+        """
+        Is the FPGA programmed?
+
+        ?fpgastatus
+        !fpgastatus ok|fail
+        """
+        programmed = yield self._serve(lambda: self.simulator.programmed)
+        if programmed:
+            raise tornado.gen.Return(req.make_reply('ok', 'ready'))
+        raise tornado.gen.Return(req.make_reply('fail', 'down'))
+
+    def request_progremote(self, req, msg):
+        """
+        Listen on a port for an fpg, program it and send #fpga ready.
+
+        ?progremote port
+        !progremote ok
+        """
+        port = int(msg.arguments[0])
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listener.bind((self.bind_address[0], port))
+            listener.listen(1)
+        except socket.error as exc:
+            listener.close()
+            return req.make_reply('fail', str(exc))
+        self._deprogram()
+        receiver = threading.Thread(target=self._receive_fpg,
+                                    args=(listener, 30))
+        receiver.daemon = True
+        receiver.start()
+        return req.make_reply('ok')
+
+    def request_progdev(self, req, msg):
+        """
+        Deprogram the FPGA, or program it with a local fpg file.
+
+        ?progdev [filename]
+        !progdev ok
+        """
+        self._deprogram()
+        if msg.arguments and msg.arguments[0]:
+            try:
+                self._program(msg.arguments[0])
+            except (IOError, RuntimeError) as exc:
+                return req.make_reply('fail', str(exc))
+            self.ioloop.add_callback(self._fpga_ready)
+        return req.make_reply('ok')
+
+    def request_tap_info(self, req, msg):
+        """
+        List the running tap devices, there are none.
+
+        ?tap-info
+        !tap-info ok
+        """
+        return req.make_reply('ok')
+
+    # ?watchdog is answered by katcp.DeviceServer
+
+    # endregion
+
+# end
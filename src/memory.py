@@ -7,6 +7,7 @@ busses. Normally via KATCP.
 import logging
 import bitfield
 import struct
+import numpy as np
 
 LOGGER = logging.getLogger(__name__)
 
@@ -192,3 +193,61 @@ class Memory(bitfield.Bitfield):
                                    field.binary_pt, field.numtype == 1)
                 processed[field.name].append(word_done)
         return processed
+
+    def _process_data_array(self, rawdata):
+        """
+        Process raw data according to this memory's bitfield setup, but
+        return a NumPy array per field instead of a list.
+
+        Fields of up to 64 bits are sliced out of the raw big-endian words
+        with array operations. Byte-aligned fields that are a multiple of
+        64 bits wide are returned as (N, width/64) uint64 arrays, most
+        significant lane first. Anything else falls back to _process_data.
+        """
+        width_bytes = self.width_bits / 8
+        words = np.frombuffer(rawdata, dtype=np.uint8)
+        words = words[:(len(words) / width_bytes) * width_bytes]
+        words = words.reshape(-1, width_bytes)
+        processed = {}
+        slow_fields = []
+        for field in self._fields.itervalues():
+            lsb = field.offset
+            msb = field.offset + field.width_bits - 1
+            # byte columns are big-endian within each word
+            first_col = width_bytes - 1 - (msb / 8)
+            last_col = width_bytes - 1 - (lsb / 8)
+            if field.width_bits > 64:
+                if (lsb % 8 == 0) and (field.width_bits % 64 == 0) and \
+                        (field.binary_pt == 0) and (field.numtype != 1):
+                    lanes = np.ascontiguousarray(
+                        words[:, first_col:last_col + 1])
+                    processed[field.name] = lanes.view('>u8').astype(
+                        np.uint64)
+                else:
+                    slow_fields.append(field.name)
+                continue
+            if last_col - first_col + 1 > 8:
+                slow_fields.append(field.name)
+                continue
+            value = np.zeros(len(words), dtype=np.uint64)
+            for col in range(first_col, last_col + 1):
+                value <<= np.uint64(8)
+                value |= words[:, col]
+            value >>= np.uint64(lsb % 8)
+            if field.width_bits < 64:
+                value &= np.uint64((1 << field.width_bits) - 1)
+            if field.numtype == 1:
+                value = value.view(np.int64)
+                if field.width_bits < 64:
+                    # sign-extend in int64, as mixing in a Python long would
+                    # promote wide fields to inexact float64
+                    shift = np.int64(64 - field.width_bits)
+                    value = (value << shift) >> shift
+            if field.binary_pt != 0:
+                value = value / float(2 ** field.binary_pt)
+            processed[field.name] = value
+        if slow_fields:
+            fallback = self._process_data(rawdata)
+            for field_name in slow_fields:
+                processed[field_name] = np.array(fallback[field_name])
+        return processed
@@ -1,5 +1,6 @@
 import struct
 import socket
+import numbers
 
 
 class Mac(object):
@@ -45,8 +46,9 @@ class Mac(object):
             mac_str = str(mac)
         elif isinstance(mac, basestring):
             mac_str = mac
-        elif isinstance(mac, int):
-            mac_int = mac
+        elif isinstance(mac, numbers.Integral):
+            # also longs and numpy integers, e.g. from snapshot arrays
+            mac_int = int(mac)
         if mac_str is not None:
             if mac_str.find(':') == -1:
                 mac_int = int(mac_str)
@@ -153,8 +155,9 @@ class IpAddress(object):
             ip_str = str(ip)
         elif isinstance(ip, basestring):
             ip_str = ip
-        elif isinstance(ip, int):
-            ip_int = ip
+        elif isinstance(ip, numbers.Integral):
+            # also longs and numpy integers, e.g. from snapshot arrays
+            ip_int = int(ip)
         if ip_str is not None:
             try:
                 ip_str = socket.gethostbyname(ip_str)
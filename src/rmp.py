@@ -1,290 +1,331 @@
-"""!@package rmp UDP socket management and RMP packet encoding/decoding
- 
-This package provides functions for network initializing and basic 32 bit read/write
-operations on the network attached device using RMP protocol. This is rough and minimal code
-not exploiting all the RMP protocol features.     
-"""
-import sys
-import socket
-import array
-from struct import *
-
-
-class rmpNetwork():
-    def __init__(self, this_ip, fpga_ip, udp_port, timeout):
-        """!@brief Initialize the network
-
-        It Opens the sockets and sets specific options as socket receive time-out and buffer size.
-
-        @param this_ip  -- str -- Host machine IP address
-        @param fpga_ip  -- str -- Network attached device IP address
-        @param udp_port -- int -- UDP port
-        @param timeout  -- int -- Receive Socket time-out in seconds
-
-        Returns -- int -- socket handle
-        """
-        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)  # Internet # UDP
-
-        self.sock.settimeout(1)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
-        if fpga_ip == "255.255.255.255":
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.sock.bind((this_ip, 0))
-        self.fpga_ip = fpga_ip
-        self.this_ip = this_ip
-        self.remote_udp_port = udp_port
-        self.timeout = timeout
-        self.psn = 0
-        self.reliable = 0
-
-    def CloseNetwork(self):
-        """!@brief Close previously opened socket.
-        """
-        self.sock.close()
-        return
-
-    def recvfrom_to(self, buff):
-        attempt = 0
-        while (attempt < self.timeout or self.timeout == 0):
-            try:
-                return self.sock.recvfrom(10240)
-            except:
-                attempt += 1
-        raise NameError("UDP timeout. No answer from remote end!")
-
-    def wr32_bulk(self, add, dat):
-        """!@brief Write remote register at address add with dat.
-
-        It transmits a write request to the remote device.
-
-        @param add -- int -- 32 bits remote address
-        @param dat -- int -- 32 bits write data
-        """
-
-        self.psn += 1
-        exp_psn = self.psn
-
-        num_pkt = len(dat)/256
-        num_wr = num_pkt
-        num_ack = 0
-        idx = 0
-
-        # if num_wr > 0:
-        #     print "sending 1"
-        #     pkt = array.array('I')
-        #     pkt.append(self.psn)  # psn
-        #     pkt.append(2)  # opcode
-        #     pkt.append(256)  # noo
-        #     pkt.append(1)  # noo
-        #     pkt.append(add)  # sa
-        #     for d in dat[256*idx:256*(idx+1)]:  # dat
-        #         pkt.append(d)
-        #     self.sock.sendto(bytes(pkt.tostring()), (self.fpga_ip, self.remote_udp_port))
-        #
-        #     num_wr -= 1
-        #     idx += 1
-        #     self.psn += 1
-
-        if num_wr > 0:
-            print "sending 1"
-            pkt = array.array('I')
-            pkt.append(self.psn)  # psn
-            pkt.append(2)  # opcode
-            pkt.append(256)  # noo
-            pkt.append(add)  # sa
-            for d in dat[256*idx:256*(idx+1)]:  # dat
-                pkt.append(d)
-            self.sock.sendto(bytes(pkt.tostring()), (self.fpga_ip, self.remote_udp_port))
-
-            num_wr -= 1
-            idx += 1
-            self.psn += 1
-
-        while num_ack != num_pkt:
-            if num_wr > 0:
-                pkt = array.array('I')
-                pkt.append(self.psn)  # psn
-                pkt.append(2)  # opcode
-                pkt.append(256)  # noo
-                pkt.append(add)  # sa
-                for d in dat[256*idx:256*(idx+1)]:  # dat
-                    pkt.append(d)
-                self.sock.sendto(bytes(pkt.tostring()), (self.fpga_ip, self.remote_udp_port))
-                num_wr -= 1
-                idx += 1
-                self.psn += 1
-
-            data, addr = self.recvfrom_to(10240)
-            data = bytes(data)
-            psn = unpack('I', data[0:4])[0]
-            add = unpack('I', data[4:8])[0]
-            if psn != exp_psn or add != add:
-               print "Bulk write PSN error!"
-               return
-            num_ack += 1
-            exp_psn += 1
-
-        if dat[(len(dat)/256)*256:] != []:
-            self.wr32(add, dat[(len(dat)/256)*256:])
-
-    def wr32(self, add, dat, infinite_loop = False):
-        """!@brief Write remote register at address add with dat.
-
-        It transmits a write request to the remote device.
-
-        @param add -- int -- 32 bits remote address
-        @param dat -- int -- 32 bits write data
-        """
-        req_add = add
-        for i in range(3):
-            try:
-
-                self.psn += 1
-
-                pkt = array.array('I')
-                pkt.append(self.psn)  # psn
-                pkt.append(2)  # opcode
-                if type(dat) == list:
-                    pkt.append(len(dat))  # noo
-                else:
-                    pkt.append(1)  # noo
-                pkt.append(req_add)  # sa
-                if type(dat) == list:
-                    for d in dat:
-                        pkt.append(d)
-                else:
-                    pkt.append(dat)  # dat
-
-                self.sock.sendto(bytes(pkt.tostring()), (self.fpga_ip, self.remote_udp_port))
-                while infinite_loop:
-                    self.sock.sendto(bytes(pkt.tostring()), (self.fpga_ip, self.remote_udp_port))
-                data, addr = self.recvfrom_to(10240)
-
-                data = bytes(data)
-
-                psn = unpack('I', data[0:4])[0]
-                add = unpack('I', data[4:8])[0]
-
-                if psn == self.psn and add == req_add:
-                    return
-                elif psn != self.psn:
-                    print
-                    print "Failed UCP write, received wrong PSN ..."
-                    print "Received: " + str(psn)
-                    print "Expected: " + str(self.psn)
-                    print "Retrying..."
-                elif add != req_add:
-                    print
-                    print "Failed UCP write, error received ..."
-                    print "Requested Add: " + hex(req_add)
-                    print "Received Add: " + hex(add)
-                    print "Retrying..."
-                    self.socket_flush()
-            except:
-                if self.reliable == 1:
-                    print
-                    print "Failed UCP write:"
-                    #print "Received: " + str(psn)
-                    #print "Expected: " + str(self.psn)
-                    print "Requested Add: " + hex(req_add)
-                    #print "Received Add: " + hex(add)
-                    print "Retrying..."
-                    pass
-                else:
-                    print "Failed UCP write. Exiting ..."
-                    sys.exit(-1)
-
-
-            print "Getting Last Executed PSN..."
-            last_psn = self.rd32(0x30000004)
-            print "Getting Last Executed PSN...", last_psn
-            if last_psn == self.psn:
-                return
-            else:
-                pass
-
-        print
-        print "UCP write error"
-        print "Requested Add: " + hex(req_add)
-        print "Received Add: " + hex(add)
-        exit(-1)
-
-
-    def rd32(self, add, n=1):
-        """!@brief Read remote register at address add.
-
-        It transmits a read request and waits for a read response from the remote device.
-        Once the response is received it extracts relevant data from a specific offset within the
-        UDP payload and returns it. In case no response is received from the remote device
-        a socket time-out occurs.
-
-        @param add -- int -- 32 bits remote address
-
-        Returns -- int -- read data
-        """
-        req_add = add
-        for i in range(3):
-
-            self.psn += 1
-
-            try:
-                pkt = array.array('I')
-                pkt.append(self.psn)    # psn
-                pkt.append(1)           # opcode
-                pkt.append(n)           # noo
-                pkt.append(req_add)     # sa
-
-                self.sock.sendto(bytes(pkt.tostring()), (self.fpga_ip, self.remote_udp_port))
-
-                data, addr = self.recvfrom_to(10240)
-
-                data = bytes(data)
-
-                psn = unpack('I', data[0:4])[0]
-                add = unpack('I', data[4:8])[0]
-
-                if psn == self.psn and add == req_add:
-                    dat = unpack('I' * n, data[8:])
-                    dat_list = []
-                    for k in range(n):
-                        dat_list.append(dat[k])
-                    if n == 1:
-                        return dat_list[0]
-                    else:
-                        return dat_list
-                else:
-                    print
-                    print "Failed UCP read, received wrong PSN or error detected ..."
-                    print "Received: " + str(psn)
-                    print "Expected: " + str(self.psn)
-                    print "Requested Add: " + hex(req_add)
-                    print "Received Add: " + hex(add)
-                    print "Retrying..."
-                    self.socket_flush()
-
-            except:
-                if self.reliable == 1:
-                    print "Failed UCP read, retrying ..."
-                else:
-                    print "Failed UCP read, exiting ..."
-                    sys.exit(-1)
-
-        print
-        print "UCP read error"
-        print "Requested Add: " + hex(req_add)
-        #print "Received Add: " + hex(add)
-        exit(-1)
-
-    def socket_flush(self):
-        print "Flushing UCP socket..."
-        self.sock.close()
-
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Internet # UDP
-
-        self.sock.settimeout(1)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
-        if self.fpga_ip == "255.255.255.255":
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.sock.bind((self.this_ip, 0))
+"""!@package rmp UDP socket management and RMP packet encoding/decoding
+
+This package provides functions for network initializing and basic 32 bit read/write
+operations on the network attached device using RMP protocol. This is rough and minimal code
+not exploiting all the RMP protocol features.
+
+Large reads and writes are split into packets of at most RMP_MAX_WORDS words,
+and up to RMP_WINDOW packets, each with its own PSN, are kept in flight at once.
+"""
+import socket
+import array
+import time
+import logging
+from struct import *
+
+from transport_stats import TransportStats
+
+LOGGER = logging.getLogger(__name__)
+
+RMP_OPCODE_READ = 1
+RMP_OPCODE_WRITE = 2
+
+# the most 32-bit words in one RMP request
+RMP_MAX_WORDS = 256
+
+# the most RMP requests in flight at once
+RMP_WINDOW = 8
+
+# the device register holding the PSN of the last request it executed before
+# the read of the register itself
+RMP_LAST_PSN_REG = 0x30000004
+
+# resend outstanding requests this many times before giving up
+RMP_RETRIES = 3
+
+
+class RmpError(RuntimeError):
+    """!@brief An RMP transaction failed."""
+    pass
+
+
+class RmpTimeout(RmpError):
+    """!@brief The remote end did not answer."""
+    pass
+
+
+class rmpNetwork():
+    def __init__(self, this_ip, fpga_ip, udp_port, timeout, metrics=None):
+        """!@brief Initialize the network
+
+        It Opens the sockets and sets specific options as socket receive time-out and buffer size.
+
+        @param this_ip  -- str -- Host machine IP address
+        @param fpga_ip  -- str -- Network attached device IP address
+        @param udp_port -- int -- UDP port
+        @param timeout  -- int -- Receive Socket time-out in seconds
+        @param metrics  -- TransportStats -- where to count packets, e.g.
+                           that of the owning transport
+
+        Returns -- int -- socket handle
+        """
+        self.fpga_ip = fpga_ip
+        self.this_ip = this_ip
+        self.remote_udp_port = udp_port
+        self.timeout = timeout
+        self.psn = 0
+        self.reliable = 0
+        self.window = RMP_WINDOW
+        self.max_words = RMP_MAX_WORDS
+        self.retries = RMP_RETRIES
+        self.metrics = metrics if metrics is not None else TransportStats()
+        self._open_socket()
+
+    def _open_socket(self):
+        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)  # Internet # UDP
+
+        self.sock.settimeout(1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        if self.fpga_ip == "255.255.255.255":
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind((self.this_ip, 0))
+
+    def CloseNetwork(self):
+        """!@brief Close previously opened socket.
+        """
+        self.sock.close()
+        return
+
+    def recvfrom_to(self, buff):
+        attempt = 0
+        while (attempt < self.timeout or self.timeout == 0):
+            try:
+                return self.sock.recvfrom(10240)
+            except socket.timeout:
+                attempt += 1
+        raise RmpTimeout("UDP timeout. No answer from remote end!")
+
+    def _send_request(self, opcode, add, noo, payload=''):
+        """!@brief Send one RMP request with a new PSN.
+
+        @param opcode  -- int -- RMP_OPCODE_READ or RMP_OPCODE_WRITE
+        @param add     -- int -- 32 bits remote address
+        @param noo     -- int -- number of 32 bit operands
+        @param payload -- str -- write data, as native-order 32 bit words
+
+        Returns -- int -- the PSN of the request
+        """
+        self.psn += 1
+        packet = pack('IIII', self.psn, opcode, noo, add) + payload
+        self.sock.sendto(packet, (self.fpga_ip, self.remote_udp_port))
+        self.metrics.sent(len(packet))
+        return self.psn
+
+    def _transact(self, opcode, add, nwords, data=None, increment=True):
+        """!@brief Run a windowed RMP transfer.
+
+        The transfer is split into requests of at most max_words words, and
+        up to window requests are kept in flight. Requests that are not
+        answered are resent with a new PSN. For a FIFO write, the
+        unanswered requests are first checked against the last PSN the
+        device executed, so that no FIFO write is repeated or skipped. A
+        lost answer ahead of answered requests cannot be told from a lost
+        request, so then RmpError is raised rather than guessing, and the
+        FIFO transfer must be restarted from the beginning.
+
+        @param opcode    -- int -- RMP_OPCODE_READ or RMP_OPCODE_WRITE
+        @param add       -- int -- 32 bits remote start address
+        @param nwords    -- int -- number of 32 bit words to transfer
+        @param data      -- str -- for writes, the native-order 32 bit words
+        @param increment -- bool -- step the address from request to request,
+                            False for a FIFO
+
+        Returns -- bytearray -- for reads, the native-order 32 bit words read
+        """
+        result = bytearray(nwords * 4) if opcode == RMP_OPCODE_READ else None
+        chunks = [(pos, min(self.max_words, nwords - pos))
+                  for pos in range(0, nwords, self.max_words)]
+        chunks.reverse()
+        # psn -> (word position, word count, request address)
+        outstanding = {}
+        retries = 0
+        fifo_write = (opcode == RMP_OPCODE_WRITE) and not increment
+
+        def send(pos, count):
+            req_add = (add + (pos * 4)) if increment else add
+            if opcode == RMP_OPCODE_READ:
+                psn = self._send_request(opcode, req_add, count)
+            else:
+                psn = self._send_request(opcode, req_add, count,
+                                         data[pos * 4:(pos + count) * 4])
+            outstanding[psn] = (pos, count, req_add)
+
+        while chunks or outstanding:
+            while chunks and (len(outstanding) < self.window):
+                send(*chunks.pop())
+            try:
+                packet, _ = self.recvfrom_to(10240)
+            except RmpTimeout:
+                self.metrics.timeout()
+                retries += 1
+                if retries > self.retries:
+                    raise RmpTimeout('No RMP answer from %s for address '
+                                     '0x%08X' % (self.fpga_ip, add))
+                pending = sorted(outstanding.items())
+                outstanding.clear()
+                if fifo_write:
+                    # do not repeat a FIFO write the device did execute,
+                    # repeating writes to memory does no harm
+                    pending = self._unexecuted_fifo_writes(pending, add)
+                LOGGER.debug('%s: resending %d RMP requests' % (
+                    self.fpga_ip, len(pending)))
+                # resend in the original order, ahead of new requests
+                for _, (pos, count, _) in reversed(pending):
+                    chunks.append((pos, count))
+                self.metrics.retransmit(len(pending))
+                continue
+            self.metrics.received(len(packet))
+            if len(packet) < 8:
+                self.metrics.discard('wrong_size')
+                continue
+            psn, resp_add = unpack('II', packet[0:8])
+            if psn not in outstanding:
+                # a late answer to a request that was resent
+                self.metrics.discard('wrong_seq')
+                continue
+            pos, count, req_add = outstanding[psn]
+            if resp_add != req_add:
+                raise RmpError('RMP error from %s: requested address '
+                               '0x%08X, answer for 0x%08X' % (
+                                   self.fpga_ip, req_add, resp_add))
+            if opcode == RMP_OPCODE_READ:
+                if len(packet) < 8 + (count * 4):
+                    raise RmpError('Short RMP read answer from %s for '
+                                   'address 0x%08X' % (self.fpga_ip, req_add))
+                result[pos * 4:(pos + count) * 4] = packet[8:8 + (count * 4)]
+            del outstanding[psn]
+            retries = 0
+        return result
+
+    def _last_executed_psn(self):
+        """!@brief Read the PSN of the last request the device executed.
+
+        Returns -- tuple -- (the PSN, the first PSN used to read it)
+        """
+        first_psn = self.psn + 1
+        last_psn = unpack('I', str(self._transact(RMP_OPCODE_READ,
+                                                  RMP_LAST_PSN_REG, 1)))[0]
+        return last_psn, first_psn
+
+    def _unexecuted_fifo_writes(self, pending, add):
+        """!@brief Find out which unanswered FIFO writes were not executed.
+
+        The device executes requests in the order they arrive, and
+        RMP_LAST_PSN_REG holds the PSN of the last one it executed before
+        the read of the register. Every unanswered request after that PSN
+        was not executed and is resent, and the one at it was executed. An
+        unanswered request before it may have been lost in flight with
+        later ones executed after it, which has already reordered the
+        FIFO, so that raises RmpError.
+
+        @param pending -- list -- the outstanding (psn, request) items,
+                          in PSN order
+        @param add     -- int -- the FIFO address, for errors
+
+        Returns -- list -- the pending items that must be resent
+        """
+        last_psn, first_read_psn = self._last_executed_psn()
+        if first_read_psn <= last_psn <= self.psn:
+            # the device reports one of the reads of the register: an
+            # earlier one whose answer was lost, executed after the
+            # writes, or this one, if the device counts the read it is
+            # answering. Either way the writes' state is hidden.
+            raise RmpError('RMP FIFO write to 0x%08X on %s: the last '
+                           'executed PSN %d is that of a read of it, cannot '
+                           'tell which of requests %s were executed' % (
+                               add, self.fpga_ip, last_psn,
+                               [psn for psn, _ in pending]))
+        unknown = [psn for psn, _ in pending if psn < last_psn]
+        if unknown:
+            raise RmpError('RMP FIFO write to 0x%08X on %s: cannot tell '
+                           'whether requests %s were executed, last '
+                           'executed PSN is %d' % (add, self.fpga_ip,
+                                                   unknown, last_psn))
+        return [item for item in pending if item[0] > last_psn]
+
+    def read_block(self, add, n):
+        """!@brief Read n consecutive 32 bit words starting at address add.
+
+        @param add -- int -- 32 bits remote address
+        @param n   -- int -- number of words to read
+
+        Returns -- bytearray -- the words read, in native byte order
+        """
+        start_time = time.time()
+        try:
+            data = self._transact(RMP_OPCODE_READ, add, n)
+        except RmpError:
+            self.metrics.failure('read')
+            raise
+        self.metrics.record('read', time.time() - start_time)
+        return data
+
+    def write_block(self, add, data, increment=True):
+        """!@brief Write 32 bit words starting at address add.
+
+        @param add       -- int -- 32 bits remote address
+        @param data      -- str -- the words to write, in native byte order
+        @param increment -- bool -- False to write every word to address add,
+                            e.g. a FIFO
+        """
+        data = str(data)
+        if len(data) % 4 != 0:
+            raise ValueError('RMP writes must be whole 32-bit words')
+        start_time = time.time()
+        try:
+            self._transact(RMP_OPCODE_WRITE, add, len(data) // 4, data,
+                           increment=increment)
+        except RmpError:
+            self.metrics.failure('write')
+            raise
+        self.metrics.record('write', time.time() - start_time)
+
+    def wr32_bulk(self, add, dat):
+        """!@brief Write a list of words to the remote FIFO at address add.
+
+        @param add -- int -- 32 bits remote address
+        @param dat -- list -- 32 bits write data
+        """
+        self.write_block(add, array.array('I', dat).tostring(),
+                         increment=False)
+
+    def wr32(self, add, dat, infinite_loop = False):
+        """!@brief Write remote register at address add with dat.
+
+        It transmits a write request to the remote device.
+
+        @param add -- int -- 32 bits remote address
+        @param dat -- int -- 32 bits write data
+        """
+        if type(dat) != list:
+            dat = [dat]
+        if infinite_loop:
+            pkt = pack('IIII', self.psn + 1, RMP_OPCODE_WRITE, len(dat), add) + \
+                array.array('I', dat).tostring()
+            while True:
+                self.sock.sendto(pkt, (self.fpga_ip, self.remote_udp_port))
+        self.write_block(add, array.array('I', dat).tostring())
+
+    def rd32(self, add, n=1):
+        """!@brief Read remote register at address add.
+
+        It transmits a read request and waits for a read response from the remote device.
+        Once the response is received it extracts relevant data from a specific offset within the
+        UDP payload and returns it. In case no response is received from the remote device
+        an RmpTimeout is raised.
+
+        @param add -- int -- 32 bits remote address
+
+        Returns -- int -- read data
+        """
+        dat = array.array('I', str(self.read_block(add, n))).tolist()
+        if n == 1:
+            return dat[0]
+        else:
+            return dat
+
+    def socket_flush(self):
+        LOGGER.debug('%s: flushing RMP socket' % self.fpga_ip)
+        self.sock.close()
+        self._open_socket()
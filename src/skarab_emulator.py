@@ -0,0 +1,627 @@
+"""
+An emulator for the SKARAB control protocol, for exercising SkarabTransport
+without a board.
+
+Each SkarabEmulator answers the microblaze's UDP control requests for one
+board, on top of an FpgaSimulator memory map. A SkarabEmulatorServer runs
+any number of them from one thread, so a whole fleet can be emulated by a
+single process. Give each emulator its own loopback alias (127.0.1.1,
+127.0.1.2, ...) to use the standard port, which progska needs, or its own
+port on 127.0.0.1 and pass that port to SkarabTransport as
+skarab_control_port.
+
+Per-packet delay, jitter, drop rate and reordering can be set per emulator.
+"""
+
+import socket
+import select
+import struct
+import heapq
+import random
+import logging
+import threading
+import time
+
+import skarab_definitions as sd
+from transport_dummy import FpgaSimulator
+
+LOGGER = logging.getLogger(__name__)
+
+# opcode for requests we do not understand, as the microblaze sends it
+UNSUPPORTED_OPCODE = 0xffff
+
+# version registers: bit 31 is set while the golden image runs
+EMULATED_FIRMWARE_VERSION = (3 << 16) | 8
+GOLDEN_IMAGE_FLAG = 1 << 31
+EMULATED_SOC_VERSION = (1 << 16) | 0
+EMULATED_EMBEDDED_SOFTWARE_VERSION = (3, 10, 0)
+
+# NOR flash block size, in bytes
+NOR_BLOCK_BYTES = int(sd.DEFAULT_BLOCK_SIZE) * 2
+
+# Spartan SPI flash page size, in bytes
+SPI_PAGE_BYTES = 264
+
+# the most packets read from one board's socket before the server moves on
+# to the next, so that every board gets a turn
+MAX_PACKETS_PER_PASS = 16
+
+# voltage and current sensors: (monitor page, nominal value)
+SENSOR_VOLTAGES = {
+    '12V2_voltage': (sd.P12V2_VOLTAGE_MON_PAGE, 12.0),
+    '12V_voltage': (sd.P12V_VOLTAGE_MON_PAGE, 12.0),
+    '5V_voltage': (sd.P5V_VOLTAGE_MON_PAGE, 5.0),
+    '3V3_voltage': (sd.P3V3_VOLTAGE_MON_PAGE, 3.3),
+    '2V5_voltage': (sd.P2V5_VOLTAGE_MON_PAGE, 2.5),
+    '1V8_voltage': (sd.P1V8_VOLTAGE_MON_PAGE, 1.8),
+    '1V2_voltage': (sd.P1V2_VOLTAGE_MON_PAGE, 1.2),
+    '1V0_voltage': (sd.P1V0_VOLTAGE_MON_PAGE, 1.0),
+    '1V8_MGTVCCAUX_voltage': (sd.P1V8_MGTVCCAUX_VOLTAGE_MON_PAGE, 1.8),
+    '1V0_MGTAVCC_voltage': (sd.P1V0_MGTAVCC_VOLTAGE_MON_PAGE, 1.0),
+    '1V2_MGTAVTT_voltage': (sd.P1V2_MGTAVTT_VOLTAGE_MON_PAGE, 1.2),
+    '5V_aux_voltage': (sd.P5VAUX_VOLTAGE_MON_PAGE, 5.0),
+    '3V3_config_voltage': (sd.PLUS3V3CONFIG02_ADC_PAGE, 3.3),
+}
+SENSOR_CURRENTS = {
+    '12V2_current': (sd.P12V2_CURRENT_MON_PAGE, 2.0),
+    '12V_current': (sd.P12V_CURRENT_MON_PAGE, 2.0),
+    '5V_current': (sd.P5V_CURRENT_MON_PAGE, 1.0),
+    '3V3_current': (sd.P3V3_CURRENT_MON_PAGE, 0.5),
+    '2V5_current': (sd.P2V5_CURRENT_MON_PAGE, 0.1),
+    '1V8_current': (sd.P1V8_CURRENT_MON_PAGE, 0.2),
+    '1V2_current': (sd.P1V2_CURRENT_MON_PAGE, 0.1),
+    '1V0_current': (sd.P1V0_CURRENT_MON_PAGE, 10.0),
+    '1V8_MGTVCCAUX_current': (sd.P1V8_MGTVCCAUX_CURRENT_MON_PAGE, 0.1),
+    '1V0_MGTAVCC_current': (sd.P1V0_MGTAVCC_CURRENT_MON_PAGE, 5.0),
+    '1V2_MGTAVTT_current': (sd.P1V2_MGTAVTT_CURRENT_MON_PAGE, 1.0),
+    '3V3_config_current': (sd.P3V3_CONFIG_CURRENT_MON_PAGE, 0.05),
+}
+
+
+def _pmbus_linear(value):
+    """
+    Encode a value as the (mantissa, exponent) word pair the monitors
+    report, with the largest precision that fits in 16 bits.
+    """
+    for exponent in range(-12, 16):
+        mantissa = int(round(value / (2.0 ** exponent)))
+        if mantissa < 0x10000:
+            return mantissa, exponent & 0x1f
+    raise ValueError('Cannot encode %f' % value)
+
+
+def _sensor_words():
+    """
+    The sensor_data words of a GET_SENSOR_DATA response, for a healthy
+    board.
+    """
+    words = [0] * 106
+    for name, idx in sd.sensor_list.items():
+        if name.endswith('_fan_rpm'):
+            words[idx] = 5000 if name.startswith('fpga') else 10000
+        elif name.endswith('_fan_pwm'):
+            # hundredths of a percent
+            words[idx] = 5000
+        elif name.startswith('hmc'):
+            # four bytes making up a 32-bit temperature
+            words[idx:idx + 4] = [0, 0, 0, 45]
+        elif name in ('voltage_monitor_temperature_degC',
+                      'current_monitor_temperature_degC'):
+            # linear format, exponent zero
+            words[idx] = 35
+        elif name.endswith('degC'):
+            # hundredths of a degree
+            words[idx] = 2500 if name.startswith('inlet') else 3500
+    for sensors, scaling in ((SENSOR_VOLTAGES, sd.voltage_scaling),
+                             (SENSOR_CURRENTS, sd.current_scaling)):
+        for name, (page, value) in sensors.items():
+            idx = sd.sensor_list[name]
+            mantissa, exponent = _pmbus_linear(value / scaling[str(page)])
+            words[idx:idx + 3] = [mantissa, exponent, page]
+    return words
+
+
+def _to_words(data):
+    """
+    Unpack a binary string into 16-bit words.
+    """
+    return list(struct.unpack('!%iH' % (len(data) // 2),
+                              data[0:(len(data) // 2) * 2]))
+
+
+def _split32(value):
+    return (value >> 16) & 0xffff, value & 0xffff
+
+
+class SkarabEmulator(object):
+    """
+    One emulated SKARAB.
+    """
+    def __init__(self, host='127.0.0.1',
+                 port=sd.ETHERNET_CONTROL_PORT_ADDRESS, fpg=None,
+                 delay=0.0, jitter=0.0, drop=0.0, reorder=0.0,
+                 reorder_delay=0.005, boot_time=0.0, flash_erase_time=0.0,
+                 flash_program_time=0.0):
+        """
+
+        :param host: the address on which to listen
+        :param port: the UDP port on which to listen, 0 for any free port
+        :param fpg: the fpg of the design the board runs, it boots into it
+            at start-up and whenever it boots from SDRAM
+        :param delay: seconds to delay every response
+        :param jitter: up to this many seconds more, at random
+        :param drop: the chance of losing each request and each response
+        :param reorder: the chance of holding a response back so that later
+            ones overtake it
+        :param reorder_delay: how long to hold those responses, seconds
+        :param boot_time: seconds the board is silent after a reboot
+        :param flash_erase_time: seconds to erase a flash block or sector
+        :param flash_program_time: seconds to program a flash request
+        """
+        self.fpg = fpg
+        self.delay = delay
+        self.jitter = jitter
+        self.drop = drop
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.boot_time = boot_time
+        self.flash_erase_time = flash_erase_time
+        self.flash_program_time = flash_program_time
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind((host, port))
+        self.sock.setblocking(0)
+        self.host, self.port = self.sock.getsockname()
+        self.simulator = FpgaSimulator(address_mask=0x7fffffff)
+        self.board_regs = {}
+        self.dsp_regs = {}
+        self.nor_flash = {}
+        self.spi_flash = {}
+        self.stats = {'requests': 0, 'responses': 0, 'dropped': 0,
+                      'reordered': 0, 'unsupported': 0}
+        self._busy_until = 0.0
+        self._down_until = 0.0
+        self._sdram_reset()
+        self._sdram_image = None
+        self._about_to_boot = False
+        self._eth_frames = 0
+        self._sensor_words = _sensor_words()
+        self._handlers = {
+            sd.WRITE_REG: self._write_reg,
+            sd.READ_REG: self._read_reg,
+            sd.WRITE_WISHBONE: self._write_wishbone,
+            sd.READ_WISHBONE: self._read_wishbone,
+            sd.BIG_WRITE_WISHBONE: self._big_write_wishbone,
+            sd.BIG_READ_WISHBONE: self._big_read_wishbone,
+            sd.GET_SENSOR_DATA: self._get_sensor_data,
+            sd.GET_EMBEDDED_SOFTWARE_VERS: self._get_embedded_software_version,
+            sd.SDRAM_RECONFIGURE: self._sdram_reconfigure,
+            sd.SDRAM_PROGRAM: self._sdram_program,
+            sd.SDRAM_PROGRAM_WISHBONE: self._sdram_program_wishbone,
+            sd.READ_FLASH_WORDS: self._read_flash_words,
+            sd.PROGRAM_FLASH_WORDS: self._program_flash_words,
+            sd.ERASE_FLASH_BLOCK: self._erase_flash_block,
+            sd.READ_SPI_PAGE: self._read_spi_page,
+            sd.PROGRAM_SPI_PAGE: self._program_spi_page,
+            sd.ERASE_SPI_SECTOR: self._erase_spi_sector,
+        }
+        self._boot(fpg is not None)
+
+    def __repr__(self):
+        return 'SkarabEmulator(%s:%i)' % (self.host, self.port)
+
+    def close(self):
+        self.sock.close()
+
+    # region --- board state ---
+
+    def _boot(self, toolflow):
+        """
+        Boot the FPGA, into the design or into the golden image.
+        """
+        if toolflow and self.fpg is not None:
+            self.simulator.load(self.fpg)
+            self.board_regs[sd.C_RD_VERSION_ADDR] = EMULATED_FIRMWARE_VERSION
+        else:
+            self.simulator.clear()
+            self.board_regs[sd.C_RD_VERSION_ADDR] = \
+                EMULATED_FIRMWARE_VERSION | GOLDEN_IMAGE_FLAG
+        self.board_regs[sd.C_RD_SOC_VERSION_ADDR] = EMULATED_SOC_VERSION
+        self._about_to_boot = False
+
+    def _sdram_reset(self):
+        self._sdram_chunks = []
+        self._sdram_expected_chunk = 1
+        self._sdram_total_chunks = 0
+
+    # endregion
+
+    # region --- request handlers ---
+    # Each takes the request's 16-bit words and raw packet and returns
+    # (response words, extra seconds of processing), or None for no
+    # response.
+
+    def _write_reg(self, words, packet):
+        board_reg, reg_addr, high, low = words[2:6]
+        regs = self.board_regs if board_reg == sd.BOARD_REG else self.dsp_regs
+        regs[reg_addr] = (high << 16) | low
+        return [board_reg, reg_addr, high, low] + [0] * 5, 0
+
+    def _read_reg(self, words, packet):
+        board_reg, reg_addr = words[2:4]
+        regs = self.board_regs if board_reg == sd.BOARD_REG else self.dsp_regs
+        high, low = _split32(regs.get(reg_addr, 0))
+        return [board_reg, reg_addr, high, low] + [0] * 5, 0
+
+    def _write_wishbone(self, words, packet):
+        addr_high, addr_low, data_high, data_low = words[2:6]
+        error = 0
+        try:
+            self.simulator.write_address((addr_high << 16) | addr_low,
+                                         packet[8:12])
+        except RuntimeError:
+            error = 1
+        return [addr_high, addr_low, data_high, data_low, error] + [0] * 4, 0
+
+    def _read_wishbone(self, words, packet):
+        addr_high, addr_low = words[2:4]
+        error = 0
+        try:
+            data = self.simulator.read_address((addr_high << 16) | addr_low, 4)
+            data_high, data_low = _to_words(data)
+        except RuntimeError:
+            error = 1
+            data_high, data_low = 0, 0
+        return [addr_high, addr_low, data_high, data_low, error] + [0] * 4, 0
+
+    def _big_write_wishbone(self, words, packet):
+        addr_high, addr_low = words[2:4]
+        data_end = 8 + (sd.MAX_WRITE_32WORDS * 4)
+        num_writes = struct.unpack('!H', packet[data_end:data_end + 2])[0]
+        error = 0
+        try:
+            self.simulator.write_address((addr_high << 16) | addr_low,
+                                         packet[8:8 + (num_writes * 4)])
+        except RuntimeError:
+            error = 1
+            num_writes = 0
+        return [addr_high, addr_low, num_writes, error] + [0] * 5, 0
+
+    def _big_read_wishbone(self, words, packet):
+        addr_high, addr_low, num_reads = words[2:5]
+        data = []
+        try:
+            data = _to_words(self.simulator.read_address(
+                (addr_high << 16) | addr_low, num_reads * 4))
+        except RuntimeError:
+            num_reads = sd.BIG_WISHBONE_READ_ERROR_CODE
+        data += [0] * ((sd.MAX_READ_32WORDS * 2) - len(data))
+        return [addr_high, addr_low, num_reads] + data, 0
+
+    def _get_sensor_data(self, words, packet):
+        return self._sensor_words + [0, 0, 0], 0
+
+    def _get_embedded_software_version(self, words, packet):
+        return list(EMULATED_EMBEDDED_SOFTWARE_VERSION) + [0] * 6, 0
+
+    def _sdram_reconfigure(self, words, packet):
+        (output_mode, clear_sdram, finished_writing, about_to_boot,
+         do_reboot, reset_read_address, clear_eth_stats, enable_debug,
+         async_read, continuity_test, continuity_low,
+         continuity_high) = words[2:14]
+        if clear_sdram:
+            self._sdram_reset()
+            self._sdram_image = None
+        if clear_eth_stats:
+            self._eth_frames = 0
+        if about_to_boot:
+            self._about_to_boot = True
+        response = [output_mode, clear_sdram, finished_writing,
+                    about_to_boot, do_reboot, reset_read_address,
+                    clear_eth_stats, enable_debug, async_read,
+                    self._eth_frames, 0, 0, 0, 0, continuity_test,
+                    continuity_low, continuity_high]
+        if do_reboot:
+            self._boot(self._about_to_boot and
+                       self._sdram_image is not None)
+            self._down_until = time.time() + self.boot_time
+        return response, 0
+
+    def _sdram_program(self, words, packet):
+        first_packet, last_packet = words[2:4]
+        if first_packet:
+            self._sdram_reset()
+        self._sdram_chunks.append(packet[8:])
+        self._eth_frames += 1
+        if last_packet:
+            self._sdram_image = ''.join(self._sdram_chunks)
+            self._sdram_reset()
+        return None
+
+    def _sdram_program_wishbone(self, words, packet):
+        chunk_id, total_chunks = words[2:4]
+        if chunk_id == 0:
+            # progska starts with an empty chunk
+            self._sdram_reset()
+            self._sdram_total_chunks = total_chunks
+        elif chunk_id == self._sdram_expected_chunk:
+            self._sdram_chunks.append(packet[8:])
+            self._sdram_expected_chunk += 1
+            self._sdram_total_chunks = total_chunks
+            self._eth_frames += 1
+            if chunk_id == total_chunks:
+                self._sdram_image = ''.join(self._sdram_chunks)
+        elif chunk_id > self._sdram_expected_chunk:
+            # from the future, the one before it was lost
+            return None
+        return [chunk_id, 0] + [0] * 7, 0
+
+    def _nor_words(self, word_address, num_words):
+        """
+        Get (block, offset) pieces of the NOR flash, allocating erased
+        blocks as they are touched.
+        """
+        pieces = []
+        byte_address = word_address * 2
+        num_bytes = num_words * 2
+        while num_bytes > 0:
+            block_idx = byte_address // NOR_BLOCK_BYTES
+            offset = byte_address % NOR_BLOCK_BYTES
+            if block_idx not in self.nor_flash:
+                self.nor_flash[block_idx] = bytearray('\xff' * NOR_BLOCK_BYTES)
+            span = min(num_bytes, NOR_BLOCK_BYTES - offset)
+            pieces.append((self.nor_flash[block_idx], offset, span))
+            byte_address += span
+            num_bytes -= span
+        return pieces
+
+    def _read_flash_words(self, words, packet):
+        addr_high, addr_low, num_words = words[2:5]
+        num_words = min(num_words, 384)
+        data = ''.join(str(block[offset:offset + span]) for block, offset, span
+                       in self._nor_words((addr_high << 16) | addr_low,
+                                          num_words))
+        read_words = _to_words(data) + [0] * (384 - num_words)
+        return [addr_high, addr_low, num_words] + read_words + [0, 0], 0
+
+    def _program_flash_words(self, words, packet):
+        (addr_high, addr_low, total_words, num_words, buffered, start,
+         finish) = words[2:9]
+        data = packet[18:18 + (num_words * 2)]
+        pos = 0
+        for block, offset, span in self._nor_words(
+                (addr_high << 16) | addr_low, len(data) // 2):
+            # programming can only clear bits
+            for ctr in range(span):
+                block[offset + ctr] &= ord(data[pos + ctr])
+            pos += span
+        return [addr_high, addr_low, total_words, num_words, buffered,
+                start, finish, 1, 0], self.flash_program_time
+
+    def _erase_flash_block(self, words, packet):
+        addr_high, addr_low = words[2:4]
+        block_idx = ((addr_high << 16) | addr_low) * 2 // NOR_BLOCK_BYTES
+        self.nor_flash.pop(block_idx, None)
+        return [addr_high, addr_low, 1] + [0] * 6, self.flash_erase_time
+
+    def _spi_page(self, address):
+        page = address >> 9
+        if page not in self.spi_flash:
+            self.spi_flash[page] = bytearray('\xff' * SPI_PAGE_BYTES)
+        return self.spi_flash[page]
+
+    def _read_spi_page(self, words, packet):
+        addr_high, addr_low, num_bytes = words[2:5]
+        num_bytes = min(num_bytes, SPI_PAGE_BYTES)
+        page = self._spi_page((addr_high << 16) | addr_low)
+        data = list(page[0:num_bytes]) + [0] * (SPI_PAGE_BYTES - num_bytes)
+        return [addr_high, addr_low, num_bytes] + data + [1, 0], 0
+
+    def _program_spi_page(self, words, packet):
+        addr_high, addr_low, num_bytes = words[2:5]
+        num_bytes = min(num_bytes, SPI_PAGE_BYTES)
+        page = self._spi_page((addr_high << 16) | addr_low)
+        # one byte per 16-bit word
+        for ctr, value in enumerate(words[5:5 + num_bytes]):
+            page[ctr] &= value & 0xff
+        verify = list(page) + [0] * (SPI_PAGE_BYTES - len(page))
+        return [addr_high, addr_low, num_bytes] + verify + [1, 0], \
+            self.flash_program_time
+
+    def _erase_spi_sector(self, words, packet):
+        addr_high, addr_low = words[2:4]
+        address = (addr_high << 16) | addr_low
+        sectors = sd.SECTOR_ADDRESS + [sd.SECTOR_ADDRESS[-1] + 0x20000]
+        for ctr in range(len(sectors) - 1):
+            if sectors[ctr] <= address < sectors[ctr + 1]:
+                for page in range(sectors[ctr] >> 9, sectors[ctr + 1] >> 9):
+                    self.spi_flash.pop(page, None)
+                break
+        return [addr_high, addr_low, 1] + [0] * 6, self.flash_erase_time
+
+    # endregion
+
+    def handle(self, packet):
+        """
+        Process one request.
+
+        :param packet: the request payload
+        :return: (response payload or None, seconds of processing)
+        """
+        words = _to_words(packet)
+        if len(words) < 2:
+            return None, 0
+        opcode = words[0]
+        handler = self._handlers.get(opcode)
+        if handler is None:
+            self.stats['unsupported'] += 1
+            LOGGER.debug('%s: unsupported opcode 0x%04x' % (self, opcode))
+            return struct.pack('!HH', UNSUPPORTED_OPCODE, words[1]), 0
+        try:
+            result = handler(words, packet)
+        except (ValueError, IndexError, struct.error) as exc:
+            LOGGER.debug('%s: bad request 0x%04x: %s' % (self, opcode, exc))
+            return None, 0
+        if result is None:
+            return None, 0
+        response, busy = result
+        response = [opcode + 1, words[1]] + response
+        return struct.pack('!%iH' % len(response), *response), busy
+
+    def receive(self, packet, now):
+        """
+        Take a request off the wire, applying the configured impairments.
+
+        :param packet: the request payload
+        :param now: the time it arrived
+        :return: (send time, response payload), or None
+        """
+        self.stats['requests'] += 1
+        if now < self._down_until:
+            return None
+        if self.drop and (random.random() < self.drop):
+            self.stats['dropped'] += 1
+            return None
+        response, busy = self.handle(packet)
+        if response is None:
+            return None
+        # requests that keep the board busy hold up the ones behind them
+        start = max(now, self._busy_until)
+        self._busy_until = start + busy
+        send_time = self._busy_until + self.delay
+        if self.jitter:
+            send_time += random.uniform(0, self.jitter)
+        if self.reorder and (random.random() < self.reorder):
+            self.stats['reordered'] += 1
+            send_time += self.reorder_delay
+        if self.drop and (random.random() < self.drop):
+            self.stats['dropped'] += 1
+            return None
+        self.stats['responses'] += 1
+        return send_time, response
+
+
+class SkarabEmulatorServer(object):
+    """
+    Runs any number of SkarabEmulators from one thread.
+    """
+    def __init__(self, emulators=None):
+        """
+
+        :param emulators: a list of SkarabEmulator instances
+        """
+        self.emulators = {}
+        self._queue = []
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        for emulator in emulators or []:
+            self.add(emulator)
+
+    def add(self, emulator):
+        """
+        Serve another emulator.
+
+        :param emulator: a SkarabEmulator
+        """
+        with self._lock:
+            self.emulators[emulator.sock] = emulator
+        return emulator
+
+    @property
+    def hosts(self):
+        """
+        :return: (host, port) for every emulator
+        """
+        return [(emulator.host, emulator.port)
+                for emulator in self.emulators.values()]
+
+    def start(self):
+        """
+        Start serving, in a daemon thread.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='SkarabEmulatorServer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, close=True):
+        """
+        Stop serving.
+
+        :param close: close the emulators' sockets too
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if close:
+            for emulator in self.emulators.values():
+                emulator.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _send_due(self, now):
+        while self._queue and (self._queue[0][0] <= now):
+            _, _, sock, payload, addr = heapq.heappop(self._queue)
+            try:
+                sock.sendto(payload, addr)
+            except socket.error as exc:
+                LOGGER.debug('Could not answer %s: %s' % (addr, exc))
+
+    def serve_forever(self):
+        """
+        Serve requests until stop() is called.
+        """
+        while not self._stop.is_set():
+            with self._lock:
+                socks = self.emulators.keys()
+            timeout = 0.1
+            if self._queue:
+                timeout = max(0.0, min(timeout,
+                                       self._queue[0][0] - time.time()))
+            try:
+                readable = select.select(socks, [], [], timeout)[0]
+            except (select.error, socket.error):
+                if self._stop.is_set():
+                    break
+                raise
+            for sock in readable:
+                emulator = self.emulators[sock]
+                # read a bounded number of packets from each socket per
+                # pass, so one busy board cannot starve the others
+                for _ in range(MAX_PACKETS_PER_PASS):
+                    try:
+                        packet, addr = sock.recvfrom(65536)
+                    except socket.error:
+                        break
+                    scheduled = emulator.receive(packet, time.time())
+                    if scheduled is not None:
+                        self._counter += 1
+                        heapq.heappush(self._queue, (
+                            scheduled[0], self._counter, sock, scheduled[1],
+                            addr))
+            self._send_due(time.time())
+
+
+def loopback_hosts(count, first='127.0.1.1'):
+    """
+    Consecutive loopback addresses, one per emulated board. Linux answers
+    on all of 127.0.0.0/8 without any setup.
+
+    :param count: how many addresses
+    :param first: the first address
+    :return: a list of address strings
+    """
+    start = struct.unpack('!I', socket.inet_aton(first))[0]
+    return [socket.inet_ntoa(struct.pack('!I', start + ctr))
+            for ctr in range(count)]
+
+# end
@@ -3,14 +3,23 @@ import struct
 import logging
 import time
 import socket
+import binascii
+
+import numpy as np
 
 import skarab_definitions as sd
 import progska
+import bitstream_cache
+from fpg_image import FpgImage
 from utils import threaded_fpga_operation as thop
 from network import IpAddress
 
 LOGGER = logging.getLogger(__name__)
 
+# byte -> the byte with its bits reversed, for str.translate
+_BIT_REVERSE_TABLE = ''.join(chr(int('{:08b}'.format(byte)[::-1], 2))
+                             for byte in range(256))
+
 
 def choose_processor(image_file):
     """
@@ -52,6 +61,14 @@ class ImageProcessor(object):
         """
         raise NotImplementedError
 
+    def make_bin_file(self):
+        """
+        Produce the .bin file, without keeping the bitstream.
+
+        :return: the name of the produced .bin file
+        """
+        return self.make_bin()[1]
+
     def write_bin(self, bitstream):
         """
 
@@ -71,29 +88,29 @@ class FpgProcessor(ImageProcessor):
         """
         :return: the name of a produced .bin file
         """
-        fpg_file = open(self.image_file, 'r')
-        fpg_contents = fpg_file.read()
-        fpg_file.close()
-
-        # scan for the end of the fpg header
-        if fpg_contents.find('?quit') == -1:
-            raise IOError('{} is not a valid fpg file!'.format(self.image_file))
-
-        # exract the bitstream portion of the file
-        bitstream_start = fpg_contents.find('?quit') + len('?quit') + 1
-        bitstream = fpg_contents[bitstream_start:]
-
-        # check if bitstream is compressed using magic number for gzip
-        if bitstream.startswith('\x1f\x8b\x08'):
-            import zlib
-            bitstream = zlib.decompress(bitstream, 16 + zlib.MAX_WBITS)
-            LOGGER.debug('Decompressing compressed bitstream.')
+        with FpgImage(self.image_file) as image:
+            if image.compressed:
+                LOGGER.debug('Decompressing compressed bitstream.')
+            bitstream = image.bitstream()
 
         if not self.extract:
             return bitstream, None
         self.write_bin(bitstream)
         return bitstream, self.bin_name
 
+    def make_bin_file(self):
+        """
+        Write the bitstream to the .bin file a chunk at a time.
+
+        :return: the name of the produced .bin file
+        """
+        LOGGER.debug('Extracting binary bitstream to {}'.format(self.bin_name))
+        with FpgImage(self.image_file) as image:
+            with open(self.bin_name, 'wb') as bin_file:
+                for chunk in image.iter_bitstream():
+                    bin_file.write(chunk)
+        return self.bin_name
+
 
 class HexProcessor(ImageProcessor):
     """
@@ -105,40 +122,44 @@ class HexProcessor(ImageProcessor):
         :return:
         """
         fptr = open(self.image_file, 'rb')  # read from
-        # for packing fpga image data into binary string use little endian
-        packer = struct.Struct('<H')
-        file_size = os.path.getsize(self.image_file)
+        contents = fptr.read()
+        fptr.close()
         # group 4 chars from the hex file to create 1 word in the bin file
         # see how many packets of 4096 words we can create without padding
         # 16384 = 4096 * 4 (since each word consists of 4 chars from the
         # hex file)
         # each char = 1 nibble = 4 bits
-        # TODO - replace i and j with meaningful loop variable names
-        bitstream = ''
-        for i in range(file_size / 16384):
-            # create packets of 4096 words
-            for j in range(4096):
-                word = fptr.read(4)
-                # pack into binary string
-                bitstream += packer.pack(int(word, 16))
+        full_size = (len(contents) / 16384) * 16384
         # entire file not processed yet. Remaining data needs to be padded to
         # a 4096 word boundary in the hex file this equates to 4096*4 bytes
 
         # get the last packet (required padding)
-        last_pkt = fptr.read().rstrip()  # strip eof '\r\n' before padding
+        last_pkt = contents[full_size:].rstrip()  # strip eof '\r\n' before padding
         last_pkt += 'f' * (16384 - len(last_pkt))  # pad to 4096 word boundary
-        # close the file
-        fptr.close()
-        # handle last data chunk
-        for wordctr in range(0, 16384, 4):
-            word = last_pkt[wordctr:wordctr + 4]  # grab 4 chars to form word
-            bitstream += packer.pack(int(word, 16))  # pack into binary string
-
+        bitstream = (self.pack_hex_words(contents[:full_size]) +
+                     self.pack_hex_words(last_pkt))
         if not self.extract:
             return bitstream, None
         self.write_bin(bitstream)
         return bitstream, self.bin_name
 
+    @staticmethod
+    def pack_hex_words(hex_chars):
+        """
+        Pack every 4 hex characters into a little-endian 16-bit word.
+
+        :param hex_chars: a string of hex characters, a multiple of 4 long
+        :return: the packed binary string
+        """
+        try:
+            words = np.frombuffer(binascii.unhexlify(hex_chars), dtype='>u2')
+            return words.astype('<u2').tostring()
+        except (TypeError, ValueError, binascii.Error):
+            # not just hex digits, let int() make what it can of each word
+            packer = struct.Struct('<H')
+            return ''.join(packer.pack(int(hex_chars[ctr:ctr + 4], 16))
+                           for ctr in range(0, len(hex_chars), 4))
+
 
 class BitProcessor(ImageProcessor):
     """
@@ -169,16 +190,7 @@ class BitProcessor(ImageProcessor):
         # i.e. given 09DC in .bit, require B039 in .bin
         # this equates to reversing the bits in each byte in the file
 
-        # for unpacking data from bit file and repacking
-        data_format = struct.Struct('!B')
-        bitstream = ''
-        for bytectr in range(len(data)):
-            # reverse bits each byte
-            byte = data_format.unpack(data[bytectr])[0]
-            bits = '{:08b}'.format(byte)
-            bits_flipped = bits[::-1]
-            byte_to_pack = int(bits_flipped, 2)
-            bitstream += data_format.pack(byte_to_pack)
+        bitstream = data.translate(_BIT_REVERSE_TABLE)
         if not self.extract:
             return bitstream, None
         self.write_bin(bitstream)
@@ -230,12 +242,49 @@ class BinProcessor(ImageProcessor):
         :param bitstream: binary bitstream to reorder
         :return: reordered_bitstream
         """
-        num_words = len(bitstream) / 2
-        data_format_pack = '<' + str(num_words) + 'H'
-        data_format_unpack = '>' + str(num_words) + 'H'
-        unpacked_format = struct.unpack(data_format_unpack, bitstream)
-        reordered_bitstream = struct.pack(data_format_pack, *unpacked_format)
-        return reordered_bitstream
+        words = np.frombuffer(bitstream, dtype='>u2')
+        return words.astype('<u2').tostring()
+
+
+def make_cached_bin(filename):
+    """
+    Get a .bin file made from an image, from the bitstream cache if it
+    is enabled.
+
+    :param filename: the .fpg, .bit, .hex or .bin image
+    :return: tuple - (name of the .bin file, True if it is a temporary
+        file the caller must remove)
+    """
+    processor = choose_processor(filename)
+    cache = bitstream_cache.get_bitstream_cache()
+    if cache.enabled:
+        try:
+            return cache.get_bin(filename, processor), False
+        except (IOError, OSError) as exc:
+            LOGGER.warning('Bitstream cache unusable, processing %s '
+                           'directly: %s' % (filename, exc))
+    binname = '/tmp/fpgstream_' + str(os.getpid()) + '.bin'
+    return processor(filename, binname).make_bin_file(), True
+
+
+def read_cached_bitstream(filename):
+    """
+    Get the processed bitstream of an image, from the bitstream cache if
+    it is enabled.
+
+    :param filename: the .fpg, .bit, .hex or .bin image
+    :return: the bitstream as a binary string
+    """
+    processor = choose_processor(filename)
+    cache = bitstream_cache.get_bitstream_cache()
+    if cache.enabled:
+        try:
+            with open(cache.get_bin(filename, processor), 'rb') as fptr:
+                return fptr.read()
+        except (IOError, OSError) as exc:
+            LOGGER.warning('Bitstream cache unusable, processing %s '
+                           'directly: %s' % (filename, exc))
+    return processor(filename, extract_to_disk=False).make_bin()[0]
 
 
 def upload_to_ram_progska(filename, fpga_list, chunk_size=1988):
@@ -246,26 +295,23 @@ def upload_to_ram_progska(filename, fpga_list, chunk_size=1988):
     :param fpga_list: a list of the CasperFpga objects
     """
     upload_start_time = time.time()
-    binname = '/tmp/fpgstream_' + str(os.getpid()) + '.bin'
-    processor = choose_processor(filename)
-    processor = processor(filename, binname)
-    binname = processor.make_bin()[1]
-    fpga_hosts = [fpga.host for fpga in fpga_list]
-
-    # clear sdram of all fpgas before uploading
-    clear_skarabs_sdram(fpga_list)
-    
     if chunk_size not in [1988, 3976, 7952]:
         raise sd.SkarabProgrammingError(
            'chunk_size can only be 1988, 3976 or 7952')
-        return 0
+    binname, temporary = make_cached_bin(filename)
+    fpga_hosts = [fpga.host for fpga in fpga_list]
+
     try:
-        retval = progska.upload(binname, fpga_hosts, str(chunk_size))
-    except RuntimeError as exc:
-        os.remove(binname)
-        raise sd.SkarabProgrammingError(
-            'progska returned error: %s' % exc.message)
-    os.remove(binname)
+        # clear sdram of all fpgas before uploading
+        clear_skarabs_sdram(fpga_list)
+        try:
+            retval = progska.upload(binname, fpga_hosts, str(chunk_size))
+        except RuntimeError as exc:
+            raise sd.SkarabProgrammingError(
+                'progska returned error: %s' % exc.message)
+    finally:
+        if temporary:
+            os.remove(binname)
     if retval != 0:
         raise sd.SkarabProgrammingError(
             'progska returned nonzero exit code: %i' % retval)
@@ -0,0 +1,583 @@
+"""
+A stand-in for the TAPCP TFTP server in a SNAP's microblaze, for
+exercising TapcpTransport without a board. Pass the server's port to
+TapcpTransport as tftp_port.
+
+TapcpServer answers TFTP requests the way the microblaze does:
+
+- name.offset.size reads and name.offset.0 writes of a memory device,
+  offset and size in hex 32-bit words
+- /fpga.offset.size for raw wishbone access
+- /flash.offset.size for the configuration flash, which is modelled as
+  sector-erasable NOR flash with erase and program times
+- /listdev, /temp and /progdev, which reboots from a flash address
+
+Like the microblaze it serves one transfer at a time, so run one server
+per emulated board. RFC 2348 block size and RFC 7440 window size options
+are negotiated, unless turned off.
+"""
+
+import os
+import time
+import socket
+import select
+import struct
+import random
+import logging
+import tempfile
+import threading
+
+import numpy as np
+
+from transport_dummy import FpgaSimulator
+from transport_tapcp import USER_FLASH_LOC, FLASH_SECTOR_SIZE
+from tftp_client import OPCODE_RRQ, OPCODE_WRQ, OPCODE_DATA, OPCODE_ACK, \
+    OPCODE_ERROR, OPCODE_OACK, DEFAULT_BLKSIZE, MAX_PACKET_SIZE
+
+LOGGER = logging.getLogger(__name__)
+
+# TFTP error codes
+ERROR_NOT_DEFINED = 0
+ERROR_FILE_NOT_FOUND = 1
+
+# the SNAP's configuration flash
+FLASH_SIZE = 0x2000000
+FLASH_PAGE_SIZE = 256
+
+# roughly the timings of the SNAP's SPI flash, seconds
+FLASH_SECTOR_ERASE_TIME = 0.15
+FLASH_PAGE_PROGRAM_TIME = 0.0005
+
+# the largest TFTP options the server agrees to
+MAX_BLKSIZE = 1468
+MAX_WINDOWSIZE = 16
+
+
+class FlashModel(object):
+    """
+    Sector-erasable NOR flash. Erased bytes read as 0xff and programming
+    can only clear bits. Sectors are only allocated once they are written.
+    """
+    def __init__(self, size=FLASH_SIZE, sector_size=FLASH_SECTOR_SIZE,
+                 page_size=FLASH_PAGE_SIZE,
+                 erase_time=FLASH_SECTOR_ERASE_TIME,
+                 page_program_time=FLASH_PAGE_PROGRAM_TIME):
+        """
+
+        :param size: the flash size, in bytes
+        :param sector_size: the erase sector size, in bytes
+        :param page_size: the program page size, in bytes
+        :param erase_time: seconds to erase a sector
+        :param page_program_time: seconds to program a page
+        """
+        self.size = size
+        self.sector_size = sector_size
+        self.page_size = page_size
+        self.erase_time = erase_time
+        self.page_program_time = page_program_time
+        self.sectors = {}
+        self.stats = {'sector_erases': 0, 'page_programs': 0}
+
+    def _check_access(self, offset, size):
+        if (offset < 0) or (offset + size > self.size):
+            raise RuntimeError('Flash access of %i bytes at 0x%x is outside '
+                               'the flash' % (size, offset))
+
+    def _pieces(self, offset, size):
+        """
+        Split an access into (sector, offset in sector, size) pieces.
+        """
+        while size > 0:
+            sector = offset // self.sector_size
+            sector_offset = offset % self.sector_size
+            span = min(size, self.sector_size - sector_offset)
+            yield sector, sector_offset, span
+            offset += span
+            size -= span
+
+    def read(self, offset, size):
+        """
+        Read bytes from the flash.
+        """
+        self._check_access(offset, size)
+        data = []
+        for sector, sector_offset, span in self._pieces(offset, size):
+            if sector in self.sectors:
+                data.append(self.sectors[sector][
+                    sector_offset:sector_offset + span].tostring())
+            else:
+                data.append('\xff' * span)
+        return ''.join(data)
+
+    def erase(self, sector):
+        """
+        Erase a sector.
+
+        :return: the seconds it takes
+        """
+        self.sectors.pop(sector, None)
+        self.stats['sector_erases'] += 1
+        return self.erase_time
+
+    def program(self, offset, data):
+        """
+        Program bytes, which can only clear bits.
+
+        :return: the seconds it takes
+        """
+        self._check_access(offset, len(data))
+        data = np.frombuffer(data, dtype=np.uint8)
+        pos = 0
+        for sector, sector_offset, span in self._pieces(offset, len(data)):
+            if sector not in self.sectors:
+                self.sectors[sector] = np.full(self.sector_size, 0xff,
+                                               dtype=np.uint8)
+            self.sectors[sector][sector_offset:sector_offset + span] &= \
+                data[pos:pos + span]
+            pos += span
+        num_pages = ((offset + len(data) - 1) // self.page_size) - \
+            (offset // self.page_size) + 1 if len(data) else 0
+        self.stats['page_programs'] += num_pages
+        return num_pages * self.page_program_time
+
+    def write(self, offset, data):
+        """
+        Write bytes as the microblaze does: every sector that starts
+        inside the write is erased first, the rest are only programmed.
+
+        :return: the seconds it takes
+        """
+        self._check_access(offset, len(data))
+        busy = 0.0
+        first = (offset + self.sector_size - 1) // self.sector_size
+        for sector in range(first, (offset + len(data) - 1) //
+                            self.sector_size + 1):
+            busy += self.erase(sector)
+        return busy + self.program(offset, data)
+
+
+def _encode_csl(memorymap):
+    """
+    Encode a memory map as the compressed sorted list /listdev returns.
+    """
+    entries = []
+    previous = ''
+    for name in sorted(memorymap.keys()):
+        common = 0
+        while (common < min(len(name), len(previous), 255)) and \
+                (name[common] == previous[common]):
+            common += 1
+        suffix = name[common:]
+        payload = struct.pack('>LLB', memorymap[name]['address'],
+                              memorymap[name]['bytes'], 0)
+        if entries:
+            entries.append(struct.pack('BB', common, len(suffix)))
+        else:
+            entries.append(struct.pack('B', len(suffix)))
+        entries.append(suffix + payload)
+        previous = name
+    body = struct.pack('B', 9) + ''.join(entries) + '\x00\x00'
+    return struct.pack('>H', len(body) + 2) + body
+
+
+class TapcpServer(object):
+    """
+    One emulated SNAP, serving TAPCP over TFTP.
+    """
+    def __init__(self, host='127.0.0.1', port=69, fpg=None, golden_fpg=None,
+                 negotiate=True, max_blksize=MAX_BLKSIZE,
+                 max_windowsize=MAX_WINDOWSIZE, delay=0.0, loss=0.0,
+                 timeout=0.1, retries=10, boot_time=0.0,
+                 flash_erase_time=FLASH_SECTOR_ERASE_TIME,
+                 flash_page_program_time=FLASH_PAGE_PROGRAM_TIME):
+        """
+
+        :param host: the address on which to listen
+        :param port: the port on which to listen, 0 for any free port
+        :param fpg: the fpg the board starts out running
+        :param golden_fpg: the fpg of the golden image, booted by a progdev
+            to address 0. Without one the board comes up unprogrammed.
+        :param negotiate: agree to blksize and windowsize options, rather
+            than ignoring them
+        :param max_blksize: the largest block size to agree to
+        :param max_windowsize: the largest window size to agree to
+        :param delay: seconds to wait before sending each packet
+        :param loss: the chance of losing each packet sent or received
+        :param timeout: seconds to wait for the client before resending
+        :param retries: resends before abandoning a transfer
+        :param boot_time: seconds the board is silent after a progdev
+        :param flash_erase_time: seconds to erase a flash sector
+        :param flash_page_program_time: seconds to program a flash page
+        """
+        self.golden_fpg = golden_fpg
+        self.negotiate = negotiate
+        self.max_blksize = max_blksize
+        self.max_windowsize = max_windowsize
+        self.delay = delay
+        self.loss = loss
+        self.timeout = timeout
+        self.retries = retries
+        self.boot_time = boot_time
+        self.temperature = 45.0
+        self.simulator = FpgaSimulator(fpg)
+        self.flash = FlashModel(erase_time=flash_erase_time,
+                                page_program_time=flash_page_program_time)
+        self.stats = {'reads': 0, 'writes': 0, 'bytes_read': 0,
+                      'bytes_written': 0, 'errors': 0, 'aborted': 0}
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.host, self.port = self.sock.getsockname()
+        self._down_until = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return 'TapcpServer(%s:%i)' % (self.host, self.port)
+
+    # region --- running ---
+
+    def start(self):
+        """
+        Start serving, in a daemon thread.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name=repr(self))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def serve_forever(self):
+        """
+        Serve requests, one transfer at a time, until stop() is called.
+        """
+        while not self._stop.is_set():
+            if not select.select([self.sock], [], [], 0.1)[0]:
+                continue
+            packet, addr = self.sock.recvfrom(MAX_PACKET_SIZE)
+            if (time.time() < self._down_until) or self._lost():
+                continue
+            if len(packet) < 2:
+                continue
+            opcode = struct.unpack('>H', packet[0:2])[0]
+            if opcode not in (OPCODE_RRQ, OPCODE_WRQ):
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.bind((self.host, 0))
+                self._transfer(sock, addr, opcode, packet[2:])
+            except socket.error as exc:
+                LOGGER.debug('%s: transfer with %s failed: %s' % (
+                    self, addr, exc))
+            finally:
+                sock.close()
+
+    # endregion
+
+    # region --- TAPCP files ---
+
+    @staticmethod
+    def _parse_filename(filename):
+        """
+        Split name.offset.size into the name, and the offset and size in
+        bytes.
+        """
+        parts = filename.rsplit('.', 2)
+        if len(parts) != 3:
+            raise ValueError('Cannot parse file name %s' % filename)
+        return parts[0], int(parts[1], 16) * 4, int(parts[2], 16) * 4
+
+    def _read_file(self, filename):
+        if filename == '/listdev':
+            return _encode_csl(self.simulator.memorymap)
+        if filename == '/temp':
+            return struct.pack('>f', self.temperature)
+        name, offset, size = self._parse_filename(filename)
+        if name == '/flash':
+            return self.flash.read(offset, size)
+        if name == '/fpga':
+            return self.simulator.read_address(offset, size)
+        return self.simulator.read(name, size, offset)
+
+    def _write_file(self, filename, data):
+        """
+        :return: the seconds the write takes
+        """
+        if filename == '/progdev':
+            return 0.0
+        name, offset, _ = self._parse_filename(filename)
+        if name == '/flash':
+            return self.flash.write(offset, data)
+        if name == '/fpga':
+            self.simulator.write_address(offset, data)
+        else:
+            self.simulator.write(name, data, offset)
+        return 0.0
+
+    def _flash_metadata(self):
+        """
+        The metadata TapcpTransport keeps at the start of the user flash.
+        """
+        meta = self.flash.read(USER_FLASH_LOC, FLASH_SECTOR_SIZE)
+        if meta.find('?end') == -1:
+            return {}
+        metadict = {}
+        for field in meta[:meta.find('?end')].split('?'):
+            args = field.split('\t')
+            if len(args) > 1:
+                metadict[args[0]] = args[1]
+        return metadict
+
+    def _boot(self, address):
+        """
+        Reboot the FPGA from a flash address. The memory map of a user
+        image comes from the fpg header written with it.
+        """
+        self.simulator.clear()
+        self._down_until = time.time() + self.boot_time
+        if address == 0:
+            if self.golden_fpg is not None:
+                self.simulator.load(self.golden_fpg)
+            return
+        meta = self._flash_metadata()
+        try:
+            if int(meta['prog_bitstream_start']) != address:
+                raise KeyError
+            header = self.flash.read(int(meta['header_start']),
+                                     int(meta['header_length']))
+        except (KeyError, ValueError, RuntimeError):
+            LOGGER.warning('%s: no known image at flash address 0x%x' % (
+                self, address))
+            return
+        fd, filename = tempfile.mkstemp(suffix='.fpg')
+        try:
+            with os.fdopen(fd, 'wb') as fptr:
+                fptr.write(header)
+            self.simulator.load(filename)
+        except RuntimeError as exc:
+            LOGGER.warning('%s: could not boot image at 0x%x: %s' % (
+                self, address, exc))
+        finally:
+            os.remove(filename)
+
+    # endregion
+
+    # region --- TFTP ---
+
+    def _lost(self):
+        return self.loss and (random.random() < self.loss)
+
+    def _send(self, sock, packet, addr):
+        if self.delay:
+            time.sleep(self.delay)
+        if not self._lost():
+            sock.sendto(packet, addr)
+
+    def _send_error(self, sock, addr, code, message):
+        self.stats['errors'] += 1
+        sock.sendto(struct.pack('>HH', OPCODE_ERROR, code) + message + '\x00',
+                    addr)
+
+    def _receive(self, sock, addr, timeout):
+        """
+        Wait for a packet from the client.
+
+        :return: (opcode, payload), or None on a timeout
+        """
+        end = time.time() + timeout
+        while True:
+            remaining = end - time.time()
+            if (remaining <= 0) or \
+                    not select.select([sock], [], [], remaining)[0]:
+                return None
+            packet, source = sock.recvfrom(MAX_PACKET_SIZE)
+            if (source != addr) or (len(packet) < 4) or self._lost():
+                continue
+            return struct.unpack('>H', packet[0:2])[0], packet[2:]
+
+    def _agree_options(self, options):
+        agreed = {}
+        if not self.negotiate:
+            return agreed
+        if 'blksize' in options:
+            agreed['blksize'] = max(8, min(options['blksize'],
+                                           self.max_blksize))
+        if 'windowsize' in options:
+            agreed['windowsize'] = max(1, min(options['windowsize'],
+                                              self.max_windowsize))
+        return agreed
+
+    def _transfer(self, sock, addr, opcode, payload):
+        fields = payload.split('\x00')
+        filename = fields[0]
+        options = {}
+        for ctr in range(2, len(fields) - 1, 2):
+            try:
+                options[fields[ctr].lower()] = int(fields[ctr + 1])
+            except ValueError:
+                pass
+        agreed = self._agree_options(options)
+        oack = None
+        if agreed:
+            oack = struct.pack('>H', OPCODE_OACK) + ''.join(
+                '%s\x00%d\x00' % item for item in sorted(agreed.items()))
+        blksize = agreed.get('blksize', DEFAULT_BLKSIZE)
+        windowsize = agreed.get('windowsize', 1)
+        if opcode == OPCODE_RRQ:
+            try:
+                data = self._read_file(filename)
+            except (RuntimeError, ValueError) as exc:
+                self._send_error(sock, addr, ERROR_FILE_NOT_FOUND, str(exc))
+                return
+            if (oack is not None) and not self._send_oack(sock, addr, oack):
+                self.stats['aborted'] += 1
+                return
+            if self._send_data(sock, addr, data, blksize, windowsize):
+                self.stats['reads'] += 1
+                self.stats['bytes_read'] += len(data)
+            else:
+                self.stats['aborted'] += 1
+        else:
+            received = self._receive_data(sock, addr, oack, blksize,
+                                          windowsize)
+            if received is None:
+                self.stats['aborted'] += 1
+                return
+            data, last_block = received
+            try:
+                busy = self._write_file(filename, data)
+            except (RuntimeError, ValueError) as exc:
+                self._send_error(sock, addr, ERROR_NOT_DEFINED, str(exc))
+                return
+            if busy:
+                time.sleep(busy)
+            self.stats['writes'] += 1
+            self.stats['bytes_written'] += len(data)
+            # a lost final ack is left to the client to retry, the
+            # microblaze does not wait around for duplicates either
+            self._send(sock, struct.pack('>HH', OPCODE_ACK, last_block), addr)
+            if filename == '/progdev':
+                self._boot(struct.unpack('>L', data[0:4])[0] << 8)
+
+    def _send_oack(self, sock, addr, oack):
+        """
+        Send our options until the client acknowledges them.
+        """
+        for _ in range(self.retries + 1):
+            self._send(sock, oack, addr)
+            received = self._receive(sock, addr, self.timeout)
+            if received is None:
+                continue
+            opcode, payload = received
+            if opcode == OPCODE_ERROR:
+                return False
+            if (opcode == OPCODE_ACK) and \
+                    (struct.unpack('>H', payload[0:2])[0] == 0):
+                return True
+        return False
+
+    def _send_data(self, sock, addr, data, blksize, windowsize):
+        """
+        Send a file a window of blocks at a time.
+        """
+        num_blocks = (len(data) // blksize) + 1
+        acked = 0
+        tries = 0
+        while acked < num_blocks:
+            window_end = min(acked + windowsize, num_blocks)
+            for block in range(acked + 1, window_end + 1):
+                start = (block - 1) * blksize
+                self._send(sock, struct.pack('>HH', OPCODE_DATA,
+                                             block & 0xffff) +
+                           data[start:start + blksize], addr)
+            while True:
+                received = self._receive(sock, addr, self.timeout)
+                if received is None:
+                    tries += 1
+                    if tries > self.retries:
+                        return False
+                    break
+                opcode, payload = received
+                if opcode == OPCODE_ERROR:
+                    return False
+                if opcode != OPCODE_ACK:
+                    continue
+                ack = struct.unpack('>H', payload[0:2])[0]
+                offset = (ack - acked) & 0xffff
+                if offset == 0 or offset > window_end - acked:
+                    continue
+                # the client may ack part of the window, send on from there
+                acked += offset
+                tries = 0
+                break
+        return True
+
+    def _receive_data(self, sock, addr, oack, blksize, windowsize):
+        """
+        Receive a file, acknowledging every window of blocks. The final
+        block is left for the caller to acknowledge once it is written.
+
+        :return: (the data, the number of the final block), or None
+        """
+        last_packet = oack or struct.pack('>HH', OPCODE_ACK, 0)
+        self._send(sock, last_packet, addr)
+        chunks = []
+        expected = 1
+        in_window = 0
+        resyncing = False
+        tries = 0
+        while True:
+            received = self._receive(sock, addr, self.timeout)
+            if received is None:
+                tries += 1
+                if tries > self.retries:
+                    return None
+                self._send(sock, last_packet, addr)
+                in_window = 0
+                resyncing = False
+                continue
+            opcode, payload = received
+            if opcode == OPCODE_ERROR:
+                return None
+            if opcode != OPCODE_DATA:
+                continue
+            block = struct.unpack('>H', payload[0:2])[0]
+            if block != expected & 0xffff:
+                if not resyncing:
+                    last_packet = struct.pack('>HH', OPCODE_ACK,
+                                              (expected - 1) & 0xffff)
+                    self._send(sock, last_packet, addr)
+                    resyncing = True
+                in_window = 0
+                continue
+            resyncing = False
+            tries = 0
+            chunks.append(payload[2:])
+            if len(payload) - 2 < blksize:
+                return ''.join(chunks), block
+            in_window += 1
+            if in_window >= windowsize:
+                last_packet = struct.pack('>HH', OPCODE_ACK, block)
+                self._send(sock, last_packet, addr)
+                in_window = 0
+            expected += 1
+
+    # endregion
+
+# end
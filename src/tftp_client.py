@@ -0,0 +1,393 @@
+"""
+A small TFTP client for bulk TAPCP transfers, with RFC 2348 block size and
+RFC 7440 window size negotiation. tftpy knows nothing of window sizes, and
+lock-step 512-byte blocks make large flash and BRAM transfers slow.
+
+Servers that ignore or refuse the options are handled by falling back to
+plain RFC 1350 transfers.
+"""
+
+import socket
+import select
+import struct
+import time
+import logging
+
+from transport_stats import TransportStats
+
+LOGGER = logging.getLogger(__name__)
+
+OPCODE_RRQ = 1
+OPCODE_WRQ = 2
+OPCODE_DATA = 3
+OPCODE_ACK = 4
+OPCODE_ERROR = 5
+OPCODE_OACK = 6
+
+# RFC 2347 error code for a refused option negotiation
+ERROR_OPTION_REFUSED = 8
+
+DEFAULT_BLKSIZE = 512
+DEFAULT_WINDOWSIZE = 1
+MAX_PACKET_SIZE = 65536
+
+# after a request with options goes unanswered, make plain requests for
+# this many seconds before asking for the options again, doubling each
+# time it happens again, up to OPTIONS_BACKOFF_MAX
+OPTIONS_BACKOFF = 1.0
+OPTIONS_BACKOFF_MAX = 60.0
+
+
+class TftpError(RuntimeError):
+    """A TFTP transfer failed."""
+    pass
+
+
+class TftpTimeout(TftpError):
+    """The server stopped answering."""
+    def __init__(self, message, no_answer=False):
+        """
+
+        :param message: the error message
+        :param no_answer: True if the server never answered the request
+        """
+        super(TftpTimeout, self).__init__(message)
+        self.no_answer = no_answer
+
+
+class TftpOptionRefused(TftpError):
+    """The server refused the requested options."""
+    pass
+
+
+class WindowedTftpClient(object):
+    """
+    A TFTP client that asks the server for larger blocks and for several
+    blocks in flight per acknowledgement.
+
+    The download and upload calls match those of tftpy.TftpClient.
+    """
+    def __init__(self, host, port=69, blksize=DEFAULT_BLKSIZE,
+                 windowsize=DEFAULT_WINDOWSIZE, retries=3, metrics=None):
+        """
+
+        :param host: the server hostname
+        :param port: the server port
+        :param blksize: the data block size to ask for, in bytes
+        :param windowsize: how many blocks to ask for per acknowledgement
+        :param retries: how many times to resend a packet before giving up
+        :param metrics: a TransportStats in which to count packets, e.g.
+            that of the owning transport
+        """
+        self.host = host
+        self.port = port
+        self.blksize = blksize
+        self.windowsize = windowsize
+        self.retries = retries
+        self.metrics = metrics if metrics is not None else TransportStats()
+        # set once the server has refused or ignored our options, after
+        # that we only make plain requests
+        self.options_refused = False
+        # plain requests until this time.time(), after an unanswered
+        # request with options
+        self._options_retry_at = 0
+        self._options_backoff = OPTIONS_BACKOFF
+        # the options agreed for the last transfer
+        self.options = {'blksize': DEFAULT_BLKSIZE,
+                        'windowsize': DEFAULT_WINDOWSIZE}
+
+    def _requested_options(self):
+        if self.options_refused or (time.time() < self._options_retry_at):
+            return {}
+        options = {}
+        if self.blksize != DEFAULT_BLKSIZE:
+            options['blksize'] = self.blksize
+        if self.windowsize != DEFAULT_WINDOWSIZE:
+            options['windowsize'] = self.windowsize
+        return options
+
+    @staticmethod
+    def _request_packet(opcode, filename, options):
+        packet = struct.pack('>H', opcode) + '%s\x00octet\x00' % filename
+        for option, value in sorted(options.items()):
+            packet += '%s\x00%d\x00' % (option, value)
+        return packet
+
+    @staticmethod
+    def _parse_oack(payload):
+        fields = payload.split('\x00')
+        options = {}
+        for ctr in range(0, len(fields) - 1, 2):
+            options[fields[ctr].lower()] = int(fields[ctr + 1])
+        return options
+
+    def _accept_oack(self, payload, requested):
+        """
+        Check the options the server acknowledged and use them.
+        """
+        options = self._parse_oack(payload)
+        agreed = {'blksize': DEFAULT_BLKSIZE, 'windowsize': DEFAULT_WINDOWSIZE}
+        for option, value in options.items():
+            if (option not in requested) or (value < 1) or \
+                    (value > requested[option]):
+                raise TftpError('Server acknowledged bad option %s=%d' % (
+                    option, value))
+            agreed[option] = value
+        self.options = agreed
+        self._options_backoff = OPTIONS_BACKOFF
+
+    def _options_ignored(self, options):
+        """
+        The server answered a request with options without an OACK, so it
+        does not do options. Make plain requests from now on.
+        """
+        if options and not self.options_refused:
+            LOGGER.info('%s: TFTP server ignored options %s, making plain '
+                        'requests from now on' % (self.host, options))
+            self.options_refused = True
+
+    @staticmethod
+    def _raise_error(payload):
+        code = struct.unpack('>H', payload[0:2])[0]
+        message = payload[2:].rstrip('\x00')
+        if code == ERROR_OPTION_REFUSED:
+            raise TftpOptionRefused(message)
+        raise TftpError('TFTP error %d: %s' % (code, message))
+
+    def _send(self, sock, packet, addr):
+        sock.sendto(packet, addr)
+        self.metrics.sent(len(packet))
+
+    def _receive(self, sock, server, timeout):
+        """
+        Wait for a packet from the server.
+
+        :return: (opcode, payload, address), or None on a timeout
+        """
+        while True:
+            ready = select.select([sock], [], [], timeout)[0]
+            if not ready:
+                self.metrics.timeout()
+                return None
+            packet, addr = sock.recvfrom(MAX_PACKET_SIZE)
+            self.metrics.received(len(packet))
+            if (server[1] is not None) and (addr != server):
+                # not from our transfer, RFC 1350 says to ignore it
+                self.metrics.discard('wrong_host')
+                continue
+            if len(packet) < 2:
+                self.metrics.discard('wrong_size')
+                continue
+            return struct.unpack('>H', packet[0:2])[0], packet[2:], addr
+
+    def _transfer(self, func, filename, fileobj, timeout):
+        """
+        Run a transfer with our options, and again without them if the
+        server refuses them or does not answer a request with options.
+
+        A refusal is remembered for good. An unanswered request may just
+        have been lost, so the options are only left out for a back-off
+        that grows while requests with them keep going unanswered.
+        """
+        options = self._requested_options()
+        try:
+            return func(filename, fileobj, timeout, options)
+        except (TftpOptionRefused, TftpTimeout) as exc:
+            if not options:
+                raise
+            if isinstance(exc, TftpTimeout) and not exc.no_answer:
+                # the server answered, so the options were not the problem
+                raise
+            if isinstance(exc, TftpOptionRefused):
+                LOGGER.info('%s: TFTP options %s refused (%s), falling back '
+                            'to plain transfers' % (self.host, options,
+                                                    exc.args[0]))
+                self.options_refused = True
+            else:
+                LOGGER.info('%s: no answer to TFTP options %s, making plain '
+                            'requests for %.1fs' % (self.host, options,
+                                                    self._options_backoff))
+                self._options_retry_at = time.time() + self._options_backoff
+                self._options_backoff = min(self._options_backoff * 2,
+                                            OPTIONS_BACKOFF_MAX)
+            if hasattr(fileobj, 'seek'):
+                fileobj.seek(0)
+            return func(filename, fileobj, timeout, {})
+
+    def download(self, filename, output, timeout=1.0):
+        """
+        Read a file from the server.
+
+        :param filename: the file to read
+        :param output: a file-like object to which to write the data
+        :param timeout: how long to wait for each packet, in seconds
+        """
+        self._transfer(self._download, filename, output, timeout)
+
+    def upload(self, filename, input, timeout=1.0):
+        """
+        Write a file to the server.
+
+        :param filename: the file to write
+        :param input: a file-like object from which to read the data
+        :param timeout: how long to wait for each packet, in seconds
+        """
+        self._transfer(self._upload, filename, input, timeout)
+
+    def _download(self, filename, output, timeout, options):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            server = (socket.gethostbyname(self.host), None)
+            self.options = {'blksize': DEFAULT_BLKSIZE,
+                            'windowsize': DEFAULT_WINDOWSIZE}
+            last_packet = self._request_packet(OPCODE_RRQ, filename, options)
+            self._send(sock, last_packet, (server[0], self.port))
+            dest = (server[0], self.port)
+            expected = 1
+            in_window = 0
+            resyncing = False
+            # whether the server has answered the options yet
+            negotiated = not options
+            tries = 0
+            while True:
+                received = self._receive(sock, server, timeout)
+                if received is None:
+                    tries += 1
+                    if tries > self.retries:
+                        raise TftpTimeout('Timed out reading %s from %s' % (
+                            filename, self.host), server[1] is None)
+                    # resend the request or our last ack
+                    self._send(sock, last_packet, dest)
+                    self.metrics.retransmit()
+                    in_window = 0
+                    resyncing = False
+                    continue
+                opcode, payload, addr = received
+                if server[1] is None:
+                    server = addr
+                    dest = addr
+                if opcode == OPCODE_ERROR:
+                    self._raise_error(payload)
+                elif opcode == OPCODE_OACK:
+                    if expected != 1:
+                        self.metrics.discard('duplicate')
+                        continue
+                    self._accept_oack(payload, options)
+                    negotiated = True
+                    last_packet = struct.pack('>HH', OPCODE_ACK, 0)
+                    self._send(sock, last_packet, dest)
+                    tries = 0
+                elif opcode == OPCODE_DATA:
+                    if not negotiated:
+                        self._options_ignored(options)
+                        negotiated = True
+                    block = struct.unpack('>H', payload[0:2])[0]
+                    data = payload[2:]
+                    if block != expected & 0xffff:
+                        # lost or reordered block, ack what we have so the
+                        # server restarts the window from there. Only do
+                        # that once per gap, the rest of the window is
+                        # still on its way.
+                        self.metrics.discard('wrong_seq')
+                        if not resyncing:
+                            last_packet = struct.pack(
+                                '>HH', OPCODE_ACK, (expected - 1) & 0xffff)
+                            self._send(sock, last_packet, dest)
+                            resyncing = True
+                        in_window = 0
+                        continue
+                    resyncing = False
+                    output.write(data)
+                    tries = 0
+                    in_window += 1
+                    last_block = len(data) < self.options['blksize']
+                    if last_block or \
+                            (in_window >= self.options['windowsize']):
+                        last_packet = struct.pack('>HH', OPCODE_ACK,
+                                                  block)
+                        self._send(sock, last_packet, dest)
+                        in_window = 0
+                    if last_block:
+                        return
+                    expected += 1
+        finally:
+            sock.close()
+
+    def _upload(self, filename, input, timeout, options):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            server = (socket.gethostbyname(self.host), None)
+            self.options = {'blksize': DEFAULT_BLKSIZE,
+                            'windowsize': DEFAULT_WINDOWSIZE}
+            request = self._request_packet(OPCODE_WRQ, filename, options)
+            self._send(sock, request, (server[0], self.port))
+            # wait for the server to accept the request
+            tries = 0
+            while True:
+                received = self._receive(sock, server, timeout)
+                if received is None:
+                    tries += 1
+                    if tries > self.retries:
+                        raise TftpTimeout('Timed out writing %s to %s' % (
+                            filename, self.host), True)
+                    self._send(sock, request, (server[0], self.port))
+                    self.metrics.retransmit()
+                    continue
+                opcode, payload, server = received
+                if opcode == OPCODE_ERROR:
+                    self._raise_error(payload)
+                elif opcode == OPCODE_OACK:
+                    self._accept_oack(payload, options)
+                    break
+                elif (opcode == OPCODE_ACK) and \
+                        (struct.unpack('>H', payload[0:2])[0] == 0):
+                    self._options_ignored(options)
+                    break
+            blksize = self.options['blksize']
+            windowsize = self.options['windowsize']
+            data = input.read()
+            # there is always a final short block, even if it is empty
+            num_blocks = (len(data) // blksize) + 1
+            acked = 0
+            # the highest block sent, blocks up to it that are sent again
+            # are retransmits
+            highest = 0
+            tries = 0
+            while acked < num_blocks:
+                window_end = min(acked + windowsize, num_blocks)
+                for block in range(acked + 1, window_end + 1):
+                    start = (block - 1) * blksize
+                    self._send(sock, struct.pack('>HH', OPCODE_DATA,
+                                                 block & 0xffff) +
+                               data[start:start + blksize], server)
+                if highest > acked:
+                    self.metrics.retransmit(min(highest, window_end) - acked)
+                highest = max(highest, window_end)
+                while True:
+                    received = self._receive(sock, server, timeout)
+                    if received is None:
+                        tries += 1
+                        if tries > self.retries:
+                            raise TftpTimeout('Timed out writing %s to '
+                                              '%s' % (filename, self.host),
+                                              False)
+                        break
+                    opcode, payload, _ = received
+                    if opcode == OPCODE_ERROR:
+                        self._raise_error(payload)
+                    if opcode != OPCODE_ACK:
+                        continue
+                    ack = struct.unpack('>H', payload[0:2])[0]
+                    # work out which block in this window was acked
+                    offset = (ack - acked) & 0xffff
+                    if offset == 0 or offset > window_end - acked:
+                        # a duplicate or stale ack
+                        self.metrics.discard('wrong_seq')
+                        continue
+                    acked += offset
+                    tries = 0
+                    break
+        finally:
+            sock.close()
+
+# end
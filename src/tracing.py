@@ -0,0 +1,520 @@
+"""
+Trace the register accesses that high-level operations generate.
+
+Trace hooks are callables added to a CasperFpga with add_trace_hook. They
+are called with a TraceEvent for every read and write through the
+CasperFpga, and for every request the transport sends. TraceRecorder is a
+hook that writes the events to a compact binary file:
+
+    with tracing.record_trace([fpga], 'gbe.trace'):
+        fpga.gbes.gbe0.get_gbe_core_details()
+
+read_trace reads the file back. analyse_trace finds redundant reads,
+runs of adjacent accesses that could have been one request, and the time
+spent per call site. simulate_trace estimates how long the trace would
+take with those fixed, and replay_trace re-issues its reads on a board.
+"""
+
+import sys
+import os
+import time
+import zlib
+import struct
+import threading
+import contextlib
+from collections import namedtuple
+
+LAYER_FPGA = 0
+LAYER_TRANSPORT = 1
+LAYER_NAMES = {LAYER_FPGA: 'casperfpga', LAYER_TRANSPORT: 'transport'}
+
+# the address of an event whose address is not known
+NO_ADDRESS = 0xffffffff
+
+TRACE_MAGIC = 'CFTRACE\x01'
+RECORD_STRING = 1
+RECORD_EVENT = 2
+# kind, string id, length
+STRING_HEADER = struct.Struct('<BHH')
+# kind, layer, op, host, device, site, address, size, start, duration,
+# ok, crc
+EVENT_RECORD = struct.Struct('<BBHHHHIIdfBI')
+
+# frames in these files are skipped when looking for the call site
+TRACE_SKIP_FILES = ('casperfpga.py', 'memory.py', 'register.py',
+                    'tracing.py', 'transport.py', 'transport_dummy.py',
+                    'transport_katcp.py', 'transport_skarab.py',
+                    'transport_tapcp.py', 'transport_itpm.py', 'fleet.py',
+                    'utils.py', 'threading.py', 'thread.py')
+
+TraceEvent = namedtuple('TraceEvent', ['layer', 'op', 'host', 'device',
+                                       'address', 'size', 'start',
+                                       'duration', 'ok', 'crc', 'site'])
+
+
+def call_site(skip_files=TRACE_SKIP_FILES):
+    """
+    Find the code that made a traced call: the first frame up the stack
+    that is not in one of skip_files.
+
+    :return: 'file:line function'
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.basename(frame.f_code.co_filename)
+        if (filename not in skip_files) and \
+                not filename.startswith('futures'):
+            return '%s:%i %s' % (filename, frame.f_lineno,
+                                 frame.f_code.co_name)
+        frame = frame.f_back
+    return '<unknown>'
+
+
+def device_address(memory_devices, device_name, offset=0):
+    """
+    The bus address of an offset into a memory device.
+
+    :param memory_devices: a dictionary of memory devices, None before
+        the design is known
+    :return: the address, or NO_ADDRESS if the device is not known
+    """
+    try:
+        return memory_devices[device_name].address + offset
+    except (KeyError, TypeError, AttributeError):
+        return NO_ADDRESS
+
+
+def crc(data):
+    """
+    The CRC32 of data read or written, 0 for anything else.
+    """
+    if isinstance(data, (str, bytearray)):
+        return zlib.crc32(str(data)) & 0xffffffff
+    return 0
+
+
+def emit(hooks, event):
+    """
+    Pass an event to every hook.
+    """
+    for hook in hooks:
+        hook(event)
+
+
+def traced_call(hooks, layer, op, host, device, address, size, payload,
+                func, *args, **kwargs):
+    """
+    Call func and pass a TraceEvent for the call to the hooks.
+
+    :param hooks: a list of trace hooks
+    :param layer: LAYER_FPGA or LAYER_TRANSPORT
+    :param op: the operation, e.g. read or blindwrite
+    :param host: the board
+    :param device: the memory device, or '' if not known
+    :param address: the bus address, or NO_ADDRESS if not known
+    :param size: the number of bytes read or written
+    :param payload: data written, its CRC is recorded. For reads, None,
+        the CRC of the data read is recorded.
+    :param func: the function to call with args and kwargs
+    :return: what func returns
+    """
+    site = call_site()
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        emit(hooks, TraceEvent(layer, op, host, device, address, size, start,
+                               time.time() - start, False, 0, site))
+        raise
+    emit(hooks, TraceEvent(layer, op, host, device, address, size, start,
+                           time.time() - start, True,
+                           crc(result if payload is None else payload),
+                           site))
+    return result
+
+
+class TraceRecorder(object):
+    """
+    A trace hook that writes events to a binary trace file.
+
+    The file holds string records, which give strings an id the first
+    time they are used, and fixed-size event records that refer to them.
+    """
+    def __init__(self, filename):
+        """
+
+        :param filename: the trace file to write
+        """
+        self.filename = filename
+        self._fptr = open(filename, 'wb')
+        self._fptr.write(TRACE_MAGIC)
+        self._strings = {}
+        self._lock = threading.Lock()
+        self.num_events = 0
+
+    def _string_id(self, value):
+        try:
+            return self._strings[value]
+        except KeyError:
+            pass
+        string_id = len(self._strings)
+        if string_id > 0xffff:
+            raise RuntimeError('Too many distinct strings in trace %s' %
+                               self.filename)
+        self._fptr.write(STRING_HEADER.pack(RECORD_STRING, string_id,
+                                            len(value)) + value)
+        self._strings[value] = string_id
+        return string_id
+
+    def __call__(self, event):
+        with self._lock:
+            if self._fptr is None:
+                return
+            self._fptr.write(EVENT_RECORD.pack(
+                RECORD_EVENT, event.layer, self._string_id(event.op),
+                self._string_id(event.host), self._string_id(event.device),
+                self._string_id(event.site), event.address & 0xffffffff,
+                event.size, event.start, event.duration,
+                1 if event.ok else 0, event.crc))
+            self.num_events += 1
+
+    def close(self):
+        with self._lock:
+            if self._fptr is not None:
+                self._fptr.close()
+                self._fptr = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+@contextlib.contextmanager
+def record_trace(fpgas, filename, transport=True):
+    """
+    Record the accesses made to some boards while the context is open.
+
+    :param fpgas: a list of CasperFpga objects
+    :param filename: the trace file to write
+    :param transport: record transport requests as well as CasperFpga
+        reads and writes
+    :return: the TraceRecorder
+    """
+    recorder = TraceRecorder(filename)
+    for fpga in fpgas:
+        fpga.add_trace_hook(recorder, transport=transport)
+    try:
+        yield recorder
+    finally:
+        for fpga in fpgas:
+            fpga.remove_trace_hook(recorder)
+        recorder.close()
+
+
+def read_trace(filename):
+    """
+    Read a trace file.
+
+    :param filename: the file written by a TraceRecorder
+    :return: a list of TraceEvents, in the order they were recorded
+    """
+    with open(filename, 'rb') as fptr:
+        data = fptr.read()
+    if data[0:len(TRACE_MAGIC)] != TRACE_MAGIC:
+        raise RuntimeError('%s is not a casperfpga trace file' % filename)
+    strings = {}
+    events = []
+    pos = len(TRACE_MAGIC)
+    while pos < len(data):
+        kind = ord(data[pos])
+        if kind == RECORD_STRING:
+            _, string_id, length = STRING_HEADER.unpack_from(data, pos)
+            pos += STRING_HEADER.size
+            strings[string_id] = data[pos:pos + length]
+            pos += length
+        elif kind == RECORD_EVENT:
+            (_, layer, op, host, device, site, address, size, start,
+             duration, ok, crc) = EVENT_RECORD.unpack_from(data, pos)
+            pos += EVENT_RECORD.size
+            events.append(TraceEvent(layer, strings[op], strings[host],
+                                     strings[device], address, size, start,
+                                     duration, ok == 1, crc, strings[site]))
+        else:
+            raise RuntimeError('%s: unknown record type %i at byte %i' % (
+                filename, kind, pos))
+    return events
+
+
+def _is_write(event):
+    return 'write' in event.op.lower()
+
+
+def _request_key(event):
+    """
+    Identify the request an event went out in. The reads of one
+    read_many call have an event each, but share a request.
+    """
+    if event.op == 'read_many':
+        return event.host, event.site, event.start
+    return id(event)
+
+
+def _num_requests(events):
+    """
+    How many requests a list of events went out in.
+    """
+    return len(set(_request_key(event) for event in events))
+
+
+def _group_requests(events):
+    """
+    Group events into the requests they went out in, in order.
+
+    :return: a list of requests, each a list of events
+    """
+    requests = []
+    # request key -> its list in requests
+    grouped = {}
+    for event in events:
+        key = _request_key(event)
+        if key not in grouped:
+            grouped[key] = []
+            requests.append(grouped[key])
+        grouped[key].append(event)
+    return requests
+
+
+def _adjacent_runs(events, max_gap=0):
+    """
+    Find runs of consecutive accesses, per board, to neighbouring
+    addresses, that could have been one request. Accesses inside the
+    span a run already covers are re-reads, not neighbours, and a run
+    within a single read_many call was one request already.
+
+    :return: a list of runs, each a list of events
+    """
+    runs = []
+    # (host, is write) -> [span start, span end, events]
+    last = {}
+    for event in events:
+        if event.address == NO_ADDRESS:
+            continue
+        key = (event.host, _is_write(event))
+        start, end = event.address, event.address + event.size
+        run = last.get(key)
+        if run is not None:
+            touches = (start <= run[1] + max_gap) and \
+                (end >= run[0] - max_gap)
+            inside = (start >= run[0]) and (end <= run[1])
+            if touches and not inside:
+                run[0] = min(run[0], start)
+                run[1] = max(run[1], end)
+                run[2].append(event)
+                continue
+            if _num_requests(run[2]) > 1:
+                runs.append(run[2])
+        last[key] = [start, end, [event]]
+    runs.extend(run[2] for run in last.values()
+                if _num_requests(run[2]) > 1)
+    runs.sort(key=lambda run: run[0].start)
+    return runs
+
+
+def _redundant_reads(events):
+    """
+    Find reads that returned the same data as the previous read of the
+    same address, with no write to the device in between. Events that do
+    not know their data have a CRC of 0, so any repeat of them counts.
+
+    :return: a list of the redundant read events
+    """
+    redundant = []
+    # (host, device, address, size) -> crc of the last read
+    last_read = {}
+    # (host, device) -> keys in last_read
+    device_keys = {}
+    for event in events:
+        if not event.ok:
+            continue
+        if _is_write(event):
+            for key in device_keys.pop((event.host, event.device), []):
+                last_read.pop(key, None)
+            continue
+        key = (event.host, event.device, event.address, event.size)
+        if last_read.get(key) == event.crc:
+            redundant.append(event)
+        last_read[key] = event.crc
+        device_keys.setdefault((event.host, event.device), set()).add(key)
+    return redundant
+
+
+def analyse_trace(events, layer=LAYER_FPGA, max_gap=0):
+    """
+    Look for batching opportunities in a trace.
+
+    :param events: a list of TraceEvents
+    :param layer: analyse the accesses at this layer
+    :param max_gap: accesses this many bytes apart still count as adjacent
+    :return: a dictionary with:
+        sites: call site -> {calls, time, bytes}
+        redundant: (host, device) -> {reads, time}
+        adjacent: call site -> {runs, requests, saved_requests, time}
+        and the totals: events, time, redundant_reads, saved_requests
+    """
+    events = [event for event in events if event.layer == layer]
+    sites = {}
+    for event in events:
+        site = sites.setdefault(event.site, {'calls': 0, 'time': 0.0,
+                                             'bytes': 0})
+        site['calls'] += 1
+        site['time'] += event.duration
+        site['bytes'] += event.size
+    redundant = {}
+    redundant_events = _redundant_reads(events)
+    for event in redundant_events:
+        entry = redundant.setdefault((event.host, event.device),
+                                     {'reads': 0, 'time': 0.0})
+        entry['reads'] += 1
+        entry['time'] += event.duration
+    adjacent = {}
+    saved_requests = 0
+    for run in _adjacent_runs(events, max_gap):
+        entry = adjacent.setdefault(run[0].site, {
+            'runs': 0, 'requests': 0, 'saved_requests': 0, 'time': 0.0})
+        requests = _num_requests(run)
+        entry['runs'] += 1
+        entry['requests'] += requests
+        entry['saved_requests'] += requests - 1
+        entry['time'] += sum(event.duration for event in run)
+        saved_requests += requests - 1
+    return {'events': len(events),
+            'time': sum(event.duration for event in events),
+            'sites': sites,
+            'redundant': redundant,
+            'redundant_reads': len(redundant_events),
+            'adjacent': adjacent,
+            'saved_requests': saved_requests}
+
+
+def simulate_trace(events, latency, bandwidth=0, layer=LAYER_FPGA,
+                   max_gap=0):
+    """
+    Estimate how long a trace takes on a link with a fixed latency per
+    request, as recorded, without its redundant reads, and with its
+    adjacent accesses coalesced as well.
+
+    :param events: a list of TraceEvents
+    :param latency: seconds per request
+    :param bandwidth: bytes per second, 0 for unlimited
+    :param layer: simulate the accesses at this layer
+    :param max_gap: accesses this many bytes apart still count as adjacent
+    :return: a dictionary of {requests, time} for each of recorded,
+        no_redundant and coalesced
+    """
+    events = [event for event in events if event.layer == layer]
+
+    def cost(requests, nbytes):
+        return {'requests': requests,
+                'time': (requests * latency) +
+                        (float(nbytes) / bandwidth if bandwidth else 0.0)}
+
+    nbytes = sum(event.size for event in events)
+    recorded = cost(_num_requests(events), nbytes)
+    redundant = set(id(event) for event in _redundant_reads(events))
+    remaining = [event for event in events if id(event) not in redundant]
+    no_redundant = cost(_num_requests(remaining),
+                        sum(event.size for event in remaining))
+    saved = sum(_num_requests(run) - 1
+                for run in _adjacent_runs(remaining, max_gap))
+    coalesced = cost(_num_requests(remaining) - saved,
+                     sum(event.size for event in remaining))
+    return {'recorded': recorded, 'no_redundant': no_redundant,
+            'coalesced': coalesced}
+
+
+def replay_trace(events, fpga, host=None, coalesce=False, max_gap=0):
+    """
+    Re-issue the reads in a trace on a board. Writes are not replayed,
+    the trace does not hold the data written.
+
+    :param events: a list of TraceEvents
+    :param fpga: the CasperFpga on which to replay
+    :param host: only replay the events of this host, all if None
+    :param coalesce: issue each run of adjacent reads as one read_many
+    :param max_gap: reads this many bytes apart still count as adjacent
+    :return: a dictionary of {requests, time} for the recorded and the
+        replayed reads
+    """
+    reads = [event for event in events if (event.layer == LAYER_FPGA) and
+             not _is_write(event) and event.ok and
+             ((host is None) or (event.host == host))]
+    if coalesce:
+        grouped = set()
+        batches = []
+        for run in _adjacent_runs(reads, max_gap):
+            batches.append(run)
+            grouped.update(id(event) for event in run)
+        batches.extend(_group_requests([event for event in reads
+                                        if id(event) not in grouped]))
+        batches.sort(key=lambda batch: batch[0].start)
+    else:
+        batches = _group_requests(reads)
+    start = time.time()
+    for batch in batches:
+        if len(batch) == 1:
+            event = batch[0]
+            fpga.read(event.device, event.size,
+                      _device_offset(fpga, event))
+        else:
+            fpga.read_many([(event.device, event.size,
+                             _device_offset(fpga, event))
+                            for event in batch])
+    return {'recorded': {'requests': _num_requests(reads),
+                         'time': sum(event.duration for event in reads)},
+            'replayed': {'requests': len(batches),
+                         'time': time.time() - start}}
+
+
+def _device_offset(fpga, event):
+    if event.address == NO_ADDRESS:
+        return 0
+    return event.address - fpga.memory_devices[event.device].address
+
+
+def format_analysis(analysis, top=10):
+    """
+    Format the result of analyse_trace for printing.
+
+    :param analysis: the dictionary from analyse_trace
+    :param top: how many entries to show in each table
+    """
+    lines = ['%i accesses, %.3f s in total, %i redundant reads, %i '
+             'requests could be saved by coalescing' % (
+                 analysis['events'], analysis['time'],
+                 analysis['redundant_reads'], analysis['saved_requests']),
+             '', 'Time per call site:']
+    sites = sorted(analysis['sites'].items(),
+                   key=lambda item: item[1]['time'], reverse=True)
+    for site, entry in sites[0:top]:
+        lines.append('  %9.3f ms %7i calls %10i bytes  %s' % (
+            entry['time'] * 1000, entry['calls'], entry['bytes'], site))
+    lines.extend(['', 'Redundant reads:'])
+    redundant = sorted(analysis['redundant'].items(),
+                       key=lambda item: item[1]['time'], reverse=True)
+    for (host, device), entry in redundant[0:top]:
+        lines.append('  %9.3f ms %7i reads  %s %s' % (
+            entry['time'] * 1000, entry['reads'], host, device))
+    lines.extend(['', 'Adjacent accesses that could be coalesced:'])
+    adjacent = sorted(analysis['adjacent'].items(),
+                      key=lambda item: item[1]['saved_requests'],
+                      reverse=True)
+    for site, entry in adjacent[0:top]:
+        lines.append('  %7i requests in %5i runs, %7i could be saved, '
+                     '%9.3f ms  %s' % (entry['requests'], entry['runs'],
+                                       entry['saved_requests'],
+                                       entry['time'] * 1000, site))
+    return '\n'.join(lines)
+
+# end
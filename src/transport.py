@@ -1,4 +1,5 @@
 from utils import get_hostname
+from transport_stats import TransportStats
 
 
 class Transport(object):
@@ -15,6 +16,28 @@ class Transport(object):
         self.memory_devices = None
         self.prog_info = {'last_uploaded': '', 'last_programmed': '',
                           'system_name': ''}
+        self.metrics = TransportStats()
+        # callables passed a TraceEvent for every request sent, see
+        # CasperFpga.add_trace_hook
+        self.trace_hooks = []
+
+    def stats(self, reset=False):
+        """
+        Get the request, packet and latency counters of this transport.
+
+        :param reset: clear the counters after reading them
+        :return: a dictionary of counters, see TransportStats.to_dict
+        """
+        stats = self.metrics.to_dict()
+        if reset:
+            self.metrics.reset()
+        return stats
+
+    def reset_stats(self):
+        """
+        Clear the request, packet and latency counters of this transport.
+        """
+        self.metrics.reset()
 
     def connect(self, timeout=None):
         """
@@ -79,6 +102,17 @@ class Transport(object):
         """
         raise NotImplementedError
 
+    def read_many(self, reads):
+        """
+        Read from several memory devices. Transports that can batch or
+        coalesce reads override this, the default reads one at a time.
+
+        :param reads: a list of (device_name, size, offset) tuples
+        :return: a list of big-endian binary strings, one per read
+        """
+        return [self.read(device_name, size, offset)
+                for device_name, size, offset in reads]
+
     def blindwrite(self, device_name, data, offset=0):
         """
         Write binary data to `device_name`, starting at `offset` bytes from `device_name`'s base address..
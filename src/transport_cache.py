@@ -0,0 +1,169 @@
+"""
+A persistent, on-disk cache of the transport type each host speaks, so
+that CasperFpga does not have to probe every host every time an object
+is created.
+
+The cache is a small JSON file, by default ~/.casperfpga/transport_cache.json.
+Set the CASPERFPGA_TRANSPORT_CACHE environment variable to use a different
+file, or to an empty string to switch the cache off.
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.casperfpga',
+                                  'transport_cache.json')
+
+# how long, in seconds, a cached transport type is trusted
+DEFAULT_TTL = 24 * 60 * 60
+
+
+class TransportCache(object):
+    """
+    Map hostnames to the name of their transport class, with a time-to-live
+    on every entry.
+    """
+    def __init__(self, filename=None, ttl=DEFAULT_TTL):
+        """
+
+        :param filename: the cache file, defaults to the
+            CASPERFPGA_TRANSPORT_CACHE environment variable or
+            DEFAULT_CACHE_FILE. An empty string disables the cache.
+        :param ttl: seconds after which an entry is stale
+        """
+        if filename is None:
+            filename = os.environ.get('CASPERFPGA_TRANSPORT_CACHE',
+                                      DEFAULT_CACHE_FILE)
+        self.filename = filename
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._mtime = None
+
+    @property
+    def enabled(self):
+        return bool(self.filename)
+
+    def _load(self):
+        """
+        (Re)load the cache file if it changed since we last read it.
+        Must be called with the lock held.
+        """
+        try:
+            mtime = os.path.getmtime(self.filename)
+        except OSError:
+            self._entries = {}
+            self._mtime = None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.filename, 'r') as fptr:
+                entries = json.load(fptr)
+            if not isinstance(entries, dict):
+                raise ValueError('not a dictionary')
+        except (IOError, ValueError) as exc:
+            LOGGER.warning('Ignoring unreadable transport cache %s: '
+                           '%s' % (self.filename, exc))
+            entries = {}
+        self._entries = entries
+        self._mtime = mtime
+
+    def _save(self):
+        """
+        Write the cache back to disk, atomically. Must be called with the
+        lock held.
+        """
+        dirname = os.path.dirname(self.filename) or '.'
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tcache')
+            with os.fdopen(fd, 'w') as fptr:
+                json.dump(self._entries, fptr, indent=1, sort_keys=True)
+            os.rename(tmpname, self.filename)
+            self._mtime = os.path.getmtime(self.filename)
+        except (IOError, OSError) as exc:
+            LOGGER.warning('Could not write transport cache %s: '
+                           '%s' % (self.filename, exc))
+
+    def get(self, host):
+        """
+        Get the cached transport class name for a host.
+
+        :param host: the hostname
+        :return: the name of the transport class, or None if the host is
+            not cached or its entry has expired
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._load()
+            entry = self._entries.get(host)
+        if entry is None:
+            return None
+        if time.time() - entry.get('time', 0) > self.ttl:
+            return None
+        return entry.get('transport')
+
+    def set(self, host, transport_name):
+        """
+        Remember the transport class for a host.
+
+        :param host: the hostname
+        :param transport_name: the name of the transport class
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._load()
+            self._entries[host] = {'transport': transport_name,
+                                   'time': time.time()}
+            self._save()
+
+    def invalidate(self, host):
+        """
+        Forget the transport class for a host, e.g. because connecting
+        with the cached type failed.
+
+        :param host: the hostname
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._load()
+            if self._entries.pop(host, None) is not None:
+                self._save()
+
+    def clear(self):
+        """
+        Forget all cached hosts.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries = {}
+            self._save()
+
+
+_transport_cache = None
+_transport_cache_lock = threading.Lock()
+
+
+def get_transport_cache():
+    """
+    Get the process-wide TransportCache, creating it on first use.
+    """
+    global _transport_cache
+    with _transport_cache_lock:
+        if _transport_cache is None:
+            _transport_cache = TransportCache()
+        return _transport_cache
+
+# end
@@ -0,0 +1,240 @@
+"""
+Work out which transport a host speaks by probing for all of them at once.
+
+Every probe is a non-blocking socket and all of them, for every host, are
+serviced by a single select() loop:
+
+    - SKARAB: a board-register read on the UDP control port
+    - katcp: a TCP connect to port 7147
+    - TAPCP: a TFTP read of sys_clkcounter
+
+The first probe to answer positively decides the transport for a host and
+its other probes are closed straight away, so detecting a whole rack takes
+at most one probe timeout.
+"""
+
+import socket
+import select
+import struct
+import time
+import errno
+import logging
+
+import skarab_definitions as sd
+from transport_skarab import SkarabTransport
+from transport_katcp import KatcpTransport
+from transport_tapcp import TapcpTransport
+from transport_dummy import DummyTransport
+from transport_cache import get_transport_cache
+
+LOGGER = logging.getLogger(__name__)
+
+# how long to wait for any probe to answer, in seconds
+PROBE_TIMEOUT = 3.0
+
+# resend UDP probes this often, in seconds, in case a packet was lost
+PROBE_RESEND_INTERVAL = 1.0
+
+# how many hosts to probe at once, each host uses three sockets
+MAX_PARALLEL_HOSTS = 64
+
+KATCP_PORT = 7147
+TFTP_PORT = 69
+
+# TFTP opcodes
+_TFTP_RRQ = 1
+_TFTP_DATA = 3
+_TFTP_ACK = 4
+
+# the order in which simultaneous answers are trusted, as for the
+# sequential probes in CasperFpga.choose_transport
+_PRIORITY = [SkarabTransport, KatcpTransport, TapcpTransport]
+
+
+def _skarab_probe_payload():
+    request = sd.ReadRegReq(sd.BOARD_REG, sd.C_RD_VERSION_ADDR)
+    return request.create_payload(0xffff)
+
+
+def _tapcp_probe_payload():
+    return struct.pack('>H', _TFTP_RRQ) + \
+        '%s.%x.%x\x00octet\x00' % ('sys_clkcounter', 0, 1)
+
+
+class _HostProbe(object):
+    """
+    The outstanding probes for one host.
+    """
+    def __init__(self, host, deadline):
+        self.host = host
+        self.deadline = deadline
+        self.result = None
+        self.probes = {}
+        self.last_send = 0
+        ip = socket.gethostbyname(host)
+        self.skarab_addr = (ip, sd.ETHERNET_CONTROL_PORT_ADDRESS)
+        self.tapcp_addr = (ip, TFTP_PORT)
+        # SKARAB control ping
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        self.probes[sock] = SkarabTransport
+        # TAPCP sys_clkcounter read
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        self.probes[sock] = TapcpTransport
+        # katcp TCP connect
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        self.probes[sock] = KatcpTransport
+        err = sock.connect_ex((ip, KATCP_PORT))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.discard(sock)
+        self.send_udp_probes()
+
+    def send_udp_probes(self):
+        """
+        (Re)send the SKARAB and TAPCP request packets.
+        """
+        for sock, transport in self.probes.items():
+            try:
+                if transport is SkarabTransport:
+                    sock.sendto(_skarab_probe_payload(), self.skarab_addr)
+                elif transport is TapcpTransport:
+                    sock.sendto(_tapcp_probe_payload(), self.tapcp_addr)
+            except socket.error:
+                self.discard(sock)
+        self.last_send = time.time()
+
+    def readers(self):
+        return [sock for sock, transport in self.probes.items()
+                if transport is not KatcpTransport]
+
+    def writers(self):
+        return [sock for sock, transport in self.probes.items()
+                if transport is KatcpTransport]
+
+    def answered(self, sock):
+        """
+        Check whether a probe socket that select() flagged is a positive
+        answer.
+        """
+        transport = self.probes[sock]
+        try:
+            if transport is KatcpTransport:
+                return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+            data, addr = sock.recvfrom(4096)
+            if transport is SkarabTransport:
+                return True
+            opcode, block = struct.unpack('>HH', data[0:4])
+            if opcode != _TFTP_DATA:
+                return False
+            # ack the single data block so the server can finish cleanly
+            sock.sendto(struct.pack('>HH', _TFTP_ACK, block), addr)
+            return True
+        except (socket.error, struct.error):
+            return False
+
+    def discard(self, sock):
+        self.probes.pop(sock, None)
+        sock.close()
+
+    def close(self):
+        for sock in self.probes.keys():
+            self.discard(sock)
+
+
+def detect_transports(hosts, timeout=PROBE_TIMEOUT,
+                      max_parallel=MAX_PARALLEL_HOSTS, use_cache=True):
+    """
+    Find the transport for each of a list of hosts, probing the hosts
+    concurrently.
+
+    :param hosts: a list of hostnames
+    :param timeout: how long to wait for a host to answer, in seconds
+    :param max_parallel: the most hosts to probe at the same time
+    :param use_cache: store the results in the on-disk transport cache
+    :return: a dictionary of transport classes keyed on hostname, None for
+        hosts that did not answer any probe
+    """
+    results = {}
+    pending = []
+    for host in hosts:
+        if host.startswith('CasperDummy'):
+            results[host] = DummyTransport
+        elif host not in results:
+            results[host] = None
+            pending.append(host)
+    pending.reverse()
+    active = []
+    while pending or active:
+        # start probing the next hosts
+        while pending and len(active) < max_parallel:
+            host = pending.pop()
+            try:
+                active.append(_HostProbe(host, time.time() + timeout))
+            except socket.error as exc:
+                LOGGER.error('Could not probe host %s: %s' % (host, exc))
+        if not active:
+            continue
+        readers = {}
+        writers = {}
+        for probe in active:
+            readers.update((sock, probe) for sock in probe.readers())
+            writers.update((sock, probe) for sock in probe.writers())
+        now = time.time()
+        wait_time = min(min(probe.deadline for probe in active),
+                        min(probe.last_send for probe in active) +
+                        PROBE_RESEND_INTERVAL) - now
+        readable, writable, _ = select.select(
+            readers.keys(), writers.keys(), [], max(wait_time, 0))
+        answers = {}
+        for sock in readable + writable:
+            probe = readers.get(sock) or writers.get(sock)
+            if probe.answered(sock):
+                answers.setdefault(probe, []).append(probe.probes[sock])
+            else:
+                probe.discard(sock)
+        for probe, transports in answers.items():
+            probe.result = sorted(transports, key=_PRIORITY.index)[0]
+        now = time.time()
+        still_active = []
+        for probe in active:
+            if (probe.result is not None) or (not probe.probes) or \
+                    (now >= probe.deadline):
+                probe.close()
+                results[probe.host] = probe.result
+                if probe.result is not None:
+                    LOGGER.debug('%s seems to be a %s' % (
+                        probe.host, probe.result.__name__))
+            else:
+                if now - probe.last_send >= PROBE_RESEND_INTERVAL:
+                    probe.send_udp_probes()
+                still_active.append(probe)
+        active = still_active
+    if use_cache:
+        cache = get_transport_cache()
+        for host, transport in results.items():
+            if transport in _PRIORITY:
+                cache.set(host, transport.__name__)
+    return results
+
+
+def detect_transport(host, timeout=PROBE_TIMEOUT, use_cache=True):
+    """
+    Find the transport for a single host, racing all the probes against
+    each other.
+
+    :param host: the hostname
+    :param timeout: how long to wait for an answer, in seconds
+    :param use_cache: store the result in the on-disk transport cache
+    :return: the transport class, or None if the host did not answer any
+        probe
+    """
+    if host.startswith('CasperDummy'):
+        return DummyTransport
+    # let the caller see name resolution errors
+    socket.gethostbyname(host)
+    return detect_transports([host], timeout=timeout,
+                             use_cache=use_cache)[host]
+
+# end
@@ -1,11 +1,32 @@
 import logging
+import time
+import random
+import bisect
+import threading
+
+import numpy as np
 
 import skarab_definitions as sd
 from transport import Transport
 from network import IpAddress
+from utils import parse_fpg, get_kwarg
 
 LOGGER = logging.getLogger(__name__)
 
+# the board ID a simulated design reports. CasperFpga takes a zero board ID
+# to mean a little-endian Red Pitaya.
+DUMMY_BOARD_ID = 0x00000007
+
+# fpga clock used for sys_clkcounter if the design does not give one, MHz
+DUMMY_CLK_RATE = 100.0
+
+# how fast other counter registers count, per second
+DUMMY_COUNTER_RATE = 1000
+
+# the system registers every design has
+SYS_REGISTERS = ['sys_board_id', 'sys_rev', 'sys_rev_rcs', 'sys_scratchpad',
+                 'sys_clkcounter']
+
 
 class NamedFifo(object):
     def __init__(self, maxlen=None):
@@ -31,20 +52,306 @@ class NamedFifo(object):
         return len(self.names)
 
 
+class FpgaSimulator(object):
+    """
+    An in-memory model of a programmed FPGA, built from the memory map in
+    an fpg file. Every memory device is backed by a bytearray.
+
+    Beyond plain memory, it emulates:
+
+    - sys_clkcounter, counting at the design's clock rate
+    - other To Processor registers with cnt/count/ctr in their names
+      (except error counters), counting at DUMMY_COUNTER_RATE
+    - snapshot blocks: arming one through its _ctrl register fills its
+      _bram with a ramp and sets _status to the captured length
+    """
+    def __init__(self, filename=None, board_id=DUMMY_BOARD_ID,
+                 address_mask=0xffffffff):
+        """
+
+        :param filename: the fpg file to load, None to start unprogrammed
+        :param board_id: the value of sys_board_id
+        :param address_mask: applied to the fpg's addresses to get bus
+            addresses, e.g. 0x7fffffff for a SKARAB
+        """
+        self.board_id = board_id
+        self.address_mask = address_mask
+        self.filename = None
+        self.device_info = {}
+        self.memorymap = {}
+        self.memory = {}
+        self.clk_rate = DUMMY_CLK_RATE
+        self._starts = []
+        self._names = []
+        self._read_hooks = {}
+        self._write_hooks = {}
+        self._captures = {}
+        self._start_time = time.time()
+        self._lock = threading.RLock()
+        if filename is not None:
+            self.load(filename)
+
+    @property
+    def programmed(self):
+        return self.filename is not None
+
+    def load(self, filename):
+        """
+        Program the simulator with a design from an fpg file.
+
+        :param filename: the fpg file
+        """
+        device_info, memorymap = parse_fpg(filename)
+        with self._lock:
+            self.clear()
+            self.device_info = device_info
+            self.memorymap = dict((name, dict(info))
+                                  for name, info in memorymap.items())
+            self._add_sys_registers()
+            for name, info in self.memorymap.items():
+                self.memory[name] = bytearray(info['bytes'])
+            self._index_addresses()
+            try:
+                self.clk_rate = float(device_info['XSG_core_config']['clk_rate'])
+            except (KeyError, ValueError):
+                self.clk_rate = DUMMY_CLK_RATE
+            self._setup_emulation()
+            self._start_time = time.time()
+            self.filename = filename
+        LOGGER.debug('Simulator loaded %s: %i memory devices' % (
+            filename, len(self.memory)))
+
+    def clear(self):
+        """
+        Deprogram the simulator.
+        """
+        with self._lock:
+            self.filename = None
+            self.device_info = {}
+            self.memorymap = {}
+            self.memory = {}
+            self._starts = []
+            self._names = []
+            self._read_hooks = {}
+            self._write_hooks = {}
+            self._captures = {}
+
+    def _add_sys_registers(self):
+        """
+        fpg files list the system registers, but add any that are missing
+        after the end of the memory map.
+        """
+        next_address = 0
+        for info in self.memorymap.values():
+            next_address = max(next_address, info['address'] + info['bytes'])
+        for name in SYS_REGISTERS:
+            if name not in self.memorymap:
+                next_address = (next_address + 3) & ~3
+                self.memorymap[name] = {'address': next_address, 'bytes': 4}
+                next_address += 4
+
+    def _index_addresses(self):
+        ordered = sorted((info['address'] & self.address_mask, name)
+                         for name, info in self.memorymap.items())
+        self._starts = [address for address, _ in ordered]
+        self._names = [name for _, name in ordered]
+
+    def _setup_emulation(self):
+        self._set_word('sys_board_id', self.board_id)
+        self._read_hooks['sys_clkcounter'] = self._update_clkcounter
+        for name, info in self.device_info.items():
+            if (info.get('tag') == 'xps:sw_reg') and \
+                    (info.get('io_dir') == 'To Processor') and \
+                    (name in self.memory) and self._is_counter(name):
+                self._read_hooks[name] = self._update_counter
+            elif info.get('tag') == 'casper:snapshot':
+                ctrl = name + '_ctrl'
+                if (ctrl in self.memory) and (name + '_bram' in self.memory):
+                    self._write_hooks[ctrl] = self._snapshot_ctrl_written
+
+    @staticmethod
+    def _is_counter(name):
+        name = name.lower()
+        if 'err' in name:
+            return False
+        return ('cnt' in name) or ('count' in name) or ('ctr' in name)
+
+    def _set_word(self, name, value, offset=0):
+        self.memory[name][offset:offset + 4] = \
+            np.array([value & 0xffffffff], dtype='>u4').tostring()
+
+    def _get_word(self, name, offset=0):
+        return int(np.frombuffer(
+            bytes(self.memory[name][offset:offset + 4]), dtype='>u4')[0])
+
+    def _update_clkcounter(self, name):
+        ticks = (time.time() - self._start_time) * self.clk_rate * 1e6
+        self._set_word(name, int(ticks))
+
+    def _update_counter(self, name):
+        ticks = (time.time() - self._start_time) * DUMMY_COUNTER_RATE
+        self._set_word(name, int(ticks))
+
+    def _snapshot_ctrl_written(self, name, old_data):
+        """
+        Capture on a rising edge of the arm bit, like the snapshot block.
+        """
+        old_ctrl = np.frombuffer(bytes(old_data[0:4]), dtype='>u4')[0]
+        new_ctrl = self._get_word(name)
+        snapshot = name[:-len('_ctrl')]
+        if not ((new_ctrl & 1) and not (old_ctrl & 1)):
+            return
+        bram = self.memory[snapshot + '_bram']
+        nwords = len(bram) // 4
+        # carry the ramp on from the last capture, so captures differ
+        start = self._captures.get(snapshot, 0)
+        self._captures[snapshot] = start + nwords
+        bram[0:nwords * 4] = np.arange(
+            start, start + nwords, dtype=np.uint64).astype('>u4').tostring()
+        status = snapshot + '_status'
+        if status in self.memory:
+            self._set_word(status, len(bram) & 0x7fffffff)
+        tr_en_cnt = snapshot + '_tr_en_cnt'
+        if tr_en_cnt in self.memory:
+            self._set_word(tr_en_cnt, len(bram))
+
+    def _check_access(self, name, size, offset):
+        if name not in self.memory:
+            raise RuntimeError('No memory device %s in %s' % (
+                name, self.filename))
+        length = len(self.memory[name])
+        if (offset < 0) or (size < 0) or (offset + size > length):
+            raise RuntimeError('Access of %i bytes at offset %i is outside '
+                               'the %i bytes of %s' % (size, offset, length,
+                                                       name))
+
+    def listdev(self):
+        """
+        :return: the names of the memory devices in the design
+        """
+        return self.memory.keys()
+
+    def read(self, name, size, offset=0):
+        """
+        Read bytes from a memory device.
+
+        :param name: the memory device
+        :param size: how many bytes to read
+        :param offset: byte offset into the device
+        :return: a binary string
+        """
+        with self._lock:
+            self._check_access(name, size, offset)
+            hook = self._read_hooks.get(name)
+            if hook is not None:
+                hook(name)
+            return str(self.memory[name][offset:offset + size])
+
+    def write(self, name, data, offset=0):
+        """
+        Write bytes to a memory device.
+
+        :param name: the memory device
+        :param data: a binary string
+        :param offset: byte offset into the device
+        """
+        with self._lock:
+            self._check_access(name, len(data), offset)
+            mem = self.memory[name]
+            hook = self._write_hooks.get(name)
+            old_data = mem[:] if hook is not None else None
+            mem[offset:offset + len(data)] = data
+            if hook is not None:
+                hook(name, old_data)
+
+    def find_address(self, address):
+        """
+        Find the memory device holding a bus address.
+
+        :param address: the bus address
+        :return: (device name, offset into the device)
+        """
+        pos = bisect.bisect_right(self._starts, address) - 1
+        if pos >= 0:
+            name = self._names[pos]
+            offset = address - self._starts[pos]
+            if offset < len(self.memory[name]):
+                return name, offset
+        raise RuntimeError('No memory device at address 0x%08x' % address)
+
+    def _address_spans(self, address, size):
+        """
+        Split a bus access into per-device (name, offset, size) spans.
+        Accesses may run across adjacent devices, but not into gaps.
+        """
+        spans = []
+        while size > 0:
+            name, offset = self.find_address(address)
+            span = min(size, len(self.memory[name]) - offset)
+            spans.append((name, offset, span))
+            address += span
+            size -= span
+        return spans
+
+    def read_address(self, address, size):
+        """
+        Read bytes from a bus address.
+        """
+        with self._lock:
+            return ''.join(self.read(name, span, offset) for name, offset, span
+                           in self._address_spans(address, size))
+
+    def write_address(self, address, data):
+        """
+        Write bytes to a bus address.
+        """
+        with self._lock:
+            pos = 0
+            for name, offset, span in self._address_spans(address, len(data)):
+                self.write(name, data[pos:pos + span], offset)
+                pos += span
+
 
 class DummyTransport(Transport):
     """
-    A dummy transport for testing
+    A dummy transport for testing.
+
+    Given an fpg file, either as the bitstream or by programming it, the
+    transport is backed by an FpgaSimulator and behaves like a programmed
+    board. Without one, reads return whatever was last written to a
+    device, or zeros.
+
+    Link latency, jitter, bandwidth and packet loss can be injected to
+    measure code end-to-end without hardware.
     """
     def __init__(self, **kwargs):
         """
         Make a Dummy Transport
 
         :param host: IP Address should be 127.0.0.1 for a Dummy
+        :param bitstream: an fpg file with which to start the simulator
+        :param latency: seconds added to every request
+        :param jitter: up to this many seconds more, at random
+        :param bandwidth: link speed in bytes per second, 0 for unlimited
+        :param loss: the chance of a request being lost, 0.0 to 1.0
+        :param loss_timeout: seconds lost for every lost request
+        :param retries: lost requests are retried this many times before
+            the request fails
+        :param board_id: the simulated sys_board_id
         """
         Transport.__init__(self, **kwargs)
         self._devices = NamedFifo(100)
         self._devices_wishbone = NamedFifo(100)
+        self.latency = get_kwarg('latency', kwargs, 0.0)
+        self.jitter = get_kwarg('jitter', kwargs, 0.0)
+        self.bandwidth = get_kwarg('bandwidth', kwargs, 0)
+        self.loss = get_kwarg('loss', kwargs, 0.0)
+        self.loss_timeout = get_kwarg('loss_timeout', kwargs, 0.1)
+        self.retries = get_kwarg('retries', kwargs, 3)
+        self.simulator = FpgaSimulator(
+            board_id=get_kwarg('board_id', kwargs, DUMMY_BOARD_ID))
+        if self.bitstream and self.bitstream.endswith('.fpg'):
+            self.simulator.load(self.bitstream)
         LOGGER.info('%s: port(%s) created and connected.' % (
             self.host, sd.ETHERNET_CONTROL_PORT_ADDRESS))
 
@@ -61,6 +368,8 @@ class DummyTransport(Transport):
 
         :return: True or False
         """
+        if self.bitstream and self.bitstream.endswith('.fpg'):
+            return self.simulator.programmed
         return True
 
     def is_connected(self):
@@ -90,6 +399,35 @@ class DummyTransport(Transport):
         """
         pass
 
+    def _simulate_link(self, nbytes, requests=1):
+        """
+        Spend the time a link would take to carry a transaction, and
+        lose requests at the configured rate.
+
+        :param nbytes: the number of bytes carried
+        :param requests: the number of requests, all in flight at once
+        """
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if self.bandwidth:
+            delay += float(nbytes) / self.bandwidth
+        if self.loss:
+            for _ in range(requests):
+                tries = 0
+                while random.random() < self.loss:
+                    tries += 1
+                    delay += self.loss_timeout
+                    self.metrics.timeout()
+                    self.metrics.retransmit()
+                    if tries > self.retries:
+                        time.sleep(delay)
+                        raise RuntimeError('%s: request timed out after %i '
+                                           'retries' % (self.host,
+                                                        self.retries))
+        if delay > 0:
+            time.sleep(delay)
+
     def read(self, device_name, size, offset=0):
         """
 
@@ -97,11 +435,48 @@ class DummyTransport(Transport):
         :param size:
         :param offset:
         """
-        try:
-            return self._devices.pop(device_name)
-        except ValueError:
-            pass
-        return '\x00' * size
+        start_time = time.time()
+        self._simulate_link(size)
+        if self.simulator.programmed:
+            data = self.simulator.read(device_name, size, offset)
+        else:
+            try:
+                data = self._devices.pop(device_name)
+            except ValueError:
+                data = '\x00' * size
+        self.metrics.received(len(data))
+        self.metrics.record('read', time.time() - start_time)
+        return data
+
+    def read_many(self, reads):
+        """
+        Read from several memory devices, with all the requests in flight
+        at once.
+
+        :param reads: a list of (device_name, size, offset) tuples
+        :return: a list of big-endian binary strings, one per read
+        """
+        start_time = time.time()
+        nbytes = sum(read[1] for read in reads)
+        self._simulate_link(nbytes, len(reads))
+        if not self.simulator.programmed:
+            data = ['\x00' * size for _, size, _ in reads]
+        else:
+            data = [self.simulator.read(device_name, size, offset)
+                    for device_name, size, offset in reads]
+        self.metrics.received(nbytes, len(reads))
+        self.metrics.record('read_many', time.time() - start_time)
+        return data
+
+    def bulkread(self, device_name, size, offset=0):
+        """
+        Read a large block of memory in one request.
+
+        :param device_name: the memory device
+        :param size: how many bytes to read
+        :param offset: byte offset into the device
+        """
+        return self.read(device_name, size, offset)
 
     def blindwrite(self, device_name, data, offset=0):
         """
@@ -110,8 +485,14 @@ class DummyTransport(Transport):
         :param data:
         :param offset:
         """
-        self._devices.push(device_name, data)
-        return
+        start_time = time.time()
+        self._simulate_link(len(data))
+        if self.simulator.programmed:
+            self.simulator.write(device_name, data, offset)
+        else:
+            self._devices.push(device_name, data)
+        self.metrics.sent(len(data))
+        self.metrics.record('write', time.time() - start_time)
 
     def listdev(self):
         """
@@ -119,13 +500,16 @@ class DummyTransport(Transport):
 
         :return: a list of memory devices
         """
+        if self.simulator.programmed:
+            return self.simulator.listdev()
         return self.memory_devices.keys()
 
     def deprogram(self):
         """
         Deprogram the FPGA connected by this transport
         """
-        raise NotImplementedError
+        self.simulator.clear()
+        self.prog_info['last_programmed'] = ''
 
     def set_igmp_version(self, version):
         """
@@ -134,7 +518,8 @@ class DummyTransport(Transport):
         pass
 
     def upload_to_ram_and_program(self, filename, port=-1, timeout=10,
-                                  wait_complete=True, skip_verification=False):
+                                  wait_complete=True, skip_verification=False,
+                                  **kwargs):
         """
         Upload an FPG file to RAM and then program the FPGA.
 
@@ -146,6 +531,10 @@ class DummyTransport(Transport):
         :param skip_verification: don't verify the image after uploading it
         """
         self.bitstream = filename
+        if filename.endswith('.fpg'):
+            self.simulator.load(filename)
+        self.prog_info['last_uploaded'] = filename
+        self.prog_info['last_programmed'] = filename
         return True
 
     def upload_to_flash(self, binary_file, port=-1, force_upload=False,
@@ -182,6 +571,10 @@ class DummyTransport(Transport):
         :param wb_address: address of the wishbone slave to read from
         :return: Read Data or None
         """
+        if self.simulator.programmed:
+            self._simulate_link(4)
+            return int(np.frombuffer(
+                self.simulator.read_address(wb_address, 4), dtype='>u4')[0])
         try:
             return self._devices_wishbone.pop(wb_address)
         except ValueError:
@@ -197,6 +590,11 @@ class DummyTransport(Transport):
         :param data: data to write
         :return: response object
         """
+        if self.simulator.programmed:
+            self._simulate_link(4)
+            self.simulator.write_address(
+                wb_address, np.array([data], dtype='>u4').tostring())
+            return None
         self._devices_wishbone.push(wb_address, data)
         return None
 
@@ -1,13 +1,13 @@
 import logging
-import struct
-import array
-import binascii
 import time
 
+import numpy as np
+
 from utils import get_kwarg
 from transport import Transport
 from rmp import rmpNetwork
 import skarab_fileops
+import CasperLogHandlers
 
 def swap32(x):
     return (((x << 24) & 0xFF000000) |
@@ -37,7 +37,8 @@ class ItpmTransport(Transport):
         udp_port = get_kwarg('port', kwargs, 10000)
         timeout = get_kwarg('timeout', kwargs, 1)
         self.fpga_idx = [0, 1]  # Indexes for the 2 FPGAs on the iTPM
-        self.itpm = rmpNetwork(pc_ip, fpga_ip, udp_port, timeout)
+        self.itpm = rmpNetwork(pc_ip, fpga_ip, udp_port, timeout,
+                               metrics=self.metrics)
 
     def connect(self, timeout=None):
         """
@@ -114,15 +115,13 @@ class ItpmTransport(Transport):
         size32 = size >> 2
 
         addr = self._get_device_address(device_name) + offset
-        self.logger.info('Reading {0} Locations from Address: 0x{1:08X}'.format(size, addr))
-        # Read the data as a list of integers.
-        if size32 == 1:
-            rd_data = [self.itpm.rd32(addr, size32)]
-        else:
-            rd_data = self.itpm.rd32(addr, size32)
-        # Convert to binary string, because that's what the Transport class demands
-        rd_data_str = struct.pack('>%dL' % size32, *rd_data)
-        return rd_data_str
+        if CasperLogHandlers.debug_enabled(self.logger):
+            self.logger.debug('Reading %i Locations from Address: 0x%08X',
+                              size, addr)
+        rd_data = self.itpm.read_block(addr, size32)
+        # Convert to a big-endian binary string, because that's what the
+        # Transport class demands
+        return np.frombuffer(rd_data, dtype=np.uint32).astype('>u4').tostring()
 
     def blindwrite(self, device_name, data, offset=0):
         """
@@ -142,15 +141,13 @@ class ItpmTransport(Transport):
 
         assert len(data) % 4 == 0
 
-        size32 = len(data) >> 2
-
         addr = self._get_device_address(device_name) + offset
-        # Convert the data to write to a list, because that's what the itpm package wants
-        wr_list = list(struct.unpack('>%dL' % size32, data))
-
-        self.logger.info('Data to Write: {}'.format(wr_list))
-        self.logger.info('Writing Data to Address: 0x{0:08X}'.format(addr))
-        self.itpm.wr32(addr, wr_list)
+        if CasperLogHandlers.debug_enabled(self.logger):
+            self.logger.debug('Writing %i Locations to Address: 0x%08X',
+                              len(data), addr)
+        # RMP wants native-order words
+        self.itpm.write_block(
+            addr, np.frombuffer(data, dtype='>u4').astype(np.uint32).tostring())
 
     def listdev(self):
         """
@@ -213,14 +210,14 @@ class ItpmTransport(Transport):
             self.itpm.wr32(SM_XIL_reg[f], 0x10)  # SELECT XIL 0/1
         self.itpm.wr32(SM_glob_reg, 0x2)  # CSn=0
 
-        word_list = []
-        for w in range(len(bytes_read) / 4):
-            word = bytes_read[w * 4:w * 4 + 4]
-            word_list.append(swap32(int(binascii.hexlify(word), 16)))
+        # the bitstream goes to the FIFO as little-endian words
+        num_words = len(bytes_read) / 4
+        words = np.frombuffer(bytes_read[0:num_words * 4], dtype='<u4')
 
         start = time.time()
 
-        self.itpm.wr32_bulk(SM_WR_fifo, word_list)
+        self.itpm.write_block(SM_WR_fifo, words.astype(np.uint32).tostring(),
+                              increment=False)
 
         end = time.time()
         self.logger.info('Programed FPGAs in {} secs'.format(end - start))
@@ -395,6 +392,5 @@ class ItpmTransport(Transport):
 
         #self.wr32_multi(0x4C, 0)
         raise RuntimeError("Could not calibrate FPGA to CPLD streaming")
-        sys.exit(-1)
 
 # end
@@ -9,6 +9,9 @@ import socket
 import struct
 import contextlib
 
+from concurrent.futures import Future
+
+import tracing
 from transport import Transport
 from utils import create_meta_dictionary, get_hostname, get_kwarg
 
@@ -22,6 +25,16 @@ if hasattr(katcp.CallbackClient, 'MAX_WRITE_BUFFER_SIZE'):
     setattr(katcp.CallbackClient, 'MAX_WRITE_BUFFER_SIZE',
             katcp.CallbackClient.MAX_WRITE_BUFFER_SIZE * 10)
 
+# the most requests read_many and write_many keep outstanding on one
+# connection
+MAX_REQUESTS_IN_FLIGHT = 64
+
+# reads larger than this, in bytes, use ?bulkread rather than ?read
+BULKREAD_THRESHOLD = 4096
+
+# bulk reads are split into pipelined ?bulkread requests of this many bytes
+BULKREAD_CHUNK_SIZE = 1024 * 1024
+
 
 class KatcpConnectionError(Exception):
     pass
@@ -112,6 +125,11 @@ class KatcpTransport(Transport, katcp.CallbackClient):
         self.system_info = {}
         self.unhandled_inform_handler = None
         self._timeout = timeout
+        self._bulkread_supported = True
+        self._coreinfo_cache = None
+        # the ?meta informs last read from the board, which identify the
+        # design running on it
+        self._design_key = None
         self.connect()
         self.logger.info('%s: port(%s) created and connected.' % (self.host, port))
 
@@ -249,26 +267,155 @@ class KatcpTransport(Transport, katcp.CallbackClient):
         # TODO raise sensible errors
         if request_timeout == -1:
             request_timeout = self._timeout
+        if self.trace_hooks:
+            device, address, size, payload = self._trace_request_info(
+                name, request_args)
+            return tracing.traced_call(
+                self.trace_hooks, tracing.LAYER_TRANSPORT, name, self.host,
+                device, address, size, payload, self._katcprequest, name,
+                request_timeout, require_ok, request_args)
+        return self._katcprequest(name, request_timeout, require_ok,
+                                  request_args)
+
+    def _katcprequest(self, name, request_timeout, require_ok,
+                      request_args):
         request = katcp.Message.request(name, *request_args)
+        start_time = time.time()
         reply, informs = self.blocking_request(request, timeout=request_timeout)
-        if (reply.arguments[0] != katcp.Message.OK) and require_ok:
-            if reply.arguments[0] == katcp.Message.FAIL:
-                raise KatcpRequestFail(
-                    'Request %s on host %s failed.\n\t'
-                    'Request: %s\n\tReply: %s' %
-                    (request.name, self.host, request, reply))
-            elif reply.arguments[0] == katcp.Message.INVALID:
-                raise KatcpRequestInvalid(
-                    'Invalid katcp request %s on host %s.\n\t'
-                    'Request: %s\n\tReply: %s' %
-                    (request.name, self.host, request, reply))
-            else:
-                raise KatcpRequestError(
-                    'Unknown error processing request %s on host '
-                    '%s.\n\tRequest: %s\n\tReply: %s' %
-                    (request.name, self.host, request, reply))
+        self._record_request(request, reply, informs, start_time)
+        if require_ok:
+            self._check_reply(request, reply)
         return reply, informs
 
+    def _trace_request_info(self, name, request_args):
+        """
+        Get the device, address, size and data written of a request, for
+        tracing.
+
+        :return: (device, address, size, data written or None)
+        """
+        if (name in ('read', 'bulkread', 'write')) and \
+                (len(request_args) == 3):
+            device, offset = request_args[0], int(request_args[1])
+            address = tracing.device_address(self.memory_devices, device,
+                                             offset)
+            if name == 'write':
+                return device, address, len(request_args[2]), \
+                    request_args[2]
+            return device, address, int(request_args[2]), None
+        if len(request_args) > 0:
+            return str(request_args[0]), tracing.NO_ADDRESS, 0, None
+        return '', tracing.NO_ADDRESS, 0, None
+
+    def _record_request(self, request, reply, informs, start_time):
+        """
+        Count a request and its reply in the transport metrics.
+
+        :param request: the request message that was sent
+        :param reply: the reply message received
+        :param informs: the informs received with the reply
+        :param start_time: when the request was sent
+        """
+        metrics = self.metrics
+        metrics.sent(len(request.name) + sum(
+            len(arg) for arg in request.arguments))
+        nbytes = sum(len(arg) for arg in reply.arguments)
+        for inform in informs:
+            nbytes += sum(len(arg) for arg in inform.arguments)
+        metrics.received(len(reply.name) + nbytes, 1 + len(informs))
+        if (reply.arguments[0] == katcp.Message.FAIL) and \
+                (len(reply.arguments) > 1) and \
+                ('timed out' in reply.arguments[1]):
+            metrics.timeout()
+            metrics.failure(request.name)
+        else:
+            metrics.record(request.name, time.time() - start_time)
+
+    def _check_reply(self, request, reply):
+        """
+        Raise an error if a reply indicates a request failure.
+
+        :param request: the request message that was sent
+        :param reply: the reply message received
+        """
+        if reply.arguments[0] == katcp.Message.OK:
+            return
+        if reply.arguments[0] == katcp.Message.FAIL:
+            raise KatcpRequestFail(
+                'Request %s on host %s failed.\n\t'
+                'Request: %s\n\tReply: %s' %
+                (request.name, self.host, request, reply))
+        elif reply.arguments[0] == katcp.Message.INVALID:
+            raise KatcpRequestInvalid(
+                'Invalid katcp request %s on host %s.\n\t'
+                'Request: %s\n\tReply: %s' %
+                (request.name, self.host, request, reply))
+        else:
+            raise KatcpRequestError(
+                'Unknown error processing request %s on host '
+                '%s.\n\tRequest: %s\n\tReply: %s' %
+                (request.name, self.host, request, reply))
+
+    def katcprequest_async(self, name, request_timeout=-1.0, require_ok=True,
+                           request_args=(), process_reply=None):
+        """
+        Send a request to the KATCP server without waiting for the reply.
+        Many requests can be outstanding on the connection at once.
+
+        :param name: request message to send.
+        :param request_timeout: number of seconds after which the request
+            must time out
+        :param require_ok: will the future raise an exception on a
+            response != ok
+        :param request_args: request arguments.
+        :param process_reply: a function called with (reply, informs) to
+            produce the result of the future, default returns the tuple
+        :return: a concurrent.futures Future for the result
+        """
+        if request_timeout == -1:
+            request_timeout = self._timeout
+        request = katcp.Message.request(name, *request_args)
+        future = Future()
+        informs = []
+        start_time = time.time()
+        trace_info = None
+        if self.trace_hooks:
+            trace_info = self._trace_request_info(name, request_args)
+            trace_site = tracing.call_site()
+
+        def reply_cb(reply):
+            self._record_request(request, reply, informs, start_time)
+            if trace_info is not None:
+                device, address, size, payload = trace_info
+                ok = reply.arguments[0] == katcp.Message.OK
+                data = reply.arguments[1] if (payload is None) and ok and \
+                    (len(reply.arguments) > 1) else payload
+                tracing.emit(self.trace_hooks, tracing.TraceEvent(
+                    tracing.LAYER_TRANSPORT, name, self.host, device,
+                    address, size, start_time, time.time() - start_time, ok,
+                    tracing.crc(data) if ok else 0, trace_site))
+            try:
+                if require_ok:
+                    self._check_reply(request, reply)
+                if process_reply is None:
+                    result = (reply, informs)
+                else:
+                    result = process_reply(reply, informs)
+            except Exception as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+        future.set_running_or_notify_cancel()
+        try:
+            self.callback_request(request, reply_cb=reply_cb,
+                                  inform_cb=informs.append,
+                                  timeout=request_timeout)
+        except Exception as exc:
+            if not future.done():
+                future.set_exception(exc)
+        return future
+
     def listdev(self, getsize=False, getaddress=False):
         """
         Get a list of the memory bus items in this design.
@@ -354,6 +501,8 @@ class KatcpTransport(Transport, katcp.CallbackClient):
         :param offset: start at this offset
         :return: binary data string
         """
+        if size > BULKREAD_THRESHOLD and self._bulkread_supported:
+            return self.bulkread(device_name, size, offset)
         reply, _ = self.katcprequest(
             name='read', request_timeout=self._timeout, require_ok=True,
             request_args=(device_name, str(offset), str(size)))
@@ -392,22 +541,136 @@ class KatcpTransport(Transport, katcp.CallbackClient):
                           require_ok=True,
                           request_args=(device_name, str(offset), data))
 
-    def bulkread(self, device_name, size, offset=0):
+    def read_async(self, device_name, size, offset=0):
+        """
+        Start a read without waiting for it to complete.
+
+        :param device_name: name of memory device from which to read
+        :param size: how many bytes to read
+        :param offset: start at this offset
+        :return: a Future for the binary data string
+        """
+        return self.katcprequest_async(
+            name='read', request_timeout=self._timeout, require_ok=True,
+            request_args=(device_name, str(offset), str(size)),
+            process_reply=lambda reply, informs: reply.arguments[1])
+
+    def write_async(self, device_name, data, offset=0):
+        """
+        Start an unchecked write without waiting for it to complete.
+
+        :param device_name: the memory device to which to write
+        :param data: the byte string to write
+        :param offset: the offset, in bytes, at which to write
+        :return: a Future that resolves to None once the write is done
+        """
+        assert(type(data) == str), 'You need to supply binary packed ' \
+                                   'string data!'
+        assert(len(data) % 4) == 0, 'You must write 32-bit-bounded words!'
+        assert((offset % 4) == 0), 'You must write 32-bit-bounded words!'
+        return self.katcprequest_async(
+            name='write', request_timeout=self._timeout, require_ok=True,
+            request_args=(device_name, str(offset), data),
+            process_reply=lambda reply, informs: None)
+
+    def _pipeline(self, start_request, items):
+        """
+        Run a request for every item, keeping up to MAX_REQUESTS_IN_FLIGHT
+        of them outstanding on the connection, and gather the results.
+
+        :param start_request: a function taking an item and returning a
+            Future
+        :param items: a list of items
+        :return: a list of results, in item order
+        """
+        futures = []
+        for ctr, item in enumerate(items):
+            if ctr >= MAX_REQUESTS_IN_FLIGHT:
+                futures[ctr - MAX_REQUESTS_IN_FLIGHT].exception()
+            futures.append(start_request(item))
+        return [future.result() for future in futures]
+
+    def read_many(self, reads):
+        """
+        Read from several memory devices, pipelining the requests on the
+        connection instead of waiting for each reply in turn.
+
+        :param reads: a list of (device_name, size, offset) tuples
+        :return: a list of big-endian binary strings, one per read
+        """
+        return self._pipeline(lambda read: self.read_async(*read), reads)
+
+    def write_many(self, writes):
+        """
+        Write to several memory devices, pipelining the requests on the
+        connection instead of waiting for each reply in turn.
+
+        :param writes: a list of (device_name, data, offset) tuples
+        """
+        self._pipeline(lambda write: self.write_async(*write), writes)
+
+    def _bulkread_chunk_async(self, device_name, size, offset, buf, pos):
+        """
+        Start a ?bulkread of one chunk, copying the informs into buf at pos
+        as they are processed.
+
+        :return: a Future that resolves to None once the chunk is in buf
+        """
+        def process_reply(reply, informs):
+            end = pos
+            for inform in informs:
+                data = inform.arguments[0]
+                buf[end:end + len(data)] = data
+                end += len(data)
+            if end - pos != size:
+                raise KatcpRequestError(
+                    'bulkread of %s on host %s returned %i bytes, expected '
+                    '%i.' % (device_name, self.host, end - pos, size))
+        return self.katcprequest_async(
+            name='bulkread', request_timeout=self._timeout, require_ok=True,
+            request_args=(device_name, str(offset), str(size)),
+            process_reply=process_reply)
+
+    def bulkread(self, device_name, size, offset=0,
+                 chunk_size=BULKREAD_CHUNK_SIZE, pipeline=True):
         """
         Read size-bytes of binary data with carriage-return escape-sequenced.
         Uses much faster bulkread katcp command which returns data in pages
         using informs rather than one read reply, which has significant
         buffering overhead on the ROACH.
 
+        Large reads are split into chunk_size requests, the data from all of
+        them is gathered into one buffer.
+
         :param device_name: name of the memory device from which to read
         :param size: how many bytes to read
         :param offset: the offset at which to read
+        :param chunk_size: the most bytes to ask for in one request
+        :param pipeline: keep several chunk requests in flight at once,
+            rather than waiting for each in turn
         :return: binary data string
         """
-        _, informs = self.katcprequest(
-            name='bulkread', request_timeout=self._timeout, require_ok=True,
-            request_args=(device_name, str(offset), str(size)))
-        return ''.join([i.arguments[0] for i in informs])
+        buf = bytearray(size)
+        chunks = [(pos, min(chunk_size, size - pos))
+                  for pos in range(0, size, chunk_size)]
+
+        def start_chunk(chunk):
+            pos, length = chunk
+            return self._bulkread_chunk_async(device_name, length,
+                                              offset + pos, buf, pos)
+        try:
+            if pipeline:
+                self._pipeline(start_chunk, chunks)
+            else:
+                for chunk in chunks:
+                    start_chunk(chunk).result()
+        except KatcpRequestInvalid:
+            # older servers have no ?bulkread, use ?read from now on
+            self.logger.info('%s: ?bulkread not supported, falling back to '
+                             '?read' % self.host)
+            self._bulkread_supported = False
+            return self.read(device_name, size, offset)
+        return str(buf)
 
     def program(self, filename=None):
         """
@@ -472,6 +735,7 @@ class KatcpTransport(Transport, katcp.CallbackClient):
         self.logger.info('%s: programmed %s okay.' % (self.host, filename))
         self.prog_info['last_programmed'] = filename
         self.prog_info['last_uploaded'] = ''
+        self._coreinfo_cache = None
 
     def deprogram(self):
         """
@@ -489,6 +753,7 @@ class KatcpTransport(Transport, katcp.CallbackClient):
             reply, _ = self.katcprequest(name='progdev', require_ok=True)
             self.logger.info('%s: deprogrammed okay' % self.host)
             self.prog_info['last_programmed'] = ''
+            self._coreinfo_cache = None
         except KatcpRequestError as exc:
             self.logger.exception('{}: could not deprogram FPGA, katcp request '
                              'failed:'.format(self.host))
@@ -601,6 +866,7 @@ class KatcpTransport(Transport, katcp.CallbackClient):
         self._timeout = old_timeout
         self.prog_info['last_programmed'] = filename
         self.prog_info['last_uploaded'] = filename
+        self._coreinfo_cache = None
         return True
 
     def upload_to_flash(self, binary_file, port=-1, force_upload=False,
@@ -740,6 +1006,9 @@ class KatcpTransport(Transport, katcp.CallbackClient):
         if reply.arguments[0] != 'ok':
             raise RuntimeError('Could not read meta information '
                                'from %s' % self.host)
+        if device is None:
+            self._design_key = tuple(tuple(inform.arguments)
+                                     for inform in informs)
         metalist = []
         for inform in informs:
             if len(inform.arguments) < 4:
@@ -765,33 +1034,56 @@ class KatcpTransport(Transport, katcp.CallbackClient):
         self._process_git_info(metalist)
         return create_meta_dictionary(metalist)
 
-    def _read_coreinfo_from_host(self):
+    def _read_coreinfo_from_host(self, design_key=None):
         """
         Get the equivalent of coreinfo.tab from the host using
         KATCP listdev commands.
+
+        The result is cached against the design metadata read from the
+        board, so it is read again if anyone - this transport or another
+        client - loads a different design. It is also dropped whenever the
+        FPGA is (de)programmed through this transport.
+
+        :param design_key: the ?meta informs just read from the board, as
+            kept by _read_design_info_from_host. Without it the cache is
+            not used.
         """
+        key = design_key
+        if (key is not None) and (self._coreinfo_cache is not None) and \
+                (self._coreinfo_cache[0] == key):
+            self.logger.debug('%s: using cached coreinfo' % self.host)
+            return dict((dev, info.copy()) for dev, info in
+                        self._coreinfo_cache[1].iteritems())
         self.logger.debug('%s: reading coreinfo' % self.host)
-        memorymap_dict = {}
-        listdev_size = self.listdev(getsize=True)
-        listdev_address = self.listdev(getaddress=True)
+        # the server has no single request that lists both size and
+        # address, so send both at once rather than one after the other
+        size_future = self.katcprequest_async(
+            name='listdev', request_timeout=self._timeout,
+            request_args=('size',))
+        address_future = self.katcprequest_async(
+            name='listdev', request_timeout=self._timeout,
+            request_args=('detail',))
+        listdev_size = [inform.arguments[0:2]
+                        for inform in size_future.result()[1]]
+        listdev_address = dict(inform.arguments[0:2]
+                               for inform in address_future.result()[1])
         if len(listdev_address) != len(listdev_size):
             raise RuntimeError('Different length listdev(size) and '
                                'listdev(detail)')
+        memorymap_dict = {}
         for byte_dev, byte_size in listdev_size:
-            matched = False
-            for addrdev, address in listdev_address:
-                if addrdev == byte_dev:
-                    byte_size = int(byte_size.split(':')[0])
-                    address = int(address.split(':')[0], 16)
-                    memorymap_dict[byte_dev] = {
-                        'address': address, 'bytes': byte_size
-                    }
-                    matched = True
-                    continue
-            if not matched:
+            try:
+                address = listdev_address[byte_dev]
+            except KeyError:
                 raise RuntimeError('No matching listdev address for '
                                    'device %s' % byte_dev)
-        return memorymap_dict
+            memorymap_dict[byte_dev] = {
+                'address': int(address.split(':')[0], 16),
+                'bytes': int(byte_size.split(':')[0])
+            }
+        self._coreinfo_cache = (key, memorymap_dict)
+        return dict((dev, info.copy()) for dev, info in
+                    memorymap_dict.iteritems())
 
     def get_system_information_from_transport(self):
         """
@@ -800,7 +1092,7 @@ class KatcpTransport(Transport, katcp.CallbackClient):
         if not self.is_running():
             return self.bitstream, None
         device_dict = self._read_design_info_from_host()
-        memorymap_dict = self._read_coreinfo_from_host()
+        memorymap_dict = self._read_coreinfo_from_host(self._design_key)
         return self.bitstream, (device_dict, memorymap_dict)
 
     def unhandled_inform(self, msg):
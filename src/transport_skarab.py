@@ -1,7 +1,6 @@
 import socket
 import math
 import select
-import logging
 import struct
 import time
 import os
@@ -13,6 +12,7 @@ from threading import Lock
 import skarab_definitions as sd
 import skarab_fileops as skfops
 import CasperLogHandlers
+import tracing
 
 from transport import Transport
 from network import IpAddress
@@ -116,6 +116,9 @@ class SkarabTransport(Transport):
         :param blocking: True (default)/False. If True a SKARAB comms
                          check will be performed. If False only the
                          instance will be created.
+        :param skarab_control_port: the board's control port, only
+                     changed to talk to an emulator, defaults to
+                     ETHERNET_CONTROL_PORT_ADDRESS
         """
         Transport.__init__(self, **kwargs)
 
@@ -143,14 +146,19 @@ class SkarabTransport(Transport):
             self.blocking = kwargs['blocking']
         except KeyError:
             self.blocking = True
+        # not the generic port kwarg, which CasperFpga and
+        # threaded_create_fpgas_from_hosts fill with the katcp port
+        try:
+            self.port = kwargs['skarab_control_port']
+        except KeyError:
+            self.port = sd.ETHERNET_CONTROL_PORT_ADDRESS
 
         # sequence number for control packets
         self._seq_num = None
         self.reset_seq_num()
 
         # create tuple for ethernet control packet address
-        self.skarab_eth_ctrl_addr = (
-            self.host, sd.ETHERNET_CONTROL_PORT_ADDRESS)
+        self.skarab_eth_ctrl_addr = (self.host, self.port)
 
         # create tuple for fabric packet address
         self.skarab_fpga_addr = (self.host, sd.ETHERNET_FABRIC_PORT_ADDRESS)
@@ -177,10 +185,10 @@ class SkarabTransport(Transport):
         if self.blocking:
             if self.is_connected():
                 self.logger.info('Port({}) created & connected.'.format(
-                    sd.ETHERNET_CONTROL_PORT_ADDRESS))
+                    self.port))
             else:
                 self.logger.error('Error connecting to {}: port{}'.format(self.host,
-                    sd.ETHERNET_CONTROL_PORT_ADDRESS))
+                    self.port))
 
         # self.image_chunks, self.local_checksum = None, None
         # TODO - add the one_gbe
@@ -396,6 +404,56 @@ class SkarabTransport(Transport):
         # return the number of bytes requested
         return data[offset_diff: size]
 
+    def read_many(self, reads, timeout=None, retries=None):
+        """
+        Read from several memory devices. Reads of adjacent or overlapping
+        addresses are merged into as few bulk read requests as possible.
+        Gaps between devices are never read.
+
+        :param reads: a list of (device_name, size, offset) tuples
+        :param timeout: value in seconds to wait before aborting instruction
+                        - Default value is None, uses initialised value
+        :param retries: value specifying number of retries should instruction fail
+                        - Default value is None, uses initialised value
+        :return: a list of binary data strings, one per read
+        """
+        if timeout is None: timeout=self.timeout
+        if retries is None: retries=self.retries
+
+        spans = []
+        for ctr, (device_name, size, offset) in enumerate(reads):
+            addr = self._get_device_address(device_name) + offset
+            start = addr - (addr % 4)
+            end = addr + size + ((-(addr + size)) % 4)
+            spans.append((start, end, addr, size, ctr))
+        spans.sort()
+        max_bytes = sd.MAX_READ_32WORDS * 4
+        results = [None] * len(reads)
+        # each group is [start, end, spans]
+        groups = []
+        for span in spans:
+            if groups:
+                group = groups[-1]
+                if (span[0] <= group[1]) and \
+                        (max(span[1], group[1]) - group[0] <= max_bytes):
+                    group[1] = max(span[1], group[1])
+                    group[2].append(span)
+                    continue
+            groups.append([span[0], span[1], [span]])
+        for group_start, group_end, group_spans in groups:
+            if len(group_spans) == 1:
+                ctr = group_spans[0][4]
+                results[ctr] = self.read(*reads[ctr], timeout=timeout,
+                                         retries=retries)
+                continue
+            data = self._bulk_read_req(group_start,
+                                       (group_end - group_start) / 4,
+                                       timeout=timeout, retries=retries)
+            for _, _, addr, size, ctr in group_spans:
+                results[ctr] = data[addr - group_start:
+                                    addr - group_start + size]
+        return results
+
     def _bulk_write_req(self, address, data, words_to_write,
                         timeout=None,
                         retries=None):
@@ -415,10 +473,11 @@ class SkarabTransport(Transport):
                                'asked to write %i' % (sd.MAX_WRITE_32WORDS,
                                                       words_to_write))
         start_addr_high, start_addr_low = self.data_split_and_pack(address)
-        self.logger.debug('\nAddress High: {}\nAddress Low: {}'
-                     '\nWords To Write: {}'.format(repr(start_addr_high),
-                                                   repr(start_addr_low),
-                                                   words_to_write))
+        debug = CasperLogHandlers.debug_enabled(self.logger)
+        if debug:
+            self.logger.debug('\nAddress High: %r\nAddress Low: %r'
+                              '\nWords To Write: %i', start_addr_high,
+                              start_addr_low, words_to_write)
         request = sd.BigWriteWishboneReq(start_addr_high,
                                          start_addr_low, data, words_to_write)
         response = self.send_packet(request, timeout=timeout, retries=retries)
@@ -434,8 +493,9 @@ class SkarabTransport(Transport):
             errmsg = 'Wishbone timeout. Address 0x{:x}'.format(address)
             raise SkarabWriteFailed(errmsg)
 
-        self.logger.debug('Number of writes dones: %d' %
-                     response.packet['number_of_writes_done'])
+        if debug:
+            self.logger.debug('Number of writes dones: %d',
+                              response.packet['number_of_writes_done'])
 
         return response.packet['number_of_writes_done']
 
@@ -467,30 +527,33 @@ class SkarabTransport(Transport):
         num_words_to_write = int(math.ceil(size / 4.0))
         max_write_words = 1.0 * sd.MAX_WRITE_32WORDS
         num_writes = int(math.ceil(num_words_to_write / max_write_words))
-        self.logger.debug('words_to_write(%i) loops(%i)' % (num_words_to_write,
-                                                            num_writes))
+        debug = CasperLogHandlers.debug_enabled(self.logger)
+        if debug:
+            self.logger.debug('words_to_write(%i) loops(%i)',
+                              num_words_to_write, num_writes)
         write_data_left = num_words_to_write
         data_start = 0
         number_of_writes_done = 0
         for wrctr in range(num_writes):
-            self.logger.debug('In write loop %i' % wrctr)
             # determine the number of 32-bit words to write
             to_write = (sd.MAX_WRITE_32WORDS if write_data_left >
                         sd.MAX_WRITE_32WORDS
                         else write_data_left)
 
-            self.logger.debug('words to write ..... %i' % to_write)
-
             # get the data that is to be written in the next transaction
             write_data = data[data_start: data_start + to_write*4]
-            self.logger.debug('Write Data Size: %i' % (len(write_data)/4))
+            if debug:
+                self.logger.debug('In write loop %i, words to write %i, '
+                                  'write data size %i', wrctr, to_write,
+                                  len(write_data) / 4)
 
             if to_write < sd.MAX_WRITE_32WORDS:
                 # if writing less than the max number of words we need to pad
                 # to the request packet size
                 padding = (sd.MAX_READ_32WORDS - to_write)
-                self.logger.debug('we are padding . . . %i . . . 32-bit words . . '
-                             '.' % padding)
+                if debug:
+                    self.logger.debug('we are padding . . . %i . . . 32-bit '
+                                      'words . . .', padding)
                 write_data += '\x00\x00\x00\x00' * padding
 
             number_of_writes_done += self._bulk_write_req(address, write_data,
@@ -500,7 +563,9 @@ class SkarabTransport(Transport):
             address += to_write * 4
             data_start += to_write * 4
 
-        self.logger.debug('Number of writes dones: %d' % number_of_writes_done)
+        if debug:
+            self.logger.debug('Number of writes dones: %d',
+                              number_of_writes_done)
         if number_of_writes_done != num_words_to_write:
             errmsg = 'Bulk write failed. Only %i . . . of %i . . . 32-bit ' \
                      'words written' % (number_of_writes_done,
@@ -831,7 +896,41 @@ class SkarabTransport(Transport):
             timeout = self.timeout
         if retries is None:
             retries = self.retries
+        if self.trace_hooks:
+            address, size = self._trace_request_info(request_object)
+            return tracing.traced_call(
+                self.trace_hooks, tracing.LAYER_TRANSPORT,
+                type(request_object).__name__, self.host, '', address, size,
+                None, self._send_sequenced, request_object, timeout, retries)
+        return self._send_sequenced(request_object, timeout, retries)
+
+    @staticmethod
+    def _trace_request_info(request_object):
+        """
+        Get the wishbone address and size of a request, for tracing.
 
+        :return: (address, size in bytes), NO_ADDRESS and 0 for requests
+            that are not wishbone accesses
+        """
+        packet = request_object.packet
+        try:
+            if 'address_high' in packet:
+                return struct.unpack('!I', packet['address_high'] +
+                                     packet['address_low'])[0], 4
+            if 'start_address_high' in packet:
+                words = packet.get('number_of_reads',
+                                   packet.get('number_of_writes', 0))
+                return struct.unpack('!I', packet['start_address_high'] +
+                                     packet['start_address_low'])[0], \
+                    words * 4
+        except (TypeError, struct.error):
+            pass
+        return tracing.NO_ADDRESS, 0
+
+    def _send_sequenced(self, request_object, timeout, retries):
+        """
+        Give a request the next sequence number and send it.
+        """
         with Lock():
             if self._seq_num >= 0xffff:
                 self._seq_num = 0
@@ -861,19 +960,33 @@ class SkarabTransport(Transport):
         self._lock.acquire()
         # create the payload and send it
         request_payload = request_object.create_payload(sequence_number)
+        request_name = type(request_object).__name__
+        start_time = time.time()
+        # ask the logger once per request, not for every message
+        debug = CasperLogHandlers.debug_enabled(self.logger)
         retransmit_count = 0
         while retransmit_count < retries:
-            self.logger.debug('{}: retransmit attempts: {}, timeout = {}, retries = {}'.format(
-                hostname, retransmit_count, timeout, retries))
+            if debug:
+                self.logger.debug(
+                    '%s: retransmit attempts: %i, timeout = %s, retries = %i',
+                    hostname, retransmit_count, timeout, retries)
             try:
-                self.logger.debug('{}: sending pkt({}, {}) to port {}.'.format(
-                    hostname, request_object.packet['command_type'],
-                    request_object.packet['seq_num'], addr))
+                if debug:
+                    self.logger.debug(
+                        '%s: sending pkt(%s, %s) to port %s.', hostname,
+                        request_object.packet['command_type'],
+                        request_object.packet['seq_num'], addr)
                 self._skarab_control_sock.send(request_payload)
+                self.metrics.sent(len(request_payload))
+                if retransmit_count > 0:
+                    self.metrics.retransmit()
                 if not request_object.expect_response:
-                    self.logger.debug(
-                        '{}: no response expected for seq {}, '
-                        'returning'.format(hostname, sequence_number))
+                    if debug:
+                        self.logger.debug(
+                            '%s: no response expected for seq %i, '
+                            'returning', hostname, sequence_number)
+                    self.metrics.record(request_name,
+                                        time.time() - start_time)
                     self._lock.release()
                     return None
                 # get a required response
@@ -882,7 +995,9 @@ class SkarabTransport(Transport):
                     # here we want to receive a packet from the socket
                     # we pass the socket to the receive_packet function
                     rx_packet = self._receive_packet(
-                        request_object, sequence_number, timeout, hostname)
+                        request_object, sequence_number, timeout, hostname,
+                        debug)
+                self.metrics.record(request_name, time.time() - start_time)
                 self._lock.release()
                 return rx_packet
             except SkarabResponseNotReceivedError:
@@ -903,6 +1018,7 @@ class SkarabTransport(Transport):
                 self._lock.release()
                 raise KeyboardInterrupt
             retransmit_count += 1
+        self.metrics.failure(request_name)
         self._lock.release()
         errmsg = ('{}: retransmit count exceeded, giving up: {}, timeout = {}, retries = {}'.format(
             hostname, retransmit_count, timeout, retries))
@@ -910,7 +1026,7 @@ class SkarabTransport(Transport):
         raise SkarabSendPacketError(errmsg)
 
     def _receive_packet(self, request_object, sequence_number,
-                        timeout, hostname):
+                        timeout, hostname, debug=False):
         """
         Receive a response to a packet.
 
@@ -918,10 +1034,13 @@ class SkarabTransport(Transport):
         :param sequence_number:
         :param timeout:
         :param hostname:
+        :param debug: log each packet at DEBUG, see
+            CasperLogHandlers.debug_enabled
         :return: The response object, or None
         """
-        self.logger.debug('%s: reading response to sequence id %i.' % (
-            hostname, sequence_number))
+        if debug:
+            self.logger.debug('%s: reading response to sequence id %i.',
+                              hostname, sequence_number)
 
         try:
             # wait for response until timeout
@@ -930,9 +1049,11 @@ class SkarabTransport(Transport):
             if data_ready[0]:
                 data = self._skarab_control_sock.recvfrom(4096)
                 response_payload, address = data
+                self.metrics.received(len(response_payload))
 
-                self.logger.debug('%s: response from %s = %s' % (
-                    hostname, str(address), repr(response_payload)))
+                if debug:
+                    self.logger.debug('%s: response from %s = %r', hostname,
+                                      address, response_payload)
 
                 # check if response is from the expected SKARAB
                 recvd_from_addr = address[0]
@@ -943,89 +1064,76 @@ class SkarabTransport(Transport):
                         '%s: received response from  %s, expected response from '
                         '%s. Discarding response.' % (
                             hostname, recvd_from_addr, expected_recvd_from_addr))
+                    self.metrics.discard('wrong_host')
                     return None
                 # check the opcode of the response i.e. first two bytes
                 if response_payload[:2] == '\xff\xff':
                     self.logger.warning('%s: received unsupported opcode: 0xffff. '
                                         'Discarding response.' % hostname)
+                    self.metrics.discard('unsupported_opcode')
                     return None
                 # check response packet size
                 if (len(response_payload)/2) != request_object.num_response_words:
                     self.logger.warning("%s: incorrect response packet size. "
-                                        "Discarding response" % hostname)
-
-                    # self.logger.pdebug("Response packet not of correct size. "
-                    self.logger.debug("Response packet not of correct size. "
-                                      "Expected %i words, got %i words.\n "
-                                      "Incorrect Response: %s" % (
-                                        request_object.num_response_words,
-                                        (len(response_payload)/2),
-                                        repr(response_payload)))
-                    # self.logger.pdebug("%s: command ID - expected (%i) got (%i)" %
-                    self.logger.debug("%s: command ID - expected (%i) got (%i)" %
-                                      (hostname, request_object.type + 1,
-                                       (struct.unpack('!H', response_payload[:2]))[0]))
-                    # self.logger.pdebug("%s: sequence num - expected (%i) got (%i)" %
-                    self.logger.debug("%s: sequence num - expected (%i) got (%i)" %
-                                      (hostname, sequence_number,
-                                       (struct.unpack('!H', response_payload[2:4]))[0]))
+                                        "Discarding response", hostname)
+                    if debug:
+                        self.logger.debug(
+                            "Response packet not of correct size. Expected %i "
+                            "words, got %i words.\n Incorrect Response: %r",
+                            request_object.num_response_words,
+                            len(response_payload) / 2, response_payload)
+                        self.logger.debug(
+                            "%s: command ID - expected (%i) got (%i)",
+                            hostname, request_object.type + 1,
+                            struct.unpack('!H', response_payload[:2])[0])
+                        self.logger.debug(
+                            "%s: sequence num - expected (%i) got (%i)",
+                            hostname, sequence_number,
+                            struct.unpack('!H', response_payload[2:4])[0])
+                    self.metrics.discard('wrong_size')
                     return None
 
                 # unpack the response before checking it
                 response_object = request_object.response.from_raw_data(
                     response_payload, request_object.num_response_words,
                     request_object.pad_words)
-                self.logger.debug('%s: response from %s, with seq num %i' % (
-                    hostname, str(address),
-                    response_object.seq_num))
+                if debug:
+                    self.logger.debug('%s: response from %s, with seq num %i',
+                                      hostname, address,
+                                      response_object.seq_num)
                 expected_response_id = request_object.type + 1
                 if response_object.type != expected_response_id:
-                    # Implementing a monkey patch here. On the MeerKAT site when the
-                    # corr2_hardware_sensor_servlet and the corr2_servlet are running at the same
-                    # time we periodically get the command ID warning below. It does not affect the
-                    # operation of the telescope, but it does clutter the KCS logs. The
-                    # corr2_servlet has two log handlers that propagate down to casperfpga. One
-                    # handler sends data to a log file, while the other sends it to the console.
-                    # The patch here is to disable the console logger for this one warning message.
-                    # When this error occurs it will only be written to the log file, not to the
-                    # console(which is collected by KCS). In this way we preserve the error without
-                    # cluttering KCS.
-
-                    # Find console handler and set to such a high level that the warning wont print.
-                    handlers = self.logger.handlers 
-                    concoleLogHandlerDisabled = False
-                    for handler in handlers:
-                        if(issubclass(type(handler), CasperLogHandlers.CasperConsoleHandler)):
-                            handler.setLevel(logging.CRITICAL)
-                            consoleLogHandler = handler
-                            concoleLogHandlerDisabled = True
-                            break
-                    
-                    # Print the log message
-                    self.logger.warning('%s: incorrect command ID in response. Expected'
-                                   '(%i) got(%i). Discarding response.' % (
-                                       hostname, expected_response_id,
-                                       response_object.type))
-
-                    # Set log levels back to what they were originally
-                    if concoleLogHandlerDisabled:
-                        consoleLogHandler.setLevel(self.logger.getEffectiveLevel())
-
+                    # On the MeerKAT site, when the corr2_hardware_sensor_servlet
+                    # and the corr2_servlet run at the same time, this warning
+                    # turns up periodically. It is harmless, and the console
+                    # handler rate-limits repeats of it so that it doesn't
+                    # clutter the KCS logs. A file handler on the logger,
+                    # e.g. one added by getNewLogger, still records every one.
+                    self.logger.warning('%s: incorrect command ID in response. '
+                                        'Expected(%i) got(%i). Discarding '
+                                        'response.', hostname,
+                                        expected_response_id,
+                                        response_object.type)
+                    self.metrics.discard('wrong_command')
                     return None
                 elif response_object.seq_num != sequence_number:
-                    self.logger.debug('%s: incorrect sequence number in response. '
-                                   'Expected(%i,%i), got(%i). Discarding '
-                                   'response.' % (
-                                       hostname, sequence_number,
-                                       request_object.packet['seq_num'],
-                                       response_object.seq_num))
+                    if debug:
+                        self.logger.debug(
+                            '%s: incorrect sequence number in response. '
+                            'Expected(%i,%s), got(%i). Discarding response.',
+                            hostname, sequence_number,
+                            request_object.packet['seq_num'],
+                            response_object.seq_num)
+                    self.metrics.discard('wrong_seq')
                     return None
                 return response_object
             else:
                 errmsg = '%s: timeout; no packet received for seq %i. Will ' \
                          'retransmit as seq %i.' % (
                              hostname, sequence_number, sequence_number + 1)
-                self.logger.debug(errmsg)
+                if debug:
+                    self.logger.debug(errmsg)
+                self.metrics.timeout()
                 raise SkarabResponseNotReceivedError(errmsg)
 
         except KeyboardInterrupt:
@@ -1860,12 +1968,7 @@ class SkarabTransport(Transport):
         file_extension = os.path.splitext(filename)[1]
         image_to_program = ''
 
-        # Need to change file-handler to use skarab_fileops.choose_processor(filename)
-        #binname = '/tmp/fpgstream_' + str(self.parent) + '.bin'
-        processor = skfops.choose_processor(filename)
-        processor = processor(filename, extract_to_disk=False)
-        #image_to_program, binname = processor.make_bin()
-        image_to_program, _none = processor.make_bin()
+        image_to_program = skfops.read_cached_bitstream(filename)
 
         self.logger.debug('VIRTEX FLASH RECONFIG: Analysing Words')
         # Can still analyse the filename, as the file size should still
@@ -0,0 +1,197 @@
+"""
+Lightweight metrics for a transport: how many requests of each kind were
+made and how long they took, how many packets and bytes went each way,
+and how many packets were retransmitted, timed out or discarded.
+
+Every Transport has a TransportStats as its metrics attribute. Read it
+with transport.stats(), clear it with transport.reset_stats().
+"""
+
+import math
+import time
+
+# latencies are counted in power-of-two buckets of microseconds, bucket
+# i holding latencies below 2**i us, the last bucket holding the rest
+NUM_LATENCY_BUCKETS = 32
+
+
+def _bucket_percentile(histogram, count, fraction):
+    """
+    Estimate a percentile from a latency histogram.
+
+    :return: the upper bound, in seconds, of the bucket holding the
+        percentile
+    """
+    target = fraction * count
+    total = 0
+    for bucket, bucket_count in enumerate(histogram):
+        total += bucket_count
+        if total >= target:
+            return (2 ** bucket) / 1e6
+    return (2 ** (len(histogram) - 1)) / 1e6
+
+
+class TransportStats(object):
+    """
+    Counters and latency histograms for one transport.
+
+    The counters are updated without a lock, to keep the cost per request
+    to a microsecond or so. Transports serialise their own requests, and
+    the worst a race between threads can do is lose a count.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all the counters.
+        """
+        self.since = time.time()
+        self.packets_out = 0
+        self.packets_in = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.retransmits = 0
+        self.timeouts = 0
+        # reason -> count
+        self.discarded = {}
+        # request name -> count
+        self.failures = {}
+        # request name -> [count, total latency, max latency, histogram]
+        self.requests = {}
+
+    def record(self, name, latency):
+        """
+        Count a completed request.
+
+        :param name: the request name, e.g. the katcp request or the
+            SKARAB command
+        :param latency: how long the request took, in seconds
+        """
+        bucket = math.frexp(latency * 1e6)[1] if latency >= 1e-6 else 0
+        if bucket >= NUM_LATENCY_BUCKETS:
+            bucket = NUM_LATENCY_BUCKETS - 1
+        try:
+            entry = self.requests[name]
+        except KeyError:
+            entry = [0, 0.0, 0.0, [0] * NUM_LATENCY_BUCKETS]
+            self.requests[name] = entry
+        entry[0] += 1
+        entry[1] += latency
+        if latency > entry[2]:
+            entry[2] = latency
+        entry[3][bucket] += 1
+
+    def sent(self, nbytes, packets=1):
+        """
+        Count packets or messages sent.
+        """
+        self.packets_out += packets
+        self.bytes_out += nbytes
+
+    def received(self, nbytes, packets=1):
+        """
+        Count packets or messages received.
+        """
+        self.packets_in += packets
+        self.bytes_in += nbytes
+
+    def retransmit(self, packets=1):
+        """
+        Count resent packets or repeated requests.
+        """
+        self.retransmits += packets
+
+    def timeout(self):
+        """
+        Count a wait for a response that timed out.
+        """
+        self.timeouts += 1
+
+    def discard(self, reason):
+        """
+        Count a response that was received but thrown away.
+
+        :param reason: why, e.g. wrong_seq, wrong_command or wrong_size
+        """
+        self.discarded[reason] = self.discarded.get(reason, 0) + 1
+
+    def failure(self, name):
+        """
+        Count a request that gave up without a usable response.
+        """
+        self.failures[name] = self.failures.get(name, 0) + 1
+
+    def merge(self, other):
+        """
+        Add another TransportStats' counters to these.
+        """
+        self.since = min(self.since, other.since)
+        self.packets_out += other.packets_out
+        self.packets_in += other.packets_in
+        self.bytes_out += other.bytes_out
+        self.bytes_in += other.bytes_in
+        self.retransmits += other.retransmits
+        self.timeouts += other.timeouts
+        for reason, count in other.discarded.items():
+            self.discarded[reason] = self.discarded.get(reason, 0) + count
+        for name, count in other.failures.items():
+            self.failures[name] = self.failures.get(name, 0) + count
+        for name, (count, total, maximum, histogram) in \
+                other.requests.items():
+            try:
+                entry = self.requests[name]
+            except KeyError:
+                entry = [0, 0.0, 0.0, [0] * NUM_LATENCY_BUCKETS]
+                self.requests[name] = entry
+            entry[0] += count
+            entry[1] += total
+            entry[2] = max(entry[2], maximum)
+            entry[3] = [ctr + other_ctr for ctr, other_ctr in
+                        zip(entry[3], histogram)]
+
+    @classmethod
+    def merged(cls, stats_list):
+        """
+        A new TransportStats holding the sum of several.
+        """
+        total = cls()
+        for stats in stats_list:
+            total.merge(stats)
+        return total
+
+    def to_dict(self):
+        """
+        The counters as a dictionary. Latencies are in seconds, the
+        percentiles being the upper bounds of their histogram buckets.
+        Histograms are keyed on the bucket upper bound in microseconds.
+        """
+        requests = {}
+        for name, (count, total, maximum, histogram) in \
+                self.requests.items():
+            requests[name] = {
+                'count': count,
+                'mean': total / count,
+                'max': maximum,
+                'p50': _bucket_percentile(histogram, count, 0.5),
+                'p90': _bucket_percentile(histogram, count, 0.9),
+                'p99': _bucket_percentile(histogram, count, 0.99),
+                'histogram': dict(
+                    (2 ** bucket, bucket_count) for bucket, bucket_count
+                    in enumerate(histogram) if bucket_count > 0),
+            }
+        return {
+            'since': self.since,
+            'elapsed': time.time() - self.since,
+            'packets_out': self.packets_out,
+            'packets_in': self.packets_in,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'retransmits': self.retransmits,
+            'timeouts': self.timeouts,
+            'discarded': dict(self.discarded),
+            'failures': dict(self.failures),
+            'requests': requests,
+        }
+
+# end
@@ -1,16 +1,34 @@
 import logging
 import struct
+import time
+import threading
 from StringIO import StringIO
-import zlib
 import hashlib
 
+import tracing
 from transport import Transport
+from fpg_image import FpgImage
+from tftp_client import WindowedTftpClient
 
 __author__ = 'jackh'
 __date__ = 'June 2017'
 
+LOGGER = logging.getLogger(__name__)
+
 TFTPY = None
 
+# TFTP options asked for on bulk reads and writes. Servers that refuse
+# them get plain 512-byte, lock-step transfers.
+DEFAULT_BLKSIZE = 1024
+DEFAULT_WINDOWSIZE = 8
+
+# the user image area of the SNAP flash, and its erase sector size
+USER_FLASH_LOC = 0x800000
+FLASH_SECTOR_SIZE = 0x10000
+
+# the most flash sectors tapcp_program_many writes at once, over all boards
+MAX_PARALLEL_SECTOR_WRITES = 32
+
 def set_log_level(level):
     TFTPY.setLogLevel(level)
 
@@ -71,6 +89,7 @@ class TapcpTransport(Transport):
         Initialized Tapcp FPGA object
 
         :param host: IP Address of the targeted Board
+        :param tftp_port: the TFTP port, only changed to talk to an emulator
         """
         try:
             import tftpy
@@ -82,7 +101,10 @@ class TapcpTransport(Transport):
         
         Transport.__init__(self, **kwargs)
         set_log_level(logging.ERROR)
-        self.t = tftpy.TftpClient(kwargs['host'], 69)
+        # not the generic port kwarg, which CasperFpga and
+        # threaded_create_fpgas_from_hosts fill with the katcp port
+        self.port = kwargs.get('tftp_port', 69)
+        self.t = tftpy.TftpClient(kwargs['host'], self.port)
 	    
         try:
             self.parent = kwargs['parent_fpga']
@@ -96,6 +118,44 @@ class TapcpTransport(Transport):
         self.timeout = kwargs.get('timeout', 3)
         self.server_timeout = 0.1 # Microblaze timeout period. So that if a command fails we can wait for the microblaze to terminate the connection before retrying
         self.retries = kwargs.get('retries', 8) # These are retries of a complete transaction (each of which has it's ofw TFTP retries).
+        # read and blindwrite use a client that negotiates bigger blocks
+        # and windows, the other commands stick with tftpy
+        self._bulk_tftp = WindowedTftpClient(
+            kwargs['host'], self.port,
+            blksize=kwargs.get('blksize', DEFAULT_BLKSIZE),
+            windowsize=kwargs.get('windowsize', DEFAULT_WINDOWSIZE),
+            metrics=self.metrics)
+
+    @property
+    def blksize(self):
+        """
+        The TFTP block size, in bytes, asked for on reads and writes.
+        """
+        return self._bulk_tftp.blksize
+
+    @blksize.setter
+    def blksize(self, value):
+        self._bulk_tftp.blksize = value
+        self._bulk_tftp.options_refused = False
+
+    @property
+    def windowsize(self):
+        """
+        The TFTP window size, in blocks, asked for on reads and writes.
+        """
+        return self._bulk_tftp.windowsize
+
+    @windowsize.setter
+    def windowsize(self, value):
+        self._bulk_tftp.windowsize = value
+        self._bulk_tftp.options_refused = False
+
+    @property
+    def tftp_options(self):
+        """
+        The TFTP options agreed with the board for the last read or write.
+        """
+        return self._bulk_tftp.options.copy()
 
     @staticmethod
     def test_host_type(host_ip):
@@ -185,24 +245,21 @@ class TapcpTransport(Transport):
         """
         return self.is_connected()
 
-    def _extract_bitstream(self,filename):
+    @staticmethod
+    def _extract_bitstream(filename):
         """
         Extract the header and program bitstream from the input file provided.
         """
-        with open(filename, 'r') as fh:
-            fpg = fh.read()
-
-        header_offset = fpg.find('\n?quit\n') + 7
-        header = fpg[0:header_offset] + '0'*(1024-header_offset%1024)
-        prog = fpg[header_offset:]+'0'*(1024-(len(fpg)-header_offset)%1024)
-        
-        if prog.startswith('\x1f\x8b\x08'):
-            prog = zlib.decompress(prog, 16 + zlib.MAX_WBITS)
-
-        chksum = hashlib.md5()
-        chksum.update(fpg)
-
-        return header, prog, chksum.hexdigest()
+        with FpgImage(filename) as image:
+            header = image.header
+            header += '0'*(1024-len(header)%1024)
+            if image.compressed:
+                prog = image.bitstream()
+            else:
+                prog_len = image.size - image.bitstream_offset
+                prog = ''.join(list(image.iter_bitstream()) +
+                               ['0'*(1024-prog_len%1024)])
+            return header, prog, image.file_hash('md5')
 
     def get_metadata(self):
         """
@@ -212,7 +269,6 @@ class TapcpTransport(Transport):
         READ_CHUNK_SIZE = 1024     # size of flash chunks to read
         MAX_SEARCH      = 128*1024 # give up if we get this far
         meta   = ''
-        offset = 0
         # We want to find the end of the metadata, marked by the
         # string end. But, to save lots of short tftp commands
         # read data from flash 1kB at a time and search that
@@ -222,12 +278,9 @@ class TapcpTransport(Transport):
             page_offset += READ_CHUNK_SIZE
             if page_offset > MAX_SEARCH:
                 return None
-            for i in range(READ_CHUNK_SIZE/4):
-                meta += meta_page[4*i:4*(i+1)]
-                offset += 4
-                if (meta.find('?end')!=-1):
-                    break
-        
+            meta += meta_page
+        meta = meta[:meta.find('?end') + 4]
+
         metadict = {};        
         for _ in meta.split('?'):
              args = _.split('\t')
@@ -237,13 +290,17 @@ class TapcpTransport(Transport):
         return metadict
 
 
-    def _update_metadata(self,filename,hlen,plen,md5):
+    def _update_metadata(self,filename,hlen,plen,md5,sector_hashes=None):
         """
         Update the meta data at user_flash_loc. Metadata is written 
         as 5  32bit integers in the following order:
         header-location, length of header (in bytes), 
         program-location, length of the program bitstream (B),
         md5sum of the fpg file
+
+        If sector_hashes is given, the md5sum of every flash sector of the
+        header and program bitstream is also written, for incremental
+        programming.
         """
         USER_FLASH_LOC = 0x800000
         SECTOR_SIZE = 0x10000
@@ -257,6 +314,8 @@ class TapcpTransport(Transport):
         metadict['prog']  = '?prog_bitstream_start\t%d?prog_bitstream_length\t%d'%(prog_loc,plen)
         metadict['md5']   =  '?md5sum\t' + md5
         metadict['file']  = '?filename\t' + filename.split('/')[-1]
+        if sector_hashes:
+            metadict['sectors'] = '?sector_md5s\t' + ''.join(sector_hashes)
         for m in metadict.values():
             meta += m
         meta += '?end'
@@ -266,80 +325,137 @@ class TapcpTransport(Transport):
 
         return head_loc, prog_loc
 
+    @staticmethod
+    def _sector_hashes(payload, sector_size):
+        """
+        The md5sum of every flash sector of a payload, as hex strings.
+        """
+        return [hashlib.md5(payload[i:i + sector_size]).hexdigest()
+                for i in range(0, len(payload), sector_size)]
+
+    @staticmethod
+    def _sector_hashes_from_metadata(meta, sector_size):
+        """
+        The sector md5sums stored in the flash metadata, an empty list if
+        there are none or they are for a different sector size.
+        """
+        if (meta is None) or ('sector_md5s' not in meta):
+            return []
+        if int(meta.get('sector_size', -1)) != sector_size:
+            return []
+        hashes = meta['sector_md5s']
+        return [hashes[i:i + 32] for i in range(0, len(hashes), 32)]
+
+    def _write_flash_sectors(self, payload, base, sectors, sector_size):
+        """
+        Write and verify the given sectors of a payload to flash.
+
+        :param payload: the data to write
+        :param base: the flash address of the start of the payload
+        :param sectors: the indices of the sectors to write
+        :param sector_size: the flash sector size, in bytes
+        """
+        for ctr, i in enumerate(sectors):
+            data = payload[i*sector_size : (i+1)*sector_size]
+            self.logger.debug("sector %d (%d of %d): writing %d bytes" % (i, ctr+1, len(sectors), len(data)))
+            self.blindwrite('/flash', data, offset=base+i*sector_size)
+            readback = self.read('/flash', len(data), offset=base+i*sector_size)
+            if data != readback:
+                raise RuntimeError("Readback of flash failed!")
+
+    def _plan_flash_write(self, image, incremental=True):
+        """
+        Work out what must be written to flash for an image.
+
+        :param image: a TapcpFlashImage
+        :param incremental: only write the sectors that differ from the
+            manifest in the flash metadata
+        :return: None if the image is already in flash, otherwise a list
+            of the sectors to write
+        """
+        self.logger.debug("Reading meta-data from flash")
+        meta_inflash = self.get_metadata()
+        if (meta_inflash is not None) and \
+                (meta_inflash.get('md5sum') == image.md5):
+            return None
+        old_hashes = []
+        if incremental:
+            old_hashes = self._sector_hashes_from_metadata(
+                meta_inflash, image.sector_size)
+        return [i for i, sector_hash in enumerate(image.sector_hashes)
+                if (i >= len(old_hashes)) or (old_hashes[i] != sector_hash)]
+
+    def _begin_flash_write(self, image, changed):
+        """
+        Until every sector is written, the flash holds neither image. Mark
+        the changed sectors, and the image, as unknown first, so an
+        interrupted write is never booted or trusted next time.
+        """
+        changed = set(changed)
+        in_flux = [('-' * 32) if i in changed else sector_hash
+                   for i, sector_hash in enumerate(image.sector_hashes)]
+        self._update_metadata(image.filename, len(image.header),
+                              len(image.prog), '', in_flux)
+
+    def _finish_flash_write(self, image):
+        """
+        Write the final metadata for an image now in flash.
+
+        :return: the flash address of the program bitstream
+        """
+        self.logger.debug("Writing new header information")
+        _, prog_loc = self._update_metadata(
+            image.filename, len(image.header), len(image.prog), image.md5,
+            image.sector_hashes)
+        return prog_loc
+
     def upload_to_ram_and_program(self, filename, port=None, timeout=None,
-                                  wait_complete=True, **kwargs):
-        USER_FLASH_LOC = 0x800000
-        sector_size = 0x10000
+                                  wait_complete=True, incremental=True,
+                                  **kwargs):
+        """
+        Write an image to the user flash area and boot from it.
+
+        :param filename: the .fpg file, or a raw image to write to flash
+        :param incremental: for .fpg files, only write the flash sectors
+            that differ from those recorded in the flash metadata
+        """
+        sector_size = FLASH_SECTOR_SIZE
         # Flash writes can take a long time, due to ~1s erase cycle
         # So set the timeout high. We'll return it to normal at the end
         old_timeout = self.timeout
-        self._logger.debug("Old timeout was %f. Setting new timeout to 1.5s" % old_timeout)
+        self.logger.debug("Old timeout was %f. Setting new timeout to 1.5s" % old_timeout)
         self.timeout = 1.5
         if(filename.endswith('.fpg')):
-            self._logger.info("Programming with an .fpg file. Checking if it is already in flash")
-            header, prog, md5 = self._extract_bitstream(filename)
-            self._logger.debug("Reading meta-data from flash")
-            meta_inflash = self.get_metadata()
-            if ((meta_inflash is not None) and (meta_inflash['md5sum'] == md5)):
-                self._logger.info("Bitstream is already on flash.")
-                self._logger.debug("Returning timeout to %f" % old_timeout)
-                self.timeout = old_timeout
-                self._logger.info("Booting from existing user image.")
-                self.progdev(int(meta_inflash['prog_bitstream_start']))
-            else:
-                self._logger.info("Bitstream is not in flash. Writing new bitstream.")
-                self._logger.debug("Generating new header information")
-                HEAD_LOC, PROG_LOC = self._update_metadata(filename,len(header),len(prog),md5)
-                payload = header + prog
-                complete_blocks = len(payload) // sector_size
-                trailing_bytes = len(payload) % sector_size
-                for i in range(complete_blocks):
-                    self._logger.debug("block %d of %d: writing %d bytes:" % (i+1, complete_blocks, len(payload[i*sector_size : (i+1)*sector_size])))
-                    self.blindwrite('/flash', payload[i*sector_size : (i+1)*sector_size], offset=HEAD_LOC+i*sector_size)
-                    readback = self.read('/flash', len(payload[i*sector_size : (i+1)*sector_size]), offset=HEAD_LOC+i*sector_size)
-                    if payload[i*sector_size : (i+1)*sector_size] != readback:
-                        raise RuntimeError("Readback of flash failed!")
-                # Write the not-complete last sector (if any)
-                if trailing_bytes:
-                    self._logger.debug("writing trailing %d bytes" % trailing_bytes)
-                    last_offset = complete_blocks * sector_size
-                    self.blindwrite('/flash', payload[last_offset :], offset=HEAD_LOC+last_offset)
-                    readback = self.read('/flash', len(payload[last_offset :]), offset=HEAD_LOC+last_offset)
-                    if payload[last_offset :] != readback:
-                        raise RuntimeError("Readback of flash failed!")
-
-                self._logger.debug("Returning timeout to %f" % old_timeout)
+            self.logger.info("Programming with an .fpg file. Checking if it is already in flash")
+            image = TapcpFlashImage(filename)
+            try:
+                changed = self._plan_flash_write(image, incremental)
+                if changed is None:
+                    self.logger.info("Bitstream is already on flash.")
+                    prog_loc = image.prog_loc
+                else:
+                    self.logger.info("Bitstream is not in flash. Writing %d of %d flash sectors." % (len(changed), len(image.sector_hashes)))
+                    self._begin_flash_write(image, changed)
+                    self._write_flash_sectors(image.payload, image.head_loc, changed, sector_size)
+                    prog_loc = self._finish_flash_write(image)
+            finally:
+                self.logger.debug("Returning timeout to %f" % old_timeout)
                 self.timeout = old_timeout
-                # Program from new flash image!
-                self._logger.info("Booting from new bitstream")
-                self.progdev(PROG_LOC)
+            # Program from the flash image!
+            self.logger.info("Booting from user image.")
+            self.progdev(prog_loc)
 
         else:
-            self._logger.info("Programming something which isn't an .fpg file.")
-            self._logger.debug("Reading file %s" % filename)
+            self.logger.info("Programming something which isn't an .fpg file.")
+            self.logger.debug("Reading file %s" % filename)
             with open(filename,'r') as fh:
                 payload = fh.read()
-            complete_blocks = len(payload) // sector_size
-            trailing_bytes = len(payload) % sector_size
-            for i in range(complete_blocks):
-                self._logger.debug("block %d of %d: writing %d bytes:" % (i+1, complete_blocks, len(payload[i*sector_size : (i+1)*sector_size])))
-                self.blindwrite('/flash', payload[i*sector_size : (i+1)*sector_size], offset=USER_FLASH_LOC+i*sector_size)
-                readback = self.read('/flash', len(payload[i*sector_size : (i+1)*sector_size]), offset=USER_FLASH_LOC+i*sector_size)
-                if payload[i*sector_size : (i+1)*sector_size] != readback:
-                    raise RuntimeError("Readback of flash failed!")
-
-            # Write the not-complete last sector (if any)
-            if trailing_bytes:
-                self._logger.debug("writing trailing %d bytes" % trailing_bytes)
-                last_offset = complete_blocks * sector_size
-                self.blindwrite('/flash', payload[last_offset :], offset=USER_FLASH_LOC+last_offset)
-                readback = self.read('/flash', len(payload[last_offset :]), offset=USER_FLASH_LOC+last_offset)
-                if payload[last_offset :] != readback:
-                    raise RuntimeError("Readback of flash failed!")
-            self._logger.debug("Returning timeout to %f" % old_timeout)
+            num_sectors = (len(payload) + sector_size - 1) // sector_size
+            self._write_flash_sectors(payload, USER_FLASH_LOC, range(num_sectors), sector_size)
+            self.logger.debug("Returning timeout to %f" % old_timeout)
             self.timeout = old_timeout
             # Program from new flash image!
-            self._logger.info("Booting from new bitstream")
+            self.logger.info("Booting from new bitstream")
             self.progdev(USER_FLASH_LOC)
 
     def _program_new_golden_image(self, imagefile):
@@ -391,20 +507,36 @@ class TapcpTransport(Transport):
         :param use_bulk: Does nothing. Kept for API compatibility
         :return: binary data string
         """
+        if self.trace_hooks:
+            return tracing.traced_call(
+                self.trace_hooks, tracing.LAYER_TRANSPORT, 'read', self.host,
+                device_name, tracing.device_address(
+                    self.memory_devices, device_name, offset),
+                size, None, self._read, device_name, size, offset)
+        return self._read(device_name, size, offset)
+
+    def _read(self, device_name, size, offset):
+        start_time = time.time()
         for retry in range(self.retries - 1):
             try:
                 buf = StringIO()
-                self.t.download('%s.%x.%x' % (device_name, offset//4, size//4), buf, timeout=self.timeout)
+                self._bulk_tftp.download('%s.%x.%x' % (device_name, offset//4, size//4), buf, timeout=self.timeout)
+                self.metrics.record('read', time.time() - start_time)
                 return buf.getvalue()
             except:
                 # if we fail to get a response after a bunch of packet re-sends, wait for the
                 # server to timeout and restart the whole transaction.
-                self.t.context.end()
+                self.metrics.retransmit()
                 time.sleep(self.server_timeout)
                 LOGGER.info('Tftp error on read -- retrying.')
         LOGGER.warning('Several Tftp errors on read -- final retry.')
         buf = StringIO()
-        self.t.download('%s.%x.%x' % (device_name, offset//4, size//4), buf, timeout=self.timeout)
+        try:
+            self._bulk_tftp.download('%s.%x.%x' % (device_name, offset//4, size//4), buf, timeout=self.timeout)
+        except Exception:
+            self.metrics.failure('read')
+            raise
+        self.metrics.record('read', time.time() - start_time)
         return buf.getvalue()
 
     def blindwrite(self, device_name, data, offset=0, use_bulk=True):
@@ -419,20 +551,36 @@ class TapcpTransport(Transport):
         assert (type(data) == str), 'Must supply binary packed string data'
         assert (len(data) % 4 == 0), 'Must write 32-bit-bounded words'
         assert (offset % 4 == 0), 'Must write 32-bit-bounded words'
+        if self.trace_hooks:
+            return tracing.traced_call(
+                self.trace_hooks, tracing.LAYER_TRANSPORT, 'write',
+                self.host, device_name, tracing.device_address(
+                    self.memory_devices, device_name, offset),
+                len(data), data, self._blindwrite, device_name, data, offset)
+        return self._blindwrite(device_name, data, offset)
+
+    def _blindwrite(self, device_name, data, offset):
+        start_time = time.time()
         for retry in range(self.retries - 1):
             try:
                 buf = StringIO(data)
-                self.t.upload('%s.%x.0' % (device_name, offset//4), buf, timeout=self.timeout)
+                self._bulk_tftp.upload('%s.%x.0' % (device_name, offset//4), buf, timeout=self.timeout)
+                self.metrics.record('write', time.time() - start_time)
                 return
             except:
                 # if we fail to get a response after a bunch of packet re-sends, wait for the
                 # server to timeout and restart the whole transaction.
-                self.t.context.end()
+                self.metrics.retransmit()
                 time.sleep(self.server_timeout)
                 LOGGER.info('Tftp error on write -- retrying')
         LOGGER.warning('Several Tftp errors on write-- final retry.')
         buf = StringIO(data)
-        self.t.upload('%s.%x.0' % (device_name, offset//4), buf, timeout=self.timeout)
+        try:
+            self._bulk_tftp.upload('%s.%x.0' % (device_name, offset//4), buf, timeout=self.timeout)
+        except Exception:
+            self.metrics.failure('write')
+            raise
+        self.metrics.record('write', time.time() - start_time)
 
     def deprogram(self):
         """
@@ -479,3 +627,113 @@ class TapcpTransport(Transport):
         :return: golden_image, multiboot, soc_major_version, soc_minor_version
         """
         raise NotImplementedError
+
+
+class TapcpFlashImage(object):
+    """
+    An .fpg file prepared for writing to the user area of a SNAP flash: the
+    header and (decompressed) program bitstream, and their sector md5sums.
+    Prepared once, it can be written to any number of boards.
+    """
+    def __init__(self, filename, sector_size=FLASH_SECTOR_SIZE):
+        """
+
+        :param filename: the .fpg file
+        :param sector_size: the flash sector size, in bytes
+        """
+        self.filename = filename
+        self.sector_size = sector_size
+        self.header, self.prog, self.md5 = \
+            TapcpTransport._extract_bitstream(filename)
+        self.payload = self.header + self.prog
+        self.sector_hashes = TapcpTransport._sector_hashes(self.payload,
+                                                           sector_size)
+        # the layout written by TapcpTransport._update_metadata
+        self.head_loc = USER_FLASH_LOC + sector_size
+        self.prog_loc = self.head_loc + len(self.header)
+
+
+def _tapcp_program_one(fpga, image, sector_limit, incremental, progress,
+                       result):
+    """
+    Write a prepared image to one board's flash and boot it, for
+    tapcp_program_many. Progress is recorded in the result dictionary as
+    it happens.
+    """
+    stime = time.time()
+    transport = fpga.transport
+    if not isinstance(transport, TapcpTransport):
+        raise TypeError('%s is not a TAPCP board' % fpga.host)
+    old_timeout = transport.timeout
+    transport.timeout = 1.5
+    try:
+        changed = transport._plan_flash_write(image, incremental)
+        if changed is None:
+            result['already_in_flash'] = True
+            prog_loc = image.prog_loc
+        else:
+            transport._begin_flash_write(image, changed)
+            for ctr, sector in enumerate(changed):
+                with sector_limit:
+                    transport._write_flash_sectors(
+                        image.payload, image.head_loc, [sector],
+                        image.sector_size)
+                result['sectors_written'] = ctr + 1
+                if progress is not None:
+                    progress(fpga.host, ctr + 1, len(changed))
+            prog_loc = transport._finish_flash_write(image)
+    finally:
+        transport.timeout = old_timeout
+        result['time'] = time.time() - stime
+    transport.progdev(prog_loc)
+    fpga.bitstream = image.filename
+    result['ok'] = True
+    result['time'] = time.time() - stime
+
+
+def tapcp_program_many(fpgas, filename, incremental=True,
+                       max_parallel=MAX_PARALLEL_SECTOR_WRITES,
+                       progress=None, timeout=None):
+    """
+    Program many TAPCP boards with the same .fpg file at once. The file is
+    read and prepared once, then the boards' flash sectors are written
+    concurrently.
+
+    :param fpgas: a list of CasperFpga objects with TAPCP transports
+    :param filename: the .fpg file
+    :param incremental: only write the flash sectors that differ on each
+        board
+    :param max_parallel: the most flash sectors to write at the same time,
+        over all the boards
+    :param progress: a function called as progress(host, sectors_written,
+        sectors_to_write) after every sector
+    :param timeout: how long to wait for all the boards, in seconds, None
+        waits forever
+    :return: a dictionary, keyed on hostname, of result dictionaries with
+        the keys ok, already_in_flash, sectors_written, sectors_total,
+        time and error
+    """
+    import utils
+    image = TapcpFlashImage(filename)
+    sector_limit = threading.BoundedSemaphore(max_parallel)
+    results = {}
+    futures = {}
+    pool = utils.get_worker_pool()
+    for fpga in fpgas:
+        results[fpga.host] = {
+            'ok': False, 'already_in_flash': False, 'sectors_written': 0,
+            'sectors_total': len(image.sector_hashes), 'time': 0.0,
+            'error': None}
+        futures[fpga.host] = pool.submit(
+            _tapcp_program_one, fpga, image, sector_limit, incremental,
+            progress, results[fpga.host])
+    deadline = None if timeout is None else time.time() + timeout
+    for host, future in futures.items():
+        try:
+            future.result(None if deadline is None else
+                          max(deadline - time.time(), 0))
+        except Exception as exc:
+            LOGGER.error('%s: programming %s failed: %s' % (
+                host, filename, exc))
+            results[host]['error'] = str(exc) or type(exc).__name__
+    return results
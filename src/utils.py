@@ -2,10 +2,19 @@ from __future__ import print_function
 import threading
 import Queue
 import time
+import random
 import logging
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+from fpg_image import FpgImage
 
 LOGGER = logging.getLogger(__name__)
 
+# the most worker threads the shared FPGA worker pool will start - enough
+# to run an operation on a whole 256-board array at once, as the work is
+# almost all waiting on the network
+MAX_WORKERS = 256
+
 
 class CheckCounter(object):
 
@@ -78,22 +87,26 @@ def parse_fpg(filename):
     :return: device info dictionary, memory map info (coreinfo.tab) dictionary
     """
     LOGGER.debug('Parsing file %s for system information' % filename)
-    if filename is not None:
-        fptr = open(filename, 'r')
-        firstline = fptr.readline().strip().rstrip('\n')
-        if firstline != '#!/bin/kcpfpg':
-            fptr.close()
-            raise RuntimeError('%s does not look like an fpg file we can '
-                               'parse.' % filename)
-    else:
+    if filename is None:
         raise IOError('No such file %s' % filename)
+    try:
+        image = FpgImage(filename)
+    except IOError as exc:
+        if exc.errno is not None:
+            # could not open it at all
+            raise
+        image = None
+    if image is not None:
+        with image:
+            lines = image.header_lines()
+    if (image is None) or (lines[0].strip() != '#!/bin/kcpfpg'):
+        raise RuntimeError('%s does not look like an fpg file we can '
+                           'parse.' % filename)
     memorydict = {}
     metalist = []
-    while True:
-        line = fptr.readline().strip().rstrip('\n')
-        if line.lstrip().rstrip() == '?quit':
-            break
-        elif line.startswith('?meta'):
+    for line in lines[1:]:
+        line = line.strip().rstrip('\n')
+        if line.startswith('?meta'):
             # some versions of mlib_devel may mistakenly have put spaces
             # as delimiters where tabs should have been used. Rectify that
             # here.
@@ -136,7 +149,6 @@ def parse_fpg(filename):
                 raise RuntimeError('%s: mem device %s already in '
                                    'dictionary' % (filename, name))
             memorydict[name] = {'address': address, 'bytes': size_bytes}
-    fptr.close()
     return create_meta_dictionary(metalist), memorydict
 
 def get_git_info_from_fpg(fpg_file):
@@ -290,6 +302,19 @@ def program_fpgas(fpga_list, progfile, timeout=10):
     else:
         for fpga in fpga_list:
             fpga.bitstream = progfile
+        from transport_tapcp import TapcpTransport, tapcp_program_many
+        if progfile.endswith('.fpg') and all(
+                isinstance(fpga.transport, TapcpTransport)
+                for fpga in fpga_list):
+            # prepare the image once and share it between the boards
+            results = tapcp_program_many(fpga_list, progfile)
+            failed = [host for host, result in results.items()
+                      if not result['ok']]
+            if failed:
+                raise RuntimeError('Programming failed on: %s' % failed)
+            LOGGER.info('Programming %d FPGAs took %.3f seconds.' % (
+                len(fpga_list), time.time() - stime))
+            return
     threaded_fpga_function(fpga_list, 60, 'upload_to_ram_and_program')
     LOGGER.info('Programming %d FPGAs took %.3f seconds.' % (
         len(fpga_list), time.time() - stime))
@@ -307,18 +332,38 @@ def threaded_create_fpgas_from_hosts(host_list, fpga_class=None,
     :param timeout: how long to wait, in seconds
     :param best_effort: return as many hosts as it was possible to make
     """
+    from casperfpga import CasperFpga
     if fpga_class is None:
-        from casperfpga import CasperFpga
         fpga_class = CasperFpga
 
     num_hosts = len(host_list)
     result_queue = Queue.Queue(maxsize=num_hosts)
     thread_list = []
 
+    # probe all the uncached hosts for their transport in one go, rather
+    # than in every thread
+    transports = {}
+    if issubclass(fpga_class, CasperFpga) and ('transport' not in kwargs):
+        from transport_cache import get_transport_cache
+        from transport_detect import detect_transports
+        use_cache = get_kwarg('transport_cache', kwargs, True)
+        cache = get_transport_cache()
+        transports = detect_transports(
+            [host for host in host_list
+             if not (use_cache and cache.get(host))],
+            use_cache=use_cache)
+
     def makehost(hostname):
-        result_queue.put_nowait(fpga_class(hostname, port, **kwargs))
+        host_kwargs = kwargs
+        if transports.get(hostname) is not None:
+            host_kwargs = kwargs.copy()
+            host_kwargs['transport'] = transports[hostname]
+        result_queue.put_nowait(fpga_class(hostname, port, **host_kwargs))
 
     for host_ in host_list:
+        if (host_ in transports) and (transports[host_] is None):
+            LOGGER.error('%s did not answer any transport probe.' % host_)
+            continue
         thread = threading.Thread(target=makehost, args=(host_,))
         thread.daemon = True
         thread.start()
@@ -402,75 +447,287 @@ def threaded_fpga_function(fpga_list, timeout, target_function):
         fpga_list, timeout, (dofunc, target_function[1], target_function[2]))
 
 
-def threaded_fpga_operation(fpga_list, timeout, target_function, num_retries=5, retry_sleep_time=5):
+class FpgaWorkerPool(object):
+    """
+    A bounded pool of worker threads that runs operations against FPGA
+    objects and returns concurrent.futures Futures.
+
+    The workers are daemon threads that are never joined, so an operation
+    stuck on an unresponsive host cannot stop the interpreter from exiting.
+    concurrent.futures.ThreadPoolExecutor joins its workers at exit.
+
+    A caller that gives up on a running operation can abandon() it. Its
+    worker then no longer counts towards max_workers, so operations stuck
+    on dead hosts cannot leave the rest of the queue without workers.
+    """
+    def __init__(self, max_workers=MAX_WORKERS):
+        """
+
+        :param max_workers: the most worker threads to start
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers must be at least one')
+        self.max_workers = max_workers
+        self._work_queue = Queue.Queue()
+        self._threads = set()
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+        # running futures and when their workers started them
+        self._started = {}
+        self._abandoned = set()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) to run on a worker thread.
+
+        :return: a Future for the result
+        """
+        future = Future()
+        self._work_queue.put((future, fn, args, kwargs))
+        # hand the job to an idle worker if there is one, otherwise start a
+        # new worker if the pool is not full yet
+        if not self._idle.acquire(False):
+            with self._lock:
+                self._add_worker()
+        return future
+
+    def started_at(self, future):
+        """
+        When a worker started running a future.
+
+        :return: the time.time() it started, or None if it is still queued
+            or has finished
+        """
+        with self._lock:
+            return self._started.get(future)
+
+    def abandon(self, future):
+        """
+        Stop counting the worker running a future towards max_workers,
+        because the caller has given up waiting for it. The worker rejoins
+        the pool, or exits if the pool is full, once the future finishes.
+
+        :param future: a running Future from submit()
+        """
+        with self._lock:
+            if (future in self._started) and \
+                    (future not in self._abandoned):
+                self._abandoned.add(future)
+                if not self._work_queue.empty():
+                    self._add_worker()
+
+    def _add_worker(self):
+        # call with self._lock held
+        if len(self._threads) - len(self._abandoned) < self.max_workers:
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.add(thread)
+
+    def _worker(self):
+        while True:
+            future, fn, args, kwargs = self._work_queue.get()
+            if future.set_running_or_notify_cancel():
+                with self._lock:
+                    self._started[future] = time.time()
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as exc:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+                with self._lock:
+                    self._started.pop(future, None)
+                    if future in self._abandoned:
+                        self._abandoned.discard(future)
+                        if len(self._threads) - len(self._abandoned) > \
+                                self.max_workers:
+                            # a replacement took this worker's place
+                            self._threads.discard(threading.current_thread())
+                            return
+            del future, fn, args, kwargs
+            self._idle.release()
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """
+    Get the persistent worker pool shared by the threaded_fpga_* functions,
+    creating it on first use.
+
+    :return: an FpgaWorkerPool with MAX_WORKERS workers
+    """
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = FpgaWorkerPool(MAX_WORKERS)
+        return _worker_pool
+
+
+def _run_target_func(target_function, fpga):
+    return target_function[0](fpga, *target_function[1], **target_function[2])
+
+
+def submit_fpga_operation(fpga_list, target_function):
     """
-    Thread any operation against many FPGA objects
+    Start an operation against many FPGA objects on the shared worker pool,
+    without waiting for it.
+
+    :param fpga_list: list of CasperFpga objects
+    :param target_function: a tuple with three parts, as for
+        threaded_fpga_operation
+    :return: a dictionary of Futures, keyed on hostname
+    """
+    target_function = _check_target_func(target_function)
+    pool = get_worker_pool()
+    return {fpga.host: pool.submit(_run_target_func, target_function, fpga)
+            for fpga in fpga_list}
+
+
+def iter_fpga_operation(fpga_list, timeout, target_function, num_retries=5,
+                        retry_sleep_time=0.5):
+    """
+    Run an operation against many FPGA objects on the shared worker pool,
+    yielding (hostname, result) pairs as each host finishes.
+
+    Every attempt on a host has a deadline of timeout seconds from the
+    moment a worker starts running it, so hosts queued behind a busy pool
+    do not use up their time waiting. A host that raises or misses its
+    deadline is retried on its own after a jittered, exponentially growing
+    back-off, while the other hosts carry on. A worker cannot be stopped,
+    so an attempt that timed out is abandoned to the pool, which stops
+    counting its worker, and the host is not run again while it is still
+    running - that counts as another failed attempt instead, and a late
+    result from it is still used.
+
+    :param fpga_list: list of CasperFpga objects
+    :param timeout: how long each attempt on a host may take, in seconds
+    :param target_function: a tuple with three parts, as for
+        threaded_fpga_operation
+    :param num_retries: the most times to try the operation on a host
+    :param retry_sleep_time: the back-off before the first retry, in
+        seconds - it doubles with every further retry
+    """
+    target_function = _check_target_func(target_function)
+    func_name = getattr(target_function[0], '__name__', target_function[0])
+    pool = get_worker_pool()
+    fpgas = {fpga.host: fpga for fpga in fpga_list}
+    attempts = {host: 0 for host in fpgas}
+    running = {}
+    # attempts that missed their deadline but are still on a worker
+    abandoned = {}
+    retry_at = {}
+    hosts_missing = []
+
+    def submit(host):
+        attempts[host] += 1
+        future = pool.submit(_run_target_func, target_function, fpgas[host])
+        running[future] = host
+
+    def failed(host, reason):
+        if attempts[host] < num_retries:
+            backoff = retry_sleep_time * (2 ** (attempts[host] - 1))
+            backoff = (backoff / 2.0) + random.uniform(0, backoff / 2.0)
+            LOGGER.warning('Ran function %s on %s: %s. Retrying in '
+                           '%.3fs.' % (func_name, host, reason, backoff))
+            retry_at[host] = time.time() + backoff
+        else:
+            hosts_missing.append(host)
+
+    for host in fpgas:
+        submit(host)
+    while running or retry_at:
+        now = time.time()
+        for host, when in retry_at.items():
+            if when > now:
+                continue
+            retry_at.pop(host)
+            previous = abandoned.get(host)
+            if previous is None or previous.done():
+                abandoned.pop(host, None)
+                submit(host)
+            else:
+                attempts[host] += 1
+                failed(host, 'the previous attempt is still running')
+        # sleep until the next deadline or retry is due, waking early for
+        # late results from abandoned attempts of hosts not yet given up on,
+        # and keep checking on attempts still waiting for a worker
+        wakeups = list(retry_at.values())
+        not_started = False
+        for future in running:
+            started = pool.started_at(future)
+            if started is not None:
+                wakeups.append(started + timeout)
+            elif not future.done():
+                not_started = True
+        waiting_on = running.keys() + [
+            future for host, future in abandoned.items() if host in retry_at]
+        wait_time = max(0, min(wakeups) - now) if wakeups else None
+        if not_started:
+            wait_time = 0.1 if wait_time is None else min(wait_time, 0.1)
+        if waiting_on:
+            done, _ = wait(waiting_on, timeout=wait_time,
+                           return_when=FIRST_COMPLETED)
+        else:
+            # nothing left to wait for if the last retry just gave up
+            done = []
+            if wait_time is not None:
+                time.sleep(wait_time)
+        for future in done:
+            if future in running:
+                host = running.pop(future)
+            else:
+                host = [_host for _host, _future in abandoned.items()
+                        if _future is future][0]
+            exc = future.exception()
+            if exc is None:
+                if abandoned.get(host) is future:
+                    abandoned.pop(host)
+                    retry_at.pop(host, None)
+                yield host, future.result()
+            elif future in abandoned.values():
+                # leave the pending retry to run it again
+                abandoned.pop(host)
+            else:
+                failed(host, 'raised %r' % exc)
+        now = time.time()
+        for future, host in running.items():
+            started = pool.started_at(future)
+            if (started is not None) and (now - started > timeout):
+                # the worker cannot be stopped, so remember the attempt
+                # rather than run the host again alongside it
+                running.pop(future)
+                abandoned[host] = future
+                pool.abandon(future)
+                failed(host, 'timed out after %.3fs' % timeout)
+    if hosts_missing:
+        errmsg = 'Ran function \'%s\' on hosts. Did not get a response ' \
+                 'from %s.' % (func_name, hosts_missing)
+        LOGGER.error(errmsg)
+
+
+def threaded_fpga_operation(fpga_list, timeout, target_function, num_retries=5, retry_sleep_time=0.5):
+    """
+    Thread any operation against many FPGA objects, using the shared worker
+    pool. See iter_fpga_operation for the timeout and retry behaviour.
 
     :param fpga_list: list of KatcpClientFpga objects
-    :param timeout: how long to wait before timing out
+    :param timeout: how long each host may take before timing out
     :param target_function: a tuple with three parts:
                             
                             1. reference, the function object that must be
                                run - MUST take FPGA object as first argument
                             2. tuple, the arguments to the function
                             3. dict, the keyword arguments to the function e.g. (func_name, (1,2,), {'another_arg': 3})
+    :param num_retries: the most times to run the operation on a host
+    :param retry_sleep_time: back-off before the first retry of a host
     :return: a dictionary of the results, keyed on hostname
     """
-    target_function = _check_target_func(target_function)
-
-    def jobfunc(resultq, fpga):
-        rv = target_function[0](fpga, *target_function[1], **target_function[2])
-        resultq.put_nowait((fpga.host, rv))
-
-    def run_threaded_op(int_fpga_list):
-        num_fpgas = len(int_fpga_list)
-        result_queue = Queue.Queue(maxsize=num_fpgas)
-        thread_list = []
-        for fpga_ in int_fpga_list:
-            thread = threading.Thread(target=jobfunc, args=(result_queue, fpga_))
-            thread.setDaemon(True)
-            thread.start()
-            thread_list.append(thread)
-        for thread_ in thread_list:
-            thread_.join(timeout)
-            if thread_.isAlive():
-                break
-        returnval = {}
-        hosts_missing = [fpga.host for fpga in int_fpga_list]
-        while True:
-            try:
-                result = result_queue.get_nowait()
-                returnval[result[0]] = result[1]
-                hosts_missing.pop(hosts_missing.index(result[0]))
-            except Queue.Empty:
-                break
-        return returnval, hosts_missing
-    
-    retry = 0
-    current_fpga_list = fpga_list[:]
-    while retry < num_retries:
-        returnval, hosts_missing = run_threaded_op(current_fpga_list)
-        if hosts_missing:
-            #warnmsg = ('Ran function {} on hosts. Did not get a response '
-            #           'from {}.'.format(target_function[0].__name__, hosts_missing))
-            warnmsg = ('Ran function {} on hosts. Did not get a response '
-                       'from {}.'.format(target_function[0].func_name, hosts_missing))
-            LOGGER.warning(warnmsg)
-            retry += 1
-            new_fpga_list = []
-            for fpga_obj in current_fpga_list:
-                if fpga_obj.host in hosts_missing:
-                    new_fpga_list.append(fpga_obj)
-            current_fpga_list = new_fpga_list[:]
-            time.sleep(retry_sleep_time)
-        else:
-            break
-
-    if hosts_missing:
-        errmsg = 'Ran function \'%s\' on hosts. Did not get a response ' \
-                 'from %s.' % (target_function[0].__name__, hosts_missing)
-        LOGGER.error(errmsg)
-    return returnval
+    return dict(iter_fpga_operation(fpga_list, timeout, target_function,
+                                    num_retries, retry_sleep_time))
 
 
 def threaded_non_blocking_request(fpga_list, timeout, request, request_args):